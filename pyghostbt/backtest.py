@@ -1,4 +1,9 @@
+import copy
 import json
+import random
+import numpy as np
+
+from collections import deque
 
 from typing import List
 from typing import Dict
@@ -8,21 +13,248 @@ from pyghostbt.tool.order import CommonOrder
 from pyghostbt.tool.param import Param
 from pyghostbt.tool.indices import Indices
 from pyghostbt.tool.asset import Asset
+from pyghostbt.tool.asset import drop_ledgers
+from pyghostbt.tool.passage import FirstPassageIndex
+from pyghostbt.tool.kline import KlineCursor
+from pyghostbt.tool.checkpoint import CheckpointFile
 from pyghostbt.const import *
-from pyanalysis.mysql import Conn
+from pyghostbt.tool.storage import connect
+from pyghostbt.tool import storage
+from pyghostbt.tool.storage import upsert_sql
 from pyanalysis.moment import moment
+from pyanalysis.mysql import Conn
+
+
+class SwapWindow(object):
+    """The close prices of the last SIZE aligned candle groups for the L_SWAP/O_SWAP contracts.
+
+    A candle group is aligned when it has the candles of all the instances' contracts. The window
+    keeps a running sum per contract, so the average prices are updated in O(1) per minute.
+    """
+    SIZE = 15
+
+    def __init__(self, instances: List[dict]):
+        self._due_timestamps = [instance["order"]["due_timestamp"] for instance in instances]
+        swap_due_timestamps = [
+            instance["order"]["due_timestamp"] for instance in instances
+            if instance["order"]["place_type"] in (ORDER_PLACE_TYPE_L_SWAP, ORDER_PLACE_TYPE_O_SWAP)
+        ]
+        self.flag = 0  # 对齐的蜡烛组数量
+        self.latest: Dict[int, dict] = {}  # 最新一组对齐的蜡烛
+        self._closes: Dict[int, deque] = {d: deque(maxlen=self.SIZE) for d in swap_due_timestamps}
+        self._sums: Dict[int, float] = {d: 0 for d in swap_due_timestamps}
+
+    def push(self, candles_kv: Dict[int, dict]) -> None:
+        for due_timestamp in self._due_timestamps:
+            # 说明instance中有些contract的candle数据没有，放弃此candle组。
+            if due_timestamp not in candles_kv:
+                return
+
+        self.flag += 1
+        for due_timestamp, closes in self._closes.items():
+            candle = candles_kv[due_timestamp]
+            if len(closes) == self.SIZE:
+                self._sums[due_timestamp] -= closes[0]
+            closes.append(candle["close"])
+            self._sums[due_timestamp] += candle["close"]
+            self.latest[due_timestamp] = candle
+
+    def avg_price(self, due_timestamp: int) -> float:
+        return self._sums[due_timestamp] / self.SIZE
 
 
 class Backtest(Strategy):
     def __init__(self, kw: dict):
+        self._config = copy.deepcopy(kw)  # 从检查点恢复时用同样的配置
         super().__init__(kw)
+        self._passage = None  # 预加载的1min蜡烛的首次触及索引
+        self._cursor = None  # 1min蜡烛的扫描位置，同一个instance的各阶段接着上次触发的位置继续
+        self.checkpoint_timestamp = 0  # 最近一次检查点的时间
+        self.checkpoint_state = None  # 从检查点恢复时，策略保存的状态
 
         # self._slippage = 0.01  # 滑点百分比
         # self._fee = -0.0005  # 手续费比例
 
+    def flush(self) -> int:
+        """Write the buffered rows and the in-memory backtest tables into MySQL, at the end of the backtest
+        or at a checkpoint. Return the count of the rows written from the memory tables.
+        """
+        for db_name in self._storage_db_names:
+            storage.flush(db_name)
+        return sum([s.flush() for s in self._memory_storages.values()])
+
+    def finish(self) -> int:
+        """Flush at the end of the backtest. The write buffers are removed, so the later upserts of the
+        process, e.g. of the strategy orders, are written directly. The open kline stream of the cursor
+        is closed.
+        """
+        if self._cursor is not None:
+            self._cursor.close()
+        count = self.flush()
+        for db_name in self._storage_db_names:
+            storage.use_direct(db_name)
+        return count
+
+    def _checkpoint_tables(self) -> Dict[str, tuple]:
+        """The (db_name, table_name) of the backtest tables saved by the checkpoint. """
+        db_name_asset = self.get("db_name_asset") or self["db_name"]
+        tables = {
+            "instance": (self["db_name"], "{}_instance_backtest"),
+            "order": (self["db_name"], "{}_order_backtest"),
+            "param": (self.get("db_name_param") or self["db_name"], "{}_param_backtest"),
+            "indices": (self["db_name"], "{}_indices_backtest"),
+            "flow": (db_name_asset, "{}_account_flow_backtest"),
+            "asset": (db_name_asset, "{}_asset_backtest"),
+        }
+        return {k: (db_name, table_name.format(self["trade_type"])) for k, (db_name, table_name) in tables.items()}
+
+    def checkpoint(self, timestamp: int, finish_timestamp: int, state=None, force: bool = False) -> bool:
+        """Save the state of the backtest into backtest_checkpoint_dir, resume() continues the run from it.
+
+        The periods before the timestamp must be finished, i.e. no flow is written before the timestamp
+        after the checkpoint. The state is any picklable data of the strategy, e.g. its loop variables.
+        The checkpoint is skipped if the last one is less than backtest_checkpoint_interval ago, unless
+        force. Return whether the checkpoint is saved.
+        """
+        directory = self.get("backtest_checkpoint_dir")
+        if not directory:
+            raise RuntimeError("the backtest_checkpoint_dir is required to save the checkpoint")
+        interval = self.get("backtest_checkpoint_interval") or 0
+        if not force and self.checkpoint_timestamp and timestamp - self.checkpoint_timestamp < interval:
+            return False
+
+        # 内存表和缓冲的数据先写入MySQL，检查点按MySQL中的id保存。
+        self.flush()
+        tables = self._checkpoint_tables()
+        last_ids = {}
+        for key, (db_name, table_name) in tables.items():
+            one = Conn(db_name).query_one("SELECT MAX(id) AS id FROM {}".format(table_name))
+            last_ids[key] = (one and one["id"]) or 0
+
+        db_name, table_name = tables["instance"]
+        instances = Conn(db_name).query(
+            "SELECT * FROM {} WHERE backtest_id = ? AND status NOT IN (?, ?)".format(table_name),
+            (self["backtest_id"], INSTANCE_STATUS_FINISHED, INSTANCE_STATUS_ERROR),
+        )
+        rows = {"instance": instances}
+        instance_ids = [i["id"] for i in instances]
+        for key in ("order", "param", "indices"):
+            db_name, table_name = tables[key]
+            rows[key] = Conn(db_name).query(
+                "SELECT * FROM {} WHERE instance_id IN ({})".format(table_name, ", ".join(["?"] * len(instance_ids))),
+                tuple(instance_ids),
+            ) if instance_ids else []
+        db_name, table_name = tables["asset"]
+        # 检查点时间上的资产快照之后还可能被更新
+        rows["asset"] = Conn(db_name).query(
+            "SELECT * FROM {} WHERE backtest_id = ? AND timestamp >= ?".format(table_name),
+            (self["backtest_id"], timestamp),
+        )
+
+        CheckpointFile.save(directory, self["backtest_id"], {
+            "config": self._config,
+            "timestamp": timestamp,
+            "finish_timestamp": finish_timestamp,
+            "last_ids": last_ids,
+            "rows": rows,
+            "asset": dict(self["asset"]),
+            "cursor": (self._cursor.position, self._cursor.standard) if self._cursor is not None else None,
+            "random": random.getstate(),
+            "numpy_random": np.random.get_state(),
+            "state": state,
+        })
+        self.checkpoint_timestamp = timestamp
+        return True
+
+    @classmethod
+    def resume(cls, backtest_id: str, checkpoint_dir: str):
+        """Continue the backtest from its last checkpoint under the same backtest_id, return the backtest.
+
+        The rows written after the checkpoint are removed and the saved rows of the live instances are
+        written back, then run() continues from the checkpoint timestamp with the restored asset, scan
+        cursor and random state. The state passed to checkpoint() is in checkpoint_state.
+        """
+        checkpoint = CheckpointFile.load(checkpoint_dir, backtest_id)
+        config = dict(checkpoint["config"], backtest_id=backtest_id, backtest_checkpoint_dir=checkpoint_dir)
+        if config.get("backtest_storage") == STORAGE_MEMORY:
+            # 检查点之前的数据只在MySQL中，恢复以后直接读写MySQL。
+            config["backtest_storage"] = STORAGE_MYSQL
+        backtest = cls(config)
+        # 同一个进程中中断的回测还缓冲着的数据先写入，再和检查点之后的其他数据一起删除。
+        backtest.flush()
+        with backtest.memory_scope():
+            backtest._restore(checkpoint)
+            backtest.run(checkpoint["timestamp"], checkpoint["finish_timestamp"])
+        backtest.finish()
+        return backtest
+
+    def _restore(self, checkpoint: dict) -> None:
+        tables = self._checkpoint_tables()
+        last_ids, rows = checkpoint["last_ids"], checkpoint["rows"]
+
+        db_name, table_name = tables["instance"]
+        conn = Conn(db_name)
+        created_ids = [i["id"] for i in conn.query(
+            "SELECT id FROM {} WHERE backtest_id = ? AND id > ?".format(table_name),
+            (self["backtest_id"], last_ids["instance"]),
+        )]
+        instance_ids = created_ids + [i["id"] for i in rows["instance"]]
+        if instance_ids:
+            placeholders = ", ".join(["?"] * len(instance_ids))
+            for key in ("order", "param", "indices"):
+                key_db_name, key_table_name = tables[key]
+                Conn(key_db_name).execute(
+                    "DELETE FROM {} WHERE instance_id IN ({})".format(key_table_name, placeholders),
+                    tuple(instance_ids),
+                )
+        if created_ids:
+            conn.execute(
+                "DELETE FROM {} WHERE id IN ({})".format(table_name, ", ".join(["?"] * len(created_ids))),
+                tuple(created_ids),
+            )
+        for instance in rows["instance"]:
+            columns = [c for c in instance if c != "id"]
+            conn.execute(
+                "UPDATE {} SET {} WHERE id = ?".format(table_name, ", ".join(["`{}` = ?".format(c) for c in columns])),
+                tuple([instance[c] for c in columns]) + (instance["id"],),
+            )
+
+        db_name, table_name = tables["flow"]
+        Conn(db_name).execute(
+            "DELETE FROM {} WHERE backtest_id = ? AND id > ?".format(table_name),
+            (self["backtest_id"], last_ids["flow"]),
+        )
+        db_name, table_name = tables["asset"]
+        Conn(db_name).execute(
+            "DELETE FROM {} WHERE backtest_id = ? AND (id > ? OR timestamp >= ?)".format(table_name),
+            (self["backtest_id"], last_ids["asset"], checkpoint["timestamp"]),
+        )
+
+        for key in ("order", "param", "indices", "asset"):
+            if len(rows[key]) == 0:
+                continue
+            db_name, table_name = tables[key]
+            columns = list(rows[key][0].keys())
+            params = []
+            for row in rows[key]:
+                params.extend([row[c] for c in columns])
+            Conn(db_name).execute(upsert_sql(table_name, columns, len(rows[key])), tuple(params))
+
+        # 账本中还有检查点之后的流水
+        drop_ledgers(self["backtest_id"])
+        self["asset"].update(checkpoint["asset"])
+        if checkpoint["cursor"] is not None:
+            position, standard = checkpoint["cursor"]
+            self._cursor = KlineCursor(self._kline, KLINE_INTERVAL_1MIN, standard=standard)
+            self._cursor.seek(position)
+        random.setstate(checkpoint["random"])
+        np.random.set_state(checkpoint["numpy_random"])
+        self.checkpoint_timestamp = checkpoint["timestamp"]
+        self.checkpoint_state = checkpoint["state"]
+
     # 获取instance 风险等级。
     def _get_risk_level(self, timestamp: int, instance_id: int) -> int:
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         table_name = "{trade_type}_instance_backtest".format(trade_type=self["trade_type"])
         query_sql = """
         SELECT id FROM {} WHERE backtest_id = ? AND symbol = ? AND exchange = ?
@@ -82,7 +314,7 @@ class Backtest(Strategy):
                 self["strategy"], INSTANCE_STATUS_WAITING, 0,
             )
 
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         one = conn.query_one(
             query_sql.format(trade_type=self["trade_type"]),
             params,
@@ -97,7 +329,7 @@ class Backtest(Strategy):
         return insert_id
 
     def _is_opened(self, wait_start_timestamp: int) -> bool:
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         if self["trade_type"] == TRADE_TYPE_FUTURE:
             opened = conn.query(
                 "SELECT id FROM future_instance_backtest WHERE backtest_id = ? AND symbol = ? AND exchange = ?"
@@ -149,7 +381,7 @@ class Backtest(Strategy):
     #             self["strategy"], INSTANCE_STATUS_WAITING, 0, self["backtest_id"],
     #         )
     #
-    #     conn = Conn(self["db_name"])
+    #     conn = connect(self["db_name"])
     #     # 线上环境中应该查找对应的instance记录来确定最新的 id
     #     one = conn.query_one(
     #         query_sql.format(trade_type=self["trade_type"]),
@@ -246,60 +478,45 @@ class Backtest(Strategy):
                 return [l_swap_instance, o_swap_instance]
         return []
 
-    # 多个timestamp的多个contract的蜡烛数据，跟instance比较。
-    def __compare_candles_kv_with_instances(
+    # 最近15个对齐的蜡烛组的窗口，跟instance比较。
+    def __compare_swap_window(
             self,
-            candles_kv: Dict[int, Dict[int, dict]],
+            window: SwapWindow,
+            candles_kv: Dict[int, dict],
             instances: List[dict],
     ) -> List[dict]:
-        if len(candles_kv) == 0:
-            return []
-
-        contracts_kv: Dict[int, List[dict]] = {}  # record due_timestamp with the candles
-        flag = 0
-        candle_timestamps = sorted(candles_kv.keys(), reverse=True)
-        for timestamp in candle_timestamps:
-            for instance in instances:
-                # 说明instance中有些contract的candle数据没有，放弃此candle组。
-                if instance["order"]["due_timestamp"] not in candles_kv[timestamp]:
-                    break
-            else:
-                for due_timestamp in candles_kv[timestamp]:
-                    if due_timestamp not in contracts_kv:
-                        contracts_kv[due_timestamp] = []
-                    contracts_kv[due_timestamp].append(candles_kv[timestamp][due_timestamp])
-                flag += 1
-
         l_avg_price, o_avg_price = 0.0, 0.0
         l_price, o_price = 0.0, 0.0
         l_swap_instance, o_swap_instance = None, None
         for instance in instances:
-            the_candles = contracts_kv.get(instance["order"]["due_timestamp"])
+            due_timestamp = instance["order"]["due_timestamp"]
             if instance["order"]["place_type"] == ORDER_PLACE_TYPE_L_SWAP:
-                if flag < 15:  # 没有超过15个蜡烛数据不进行匹配
+                if window.flag < SwapWindow.SIZE:  # 没有超过15个蜡烛数据不进行匹配
                     continue
-                l_price = the_candles[0]["close"]
-                l_avg_price = sum([c["close"] for c in the_candles[:15]]) / 15
+                the_candle = window.latest[due_timestamp]
+                l_price = the_candle["close"]
+                l_avg_price = window.avg_price(due_timestamp)
                 l_swap_instance = instance
                 l_swap_instance["order"]["price"] = l_price  # add the candle close price to order
-                l_swap_instance["order"]["place_timestamp"] = the_candles[0]["timestamp"]
-                l_swap_instance["order"]["place_datetime"] = the_candles[0]["date"]
-                l_swap_instance["order"]["deal_timestamp"] = the_candles[0]["timestamp"]
-                l_swap_instance["order"]["deal_datetime"] = the_candles[0]["date"]
+                l_swap_instance["order"]["place_timestamp"] = the_candle["timestamp"]
+                l_swap_instance["order"]["place_datetime"] = the_candle["date"]
+                l_swap_instance["order"]["deal_timestamp"] = the_candle["timestamp"]
+                l_swap_instance["order"]["deal_datetime"] = the_candle["date"]
             elif instance["order"]["place_type"] == ORDER_PLACE_TYPE_O_SWAP:
-                if flag < 15:  # 没有超过15个蜡烛数据不进行匹配
+                if window.flag < SwapWindow.SIZE:  # 没有超过15个蜡烛数据不进行匹配
                     continue
-                o_price = the_candles[0]["close"]
-                o_avg_price = sum([c["close"] for c in the_candles[:15]]) / 15
+                the_candle = window.latest[due_timestamp]
+                o_price = the_candle["close"]
+                o_avg_price = window.avg_price(due_timestamp)
                 o_swap_instance = instance
                 o_swap_instance["order"]["price"] = o_price
-                o_swap_instance["order"]["place_timestamp"] = the_candles[0]["timestamp"]
-                o_swap_instance["order"]["place_datetime"] = the_candles[0]["date"]
-                o_swap_instance["order"]["deal_timestamp"] = the_candles[0]["timestamp"]
-                o_swap_instance["order"]["deal_datetime"] = the_candles[0]["date"]
+                o_swap_instance["order"]["place_timestamp"] = the_candle["timestamp"]
+                o_swap_instance["order"]["place_datetime"] = the_candle["date"]
+                o_swap_instance["order"]["deal_timestamp"] = the_candle["timestamp"]
+                o_swap_instance["order"]["deal_datetime"] = the_candle["date"]
             else:
-                # 除了换仓的订单进行匹配。
-                the_candle = candles_kv[candle_timestamps[0]].get(instance["order"]["due_timestamp"])
+                # 除了换仓的订单，用最新一组蜡烛进行匹配。
+                the_candle = candles_kv.get(due_timestamp)
                 if the_candle and self.__compare_candle_with_instance(
                         the_candle,
                         instance,
@@ -310,6 +527,189 @@ class Backtest(Strategy):
                 return [l_swap_instance, o_swap_instance]
         return []
 
+    def __match_frames(self, frames, instances: List[Dict]) -> Dict:
+        """Find the first triggered (candle, instance) pair of the candle frames with numpy.
+
+        Every frame is compared with all the instances as a candles x instances mask, the first True
+        in the row-major order is the pair which the candle by candle comparison triggers first.
+        """
+        if not instances:
+            return {}
+        place_types = [instance["order"]["place_type"] for instance in instances]
+        t_taker = np.array([t == ORDER_PLACE_TYPE_T_TAKER for t in place_types])
+        b_taker = np.array([t == ORDER_PLACE_TYPE_B_TAKER for t in place_types])
+        # 市价单在第一根蜡烛成交，其他类型在比较时报错。
+        others = ~(t_taker | b_taker)
+        prices = np.array([
+            instance["order"]["price"] if t_taker[i] or b_taker[i] else 0
+            for i, instance in enumerate(instances)
+        ], dtype=np.float64)
+
+        for frame in frames:
+            if len(frame) == 0:
+                continue
+            mask = (t_taker & (frame.high[:, None] > prices)) | (b_taker & (frame.low[:, None] < prices)) | others
+            first = int(np.argmax(mask))
+            i, j = divmod(first, len(instances))
+            if mask[i, j]:
+                return self.__compare_candle_with_instance(frame.row(i), instances[j])
+        return {}
+
+    @staticmethod
+    def _coarse_possible(frame, instances: List[Dict]) -> np.ndarray:
+        """The coarse candles whose high/low range crosses the price of any instance. """
+        possible = np.zeros(len(frame), dtype=bool)
+        for instance in instances:
+            order = instance["order"]
+            if order["place_type"] == ORDER_PLACE_TYPE_T_TAKER:
+                possible |= frame.high > order["price"]
+            elif order["place_type"] == ORDER_PLACE_TYPE_B_TAKER:
+                possible |= frame.low < order["price"]
+            else:
+                possible[:] = True
+        return possible
+
+    @staticmethod
+    def _add_segment(segments: list, lo: int, hi: int) -> None:
+        """Append [lo, hi) to the sorted segments, merged with the last one if they touch. """
+        if lo >= hi:
+            return
+        if segments and segments[-1][1] >= lo:
+            segments[-1][1] = max(segments[-1][1], hi)
+        else:
+            segments.append([lo, hi])
+
+    @classmethod
+    def _coarse_ranges(
+            cls,
+            start_timestamp: int,
+            finish_timestamp: int,
+            ranges: list,
+            bucket_starts: np.ndarray,
+            bucket_size: int,
+    ) -> list:
+        """The parts of [start_timestamp, finish_timestamp) to scan with the 1min candles.
+
+        Inside the covered ranges only the possible buckets are scanned, cut at the range edges. The
+        parts not covered are always scanned.
+        """
+        segments = []
+        flag_timestamp = start_timestamp
+        for covered_start, covered_finish in sorted(ranges):
+            if covered_finish <= flag_timestamp:
+                continue
+            if covered_start >= finish_timestamp:
+                break
+            # 没有覆盖的部分直接扫描1min蜡烛
+            cls._add_segment(segments, flag_timestamp, min(covered_start, finish_timestamp))
+            lo, hi = max(covered_start, flag_timestamp), min(covered_finish, finish_timestamp)
+            i, j = np.searchsorted(bucket_starts, [lo - bucket_size, hi], side="right")
+            for bucket_start in bucket_starts[i:j].tolist():
+                cls._add_segment(segments, max(bucket_start, lo), min(bucket_start + bucket_size, hi))
+            flag_timestamp = hi
+        cls._add_segment(segments, flag_timestamp, finish_timestamp)
+        return segments
+
+    def __coarse_segments(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            instances: List[Dict],
+            standard: bool,
+    ):
+        """The ranges of [start_timestamp, finish_timestamp) in which the 1min candles may trigger the instances.
+
+        The coarse candles of backtest_coarse_interval are read from the kline pyramid. A bucket whose
+        high/low range does not cross any order price can not trigger, so its 1min candles are skipped.
+        The ranges not covered by the pyramid are always scanned. None if there is no pyramid.
+        """
+        interval = self.get("backtest_coarse_interval")
+        if not interval:
+            return None
+        if interval not in (KLINE_INTERVAL_1HOUR, KLINE_INTERVAL_4HOUR, KLINE_INTERVAL_1DAY):
+            raise RuntimeError("do not support the coarse interval", interval)
+        frame, ranges = self._kline.query_pyramid(start_timestamp, finish_timestamp, interval, standard=standard)
+        if frame is None:
+            return None
+
+        # 任意一个instance的价格在这根蜡烛的范围内时，可能触发。
+        bucket_starts = frame.timestamp[self._coarse_possible(frame, instances)]
+        return self._coarse_ranges(
+            start_timestamp, finish_timestamp, ranges, bucket_starts, INTERVAL_MILLISECONDS[interval],
+        )
+
+    def __min_frames(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            instances: List[Dict],
+            standard: bool,
+    ):
+        segments = self.__coarse_segments(start_timestamp, finish_timestamp, instances, standard)
+        if segments is None:
+            if self._cursor is None or self._cursor.standard != standard:
+                self._cursor = KlineCursor(self._kline, KLINE_INTERVAL_1MIN, standard=standard)
+            yield from self._cursor.frames(start_timestamp, finish_timestamp)
+            return
+        for lo, hi in segments:
+            yield from self._kline.query_frames(lo, hi, KLINE_INTERVAL_1MIN, standard=standard)
+
+    def __match_min_frames(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            instances: List[Dict],
+            standard: bool,
+    ) -> Dict:
+        frames = self.__min_frames(start_timestamp, finish_timestamp, instances, standard)
+        passed = self.__match_frames(frames, instances)
+        # 下一个阶段从触发的蜡烛继续扫描
+        if passed and self._cursor is not None and self._cursor.standard == standard:
+            self._cursor.seek(passed["order"]["place_timestamp"])
+        return passed
+
+    def preload_min_kline(self, start_timestamp: int, finish_timestamp: int, standard: bool = True) -> None:
+        """Load the 1min candles of the whole backtest range once, and build the first passage index.
+
+        The _back_test_by_min_kline calls inside the range find the trigger candle in O(log n) instead of
+        scanning the candles one by one.
+        """
+        frame = self._kline.query_frame(start_timestamp, finish_timestamp, KLINE_INTERVAL_1MIN, standard=standard)
+        self._passage = FirstPassageIndex(frame, start_timestamp, finish_timestamp)
+
+    def __first_passage(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            instances: List[Dict],
+            standard: bool,
+    ):
+        """The same result as comparing the candles with the instances one by one, None if not preloaded. """
+        passage: FirstPassageIndex = self._passage
+        if passage is None or passage.frame.standard != standard:
+            return None
+        if not passage.covers(start_timestamp, finish_timestamp):
+            return None
+
+        lo, first = passage.index(start_timestamp), passage.index(finish_timestamp)
+        triggered = None
+        for instance in instances:
+            order = instance["order"]
+            if order["place_type"] == ORDER_PLACE_TYPE_T_TAKER:
+                i = passage.first_above(order["price"], lo, first)
+            elif order["place_type"] == ORDER_PLACE_TYPE_B_TAKER:
+                i = passage.first_below(order["price"], lo, first)
+            else:
+                # 市价单在第一根蜡烛成交，其他类型在比较时报错。
+                i = lo if lo < first else -1
+            # 同一根蜡烛上，排在前面的instance优先。
+            if i != -1:
+                first, triggered = i, instance
+
+        if triggered is None:
+            return {}
+        return self.__compare_candle_with_instance(passage.frame.row(first), triggered)
+
     def _back_test_by_min_kline(
             self,
             start_timestamp: int,
@@ -317,19 +717,12 @@ class Backtest(Strategy):
             instances: List[Dict] = None,
             standard: bool = True,
     ) -> Dict:
-        candles = self._kline.query_range(
-            start_timestamp,
-            finish_timestamp,
-            KLINE_INTERVAL_1MIN,
-            standard=standard
-        )
-        # instance 触发了
-        for candle in candles:
-            for instance in instances:
-                if self.__compare_candle_with_instance(candle, instance):
-                    return instance
-        # instance 没触发
-        return {}
+        passed = self.__first_passage(start_timestamp, finish_timestamp, instances, standard)
+        if passed is not None:
+            return passed
+
+        # 没触发时返回 {}
+        return self.__match_min_frames(start_timestamp, finish_timestamp, instances, standard)
 
     def _back_test_by_min_kline1(
             self,
@@ -338,19 +731,12 @@ class Backtest(Strategy):
             instances: List[Dict] = None,
             standard: bool = True,
     ) -> List[Dict]:
-        candles = self._kline.query_range(
-            start_timestamp,
-            finish_timestamp,
-            KLINE_INTERVAL_1MIN,
-            standard=standard
-        )
-        # instance 触发了
-        for candle in candles:
-            for instance in instances:
-                if self.__compare_candle_with_instance(candle, instance):
-                    return [instance]
-        # instance 没触发
-        return []
+        passed = self.__first_passage(start_timestamp, finish_timestamp, instances, standard)
+        if passed is not None:
+            return [passed] if passed else []
+
+        passed = self.__match_min_frames(start_timestamp, finish_timestamp, instances, standard)
+        return [passed] if passed else []
 
     def _back_test_swap_by_min_kline(
             self,
@@ -369,24 +755,28 @@ class Backtest(Strategy):
             standard=standard
         )
 
-        frag_candles_kv: Dict[int, Dict[int, Dict]] = {}  # the key is timestamp, due_timestamp, value is candle
-        tmp_instances: List[dict] = []  # 触发后的instances
+        # 只保留最近15个对齐的蜡烛组，每分钟 O(1) 比较一次。
+        window = SwapWindow(instances)
+        candles_kv: Dict[int, Dict] = {}  # 当前蜡烛组，the key is due_timestamp, value is candle
         last_timestamp = 0
 
         for candle in candles:
-            # 出现新的candle组时，进行比较一轮
-            if candle["timestamp"] != last_timestamp:
-                tmp_instances = self.__compare_candles_kv_with_instances(frag_candles_kv, instances)
+            # 出现新的candle组时，上一组已经完整，进行比较一轮
+            if candle["timestamp"] != last_timestamp and candles_kv:
+                window.push(candles_kv)
+                tmp_instances = self.__compare_swap_window(window, candles_kv, instances)
                 if tmp_instances:
-                    break
-                frag_candles_kv[candle["timestamp"]] = {}
+                    return tmp_instances
+                candles_kv = {}
 
             last_timestamp = candle["timestamp"]
-            frag_candles_kv[candle["timestamp"]][candle["due_timestamp"]] = candle
-        else:
-            # 最后frag_candles_kv彻底组装完成以后，再进行匹配
-            tmp_instances = self.__compare_candles_kv_with_instances(frag_candles_kv, instances)
-        return tmp_instances
+            candles_kv[candle["due_timestamp"]] = candle
+
+        # 最后一组蜡烛组装完成以后，再进行匹配
+        if candles_kv:
+            window.push(candles_kv)
+            return self.__compare_swap_window(window, candles_kv, instances)
+        return []
 
     def _back_test_by_day_kline(
             self,
@@ -395,23 +785,18 @@ class Backtest(Strategy):
             instances=None,
             standard=True,
     ) -> Dict:
-        candles = self._kline.query(
+        frame = self._kline.query_frame(
             start_timestamp,
             finish_timestamp,
             KLINE_INTERVAL_1DAY,
             standard=standard
         )
-
-        for candle in candles:
-            for instance in instances:
-                if self.__compare_candle_with_instance(candle, instance):
-                    return instance
-        # instance 没触发
-        return {}
+        # 没触发时返回 {}
+        return self.__match_frames([frame], instances)
 
     def save(self, slippage=0.01, fee=-0.0005) -> None:
         self.check_instance(self)
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         one = conn.query_one(
             "SELECT id FROM {trade_type}_instance_{mode} WHERE id = ?".format(**self),
             (self["id"],),
@@ -509,7 +894,7 @@ class Backtest(Strategy):
             # 如果没有一个contract中有持仓，则认为交易结束。
             instance_status = INSTANCE_STATUS_FINISHED
 
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         conn.execute(
             "UPDATE {trade_type}_instance_backtest SET wait_finish_timestamp = ?, wait_finish_datetime = ?,"
             " status = ?, unit_amount = ? WHERE id = ?".format(trade_type=self["trade_type"]),
@@ -542,7 +927,7 @@ class Backtest(Strategy):
         )
 
         # 步骤三： 更新到对应的instance上。
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         if self["trade_type"] == TRADE_TYPE_FUTURE:
             conn.execute(
                 "UPDATE {}_instance_backtest SET asset_pnl = ? WHERE id = ?".format(self["trade_type"]),
@@ -555,6 +940,51 @@ class Backtest(Strategy):
             )
         return 0
 
+    def summary(self, timestamp: int) -> dict:
+        """The summary metrics of the backtest at the timestamp, to compare the backtests of a sweep. """
+        conn = connect(self["db_name"])
+        one = conn.query_one(
+            "SELECT COUNT(*) AS instances, SUM(CASE WHEN status = ? THEN 1 ELSE 0 END) AS finished,"
+            " SUM(CASE WHEN asset_pnl > 0 THEN 1 ELSE 0 END) AS wins, SUM(asset_pnl) AS pnl"
+            " FROM {}_instance_backtest WHERE backtest_id = ?".format(self["trade_type"]),
+            (INSTANCE_STATUS_FINISHED, self["backtest_id"]),
+        )
+        finished = int(one["finished"] or 0)
+        asset: Asset = self["asset"]
+        asset.load(timestamp)
+        return {
+            "backtest_id": self["backtest_id"],
+            "instances": int(one["instances"] or 0),
+            "finished": finished,
+            "win_rate": int(one["wins"] or 0) / finished if finished else 0.0,
+            "pnl": float(one["pnl"] or 0),
+            "asset_total": asset["asset_total"],
+            "position_total": asset["position_total"],
+        }
+
+    # 回测 [start_timestamp, finish_timestamp)，由具体的策略实现。
+    def run(self, start_timestamp: int, finish_timestamp: int) -> None:
+        pass
+
+    # 由Engine单次遍历蜡烛时调用，按照instance当前的阶段分发，见Engine。
+    def on_candle(self, candle: dict) -> None:
+        status = self.get("status", INSTANCE_STATUS_WAITING)
+        if status == INSTANCE_STATUS_WAITING:
+            self.on_waiting(candle)
+        elif status == INSTANCE_STATUS_OPENING:
+            self.on_opening(candle)
+        elif status == INSTANCE_STATUS_LIQUIDATING:
+            self.on_liquidating(candle)
+
+    def on_waiting(self, candle: dict) -> None:
+        pass
+
+    def on_opening(self, candle: dict) -> None:
+        pass
+
+    def on_liquidating(self, candle: dict) -> None:
+        pass
+
     # 返回结果为该阶段结束时间，如果返回0表示该阶段没有触发
     def back_test_waiting(self, bt_wait_start_timestamp: int) -> int:
         pass
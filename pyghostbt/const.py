@@ -17,6 +17,10 @@ MODE_STRATEGY = "strategy"
 MODE_ONLINE = "online"
 MODE_OFFLINE = "offline"
 
+# 回测数据的存储方式，memory时回测过程中只写内存，结束时再批量写入MySQL。
+STORAGE_MYSQL = "mysql"
+STORAGE_MEMORY = "memory"
+
 KLINE_INTERVAL_1MIN = "1min"
 KLINE_INTERVAL_15MIN = "15min"
 KLINE_INTERVAL_1HOUR = "1hour"
@@ -108,3 +112,13 @@ INTERVAL_4HOUR = "4hour"
 INTERVAL_8HOUR = "8hour"
 INTERVAL_1DAY = "1day"
 INTERVAL_1WEEK = "1week"
+
+INTERVAL_MILLISECONDS = {
+    INTERVAL_1MIN: 60 * 1000,
+    INTERVAL_15MIN: 15 * 60 * 1000,
+    INTERVAL_1HOUR: 60 * 60 * 1000,
+    INTERVAL_4HOUR: 4 * 60 * 60 * 1000,
+    INTERVAL_8HOUR: 8 * 60 * 60 * 1000,
+    INTERVAL_1DAY: 24 * 60 * 60 * 1000,
+    INTERVAL_1WEEK: 7 * 24 * 60 * 60 * 1000,
+}
@@ -0,0 +1,58 @@
+from typing import List
+from pyghostbt.tool.kline import Kline
+from pyghostbt.const import *
+
+# 离开这些状态的instance不再接收蜡烛
+ENGINE_DONE_STATUS = (INSTANCE_STATUS_FINISHED, INSTANCE_STATUS_ERROR)
+
+
+class Engine(object):
+    """Walk the candles of a symbol once in time order, dispatch every candle to all the live instances.
+
+    The instances are the Backtest objects of any strategy, Backtest.on_candle() calls the hook of the
+    current stage, so a stage change takes effect from the next candle. Every candle is read and
+    converted once no matter how many instances or stage changes there are, the total data read
+    scales with the backtest length.
+
+    The instances added during the run, e.g. the new waiting instance created by a hook, receive the
+    candles from the next one. An instance leaves the engine when its status is finished or error.
+    """
+
+    def __init__(self, kline: Kline, interval: str = KLINE_INTERVAL_1MIN, standard: bool = True):
+        self._kline = kline
+        self._interval = interval
+        self._standard = standard
+        self._live = []  # [(start_timestamp, backtest)]
+        self._added = []
+        self.timestamp = 0  # 正在分发的蜡烛的时间
+        self.candles = 0  # 已经分发的蜡烛数量
+
+    def add(self, backtest, start_timestamp: int = 0) -> None:
+        """Add the instance, it receives the candles at or after the start_timestamp. """
+        self._added.append((start_timestamp, backtest))
+
+    @property
+    def instances(self) -> List:
+        return [backtest for _, backtest in self._live + self._added]
+
+    def run(self, start_timestamp: int, finish_timestamp: int) -> int:
+        """Dispatch the candles in [start_timestamp, finish_timestamp), return the count of the candles. """
+        count = 0
+        for frame in self._kline.query_frames(start_timestamp, finish_timestamp, self._interval, standard=self._standard):
+            for candle in frame:
+                self.timestamp = candle["timestamp"]
+                if self._added:
+                    self._live.extend(self._added)
+                    self._added = []
+
+                done = False
+                for wake_timestamp, backtest in self._live:
+                    if wake_timestamp > self.timestamp:
+                        continue
+                    backtest.on_candle(candle)
+                    done = done or backtest.get("status") in ENGINE_DONE_STATUS
+                if done:
+                    self._live = [i for i in self._live if i[1].get("status") not in ENGINE_DONE_STATUS]
+                count += 1
+        self.candles += count
+        return count
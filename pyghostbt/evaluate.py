@@ -0,0 +1,225 @@
+import numpy as np
+
+from typing import List
+from jsonschema import validate
+from pyghostbt.tool.kline import Kline
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.tool.storage import connect
+from pyghostbt.util import real_number
+from pyghostbt.const import *
+
+equity_input = {
+    "type": "object",
+    "required": ["trade_type", "symbol", "exchange", "db_name", "backtest_id"],
+    "properties": {
+        "trade_type": {
+            "type": "string",
+            "enum": [
+                TRADE_TYPE_FUTURE,
+                TRADE_TYPE_SWAP,
+                TRADE_TYPE_MARGIN,
+                TRADE_TYPE_SPOT,
+            ],
+        },
+        "symbol": {
+            "type": "string",
+            "minLength": 1,
+        },
+        "exchange": {
+            "type": "string",
+        },
+        "db_name": {
+            "type": "string",
+            "minLength": 1,
+        },
+        "db_name_asset": {
+            "type": ["null", "string"],
+        },
+        "backtest_id": {
+            "type": "string",
+            "minLength": 32,
+            "maxLength": 32,
+        },
+        "settle_mode": {
+            "type": ["null", "integer"],
+            "enum": [None, SETTLE_MODE_BASIS, SETTLE_MODE_COUNTER],
+        },
+        "capital": {
+            "type": ["null", "number"],
+        },
+    }
+}
+
+
+def mark_to_market(
+        timestamps: np.ndarray,
+        close: np.ndarray,
+        orders: List[dict],
+        unit_amount: float,
+        settle_mode: int,
+        unrealized: np.ndarray,
+        realized_steps: np.ndarray,
+) -> None:
+    """Add the pnl of the orders of one instance at the close of every candle.
+
+    The deals are applied from the candle of their deal_timestamp. The open position of every contract
+    is marked at the close price as if it is liquidated there, with the same formula as
+    Strategy._settle_pnl. The pnl of the candles with open position is added to unrealized. The
+    constant pnl of the other candles, e.g. after all the contracts are liquidated, is added to
+    realized_steps as the differences, the cumulative sum of realized_steps is the realized pnl.
+    """
+    orders = sorted(
+        [o for o in orders if o["deal_amount"] and o["status"] != ORDER_STATUS_FAIL],
+        key=lambda o: o["deal_timestamp"],
+    )
+    if not orders:
+        return
+    unit_amount = unit_amount or 1.0
+    # 和结算时一样，unit_amount不是1时deal_amount是合约张数，否则是标准化的数量。
+    scale = 1.0 if unit_amount > 1.0 or unit_amount < 1.0 else 1.0 / 100000000
+    indexes = np.searchsorted(timestamps, [o["deal_timestamp"] for o in orders], side="left").tolist()
+    indexes.append(len(timestamps))
+
+    contracts = {}  # due_timestamp -> [open_amount, open_quota, liquidate_amount, liquidate_quota, side]
+    fee = 0.0
+    for k, order in enumerate(orders):
+        contract = contracts.setdefault(order.get("due_timestamp") or 0, [0, 0.0, 0, 0.0, 1])
+        quota = order["deal_amount"] * scale * real_number(order["avg_price"]) * unit_amount
+        if order["type"] == ORDER_TYPE_OPEN_LONG:
+            contract[0] += order["deal_amount"]
+            contract[1] -= quota
+            contract[4] = 1
+        elif order["type"] == ORDER_TYPE_OPEN_SHORT:
+            contract[0] += order["deal_amount"]
+            contract[1] += quota
+            contract[4] = -1
+        elif order["type"] == ORDER_TYPE_LIQUIDATE_LONG:
+            contract[2] += order["deal_amount"]
+            contract[3] += quota
+        elif order["type"] == ORDER_TYPE_LIQUIDATE_SHORT:
+            contract[2] += order["deal_amount"]
+            contract[3] -= quota
+        else:
+            raise RuntimeError("the order type is not right. ")
+        fee += float(order["fee"] or 0.0)  # MySQL中是decimal
+
+        lo, hi = indexes[k], indexes[k + 1]
+        if lo >= hi:
+            continue
+        pnl, holding = fee, False
+        for open_amount, open_quota, liquidate_amount, liquidate_quota, side in contracts.values():
+            if open_amount == 0:
+                continue
+            remaining = open_amount - liquidate_amount
+            if remaining != 0:
+                holding = True
+                liquidate_quota = liquidate_quota + side * remaining * scale * close[lo:hi] * unit_amount
+            contract_pnl = liquidate_quota + open_quota
+            if settle_mode == SETTLE_MODE_BASIS:
+                # 除以open_price和liquidate_price
+                contract_pnl = contract_pnl / abs(open_quota / open_amount / unit_amount)
+                contract_pnl = contract_pnl / np.abs(liquidate_quota / open_amount / unit_amount)
+            pnl = pnl + contract_pnl
+        if holding:
+            unrealized[lo:hi] += pnl
+        else:
+            realized_steps[lo] += pnl
+            if hi < len(realized_steps):
+                realized_steps[hi] -= pnl
+
+
+class EquityCurve(object):
+    """The mark-to-market equity of a backtest at the close of every candle.
+
+    The instances and their orders are loaded with two queries, then the equity of all the candles is
+    computed with numpy: the capital, plus the pnl of the instances whose contracts are all liquidated,
+    plus the pnl of the open positions marked at the close price. The equity is in the settle currency,
+    the coin of the symbol in SETTLE_MODE_BASIS and the quote currency in SETTLE_MODE_COUNTER.
+    """
+
+    def __init__(self, **kwargs):
+        validate(instance=kwargs, schema=equity_input)
+        self._trade_type = kwargs.get("trade_type")
+        self._symbol = kwargs.get("symbol")
+        self._exchange = kwargs.get("exchange")
+        self._db_name = kwargs.get("db_name")
+        self._db_name_asset = kwargs.get("db_name_asset") or self._db_name
+        self._backtest_id = kwargs.get("backtest_id")
+        self._settle_mode = kwargs.get("settle_mode") or SETTLE_MODE_BASIS
+        self._settle_currency = self._symbol.split("_")[self._settle_mode - 1]
+        self.capital = kwargs.get("capital")
+
+        self.instances = []
+        self.orders = {}  # instance id -> orders
+
+    def load(self) -> None:
+        conn = connect(self._db_name)
+        self.instances = conn.query(
+            "SELECT * FROM {}_instance_backtest WHERE backtest_id = ? AND symbol = ? AND exchange = ?"
+            " ORDER BY id".format(self._trade_type),
+            (self._backtest_id, self._symbol, self._exchange),
+        )
+        orders = conn.query(
+            "SELECT o.* FROM {trade_type}_order_backtest o JOIN {trade_type}_instance_backtest i"
+            " ON o.instance_id = i.id WHERE i.backtest_id = ? AND i.symbol = ? AND i.exchange = ?"
+            " ORDER BY o.instance_id, o.sequence".format(trade_type=self._trade_type),
+            (self._backtest_id, self._symbol, self._exchange),
+        )
+        self.orders = {}
+        for order in orders:
+            self.orders.setdefault(order["instance_id"], []).append(order)
+
+        if self.capital is None:
+            # 回测开始时注资以后的资产
+            one = connect(self._db_name_asset).query_one(
+                "SELECT asset_total FROM {}_asset_backtest WHERE exchange = ? AND settle_mode = ?"
+                " AND settle_currency = ? AND backtest_id = ? ORDER BY timestamp, id LIMIT 1".format(self._trade_type),
+                (self._exchange, self._settle_mode, self._settle_currency, self._backtest_id),
+            )
+            self.capital = float(one["asset_total"]) if one else 0.0
+
+    def build(self, frame: KlineFrame) -> dict:
+        """The equity curve at the close of the candles of the frame, as numpy arrays of the same length.
+
+        Returns:
+            timestamp, realized, unrealized, equity and drawdown, the drawdown is the ratio of the equity
+            to its running maximum minus 1.
+        """
+        timestamps = frame.timestamp
+        close = frame.close / 100000000 if frame.standard else frame.close.astype(np.float64)
+        unrealized = np.zeros(len(frame), dtype=np.float64)
+        realized_steps = np.zeros(len(frame), dtype=np.float64)
+        for instance in self.instances:
+            mark_to_market(
+                timestamps,
+                close,
+                self.orders.get(instance["id"], []),
+                float(instance.get("unit_amount") or 1.0),
+                self._settle_mode,
+                unrealized,
+                realized_steps,
+            )
+
+        realized = np.cumsum(realized_steps)
+        equity = (self.capital or 0.0) + realized + unrealized
+        peak = np.maximum.accumulate(equity) if len(equity) else equity
+        with np.errstate(divide="ignore", invalid="ignore"):
+            drawdown = np.where(peak > 0, equity / peak - 1, 0.0)
+        return {
+            "timestamp": timestamps,
+            "realized": realized,
+            "unrealized": unrealized,
+            "equity": equity,
+            "drawdown": drawdown,
+        }
+
+    def query(
+            self,
+            kline: Kline,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str = KLINE_INTERVAL_1MIN,
+    ) -> dict:
+        """Load the backtest and build the equity curve of the candles in [start_timestamp, finish_timestamp). """
+        self.load()
+        return self.build(kline.query_frame(start_timestamp, finish_timestamp, interval, standard=True))
@@ -0,0 +1,189 @@
+import numpy as np
+
+from typing import List
+from jsonschema import validate
+from concurrent.futures import ThreadPoolExecutor
+from pyghostbt.tool.asset import ASSET_FIGURES
+from pyghostbt.tool.storage import connect
+from pyghostbt.const import *
+
+portfolio_input = {
+    "type": "object",
+    "required": ["keys", "mode", "db_name"],
+    "properties": {
+        "keys": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["trade_type", "symbol", "exchange"],
+                "properties": {
+                    "trade_type": {
+                        "type": "string",
+                        "enum": [
+                            TRADE_TYPE_FUTURE,
+                            TRADE_TYPE_SWAP,
+                            TRADE_TYPE_MARGIN,
+                            TRADE_TYPE_SPOT,
+                        ],
+                    },
+                    "symbol": {
+                        "type": "string",
+                        "minLength": 1,
+                    },
+                    "exchange": {
+                        "type": "string",
+                    },
+                    "settle_mode": {
+                        "type": ["null", "integer"],
+                        "enum": [None, SETTLE_MODE_BASIS, SETTLE_MODE_COUNTER],
+                    },
+                },
+            },
+        },
+        "mode": {
+            "type": "string",
+            "enum": [
+                MODE_ONLINE,
+                MODE_OFFLINE,
+                MODE_BACKTEST,
+                MODE_STRATEGY,
+            ],
+        },
+        "db_name": {
+            "type": "string",
+            "minLength": 1,
+        },
+        "db_name_asset": {
+            "type": ["null", "string"],
+        },
+        "backtest_id": {
+            "type": ["string", "null"],
+            "minLength": 32,
+            "maxLength": 32,
+        },
+        "max_workers": {
+            "type": ["null", "integer"],
+            "minimum": 1,
+        },
+    }
+}
+
+
+def align(timestamps: np.ndarray, key_timestamps: np.ndarray, values: np.ndarray, fill: float = np.nan) -> np.ndarray:
+    """The values as of every timestamp, i.e. the last value not after it, the fill if there is none. """
+    i = np.searchsorted(key_timestamps, timestamps, side="right") - 1
+    aligned = np.full(len(timestamps), fill, dtype=np.float64)
+    aligned[i >= 0] = values[i[i >= 0]]
+    return aligned
+
+
+class PortfolioAsset(object):
+    """The asset records of many (symbol, exchange, settle_currency) keys on one time axis.
+
+    The asset records are kept per settle currency account, not per symbol, so the symbols sharing the
+    trade_type, exchange, settle_mode and settle_currency are merged into one key with their symbols,
+    e.g. btc_usdt and eth_usdt in counter mode. The records of every key are loaded concurrently on a
+    thread pool, each key with its own connection. The records are aligned on the union of their
+    timestamps, every key carries its last record forward, so the positions of all the keys can be
+    summed as the combined exposure.
+    """
+
+    def __init__(self, **kwargs):
+        validate(instance=kwargs, schema=portfolio_input)
+        self._mode = kwargs.get("mode")
+        self._db_name = kwargs.get("db_name_asset") or kwargs.get("db_name")
+        self._backtest_id = kwargs.get("backtest_id")
+        self._max_workers = kwargs.get("max_workers")
+        if self._mode == MODE_BACKTEST and not self._backtest_id:
+            raise RuntimeError("the backtest_id is required in backtest mode. ")
+
+        self.keys = []
+        for key in kwargs.get("keys"):
+            settle_mode = key.get("settle_mode") or SETTLE_MODE_BASIS
+            asset_key = {
+                "trade_type": key["trade_type"],
+                "exchange": key["exchange"],
+                "settle_mode": settle_mode,
+                "settle_currency": key["symbol"].split("_")[settle_mode - 1],
+            }
+            # 同一个结算账户的资产记录只加载和合计一次
+            same = [k for k in self.keys if all(k[field] == value for field, value in asset_key.items())]
+            if same:
+                if key["symbol"] not in same[0]["symbols"]:
+                    same[0]["symbols"].append(key["symbol"])
+                continue
+            asset_key["symbols"] = [key["symbol"]]
+            self.keys.append(asset_key)
+        self.records = []  # 每个key的 (timestamps, {figure: values})
+
+    def __load_key(self, key: dict, start_timestamp: int, finish_timestamp: int) -> tuple:
+        table_name = "{trade_type}_asset_{mode}".format(
+            trade_type=key["trade_type"],
+            mode=self._mode if self._mode == MODE_BACKTEST else "strategy",
+        )
+        condition = "exchange = ? AND settle_mode = ? AND settle_currency = ?"
+        params = (key["exchange"], key["settle_mode"], key["settle_currency"])
+        if self._mode == MODE_BACKTEST:
+            condition += " AND backtest_id = ?"
+            params += (self._backtest_id,)
+
+        conn = connect(self._db_name)
+        # 开始时间的资产是它之前的最后一条记录
+        first = conn.query(
+            "SELECT timestamp, {} FROM {} WHERE {} AND timestamp < ? ORDER BY timestamp DESC, id DESC"
+            " LIMIT 1".format(", ".join(ASSET_FIGURES), table_name, condition),
+            params + (start_timestamp,),
+        )
+        rows = first + conn.query(
+            "SELECT timestamp, {} FROM {} WHERE {} AND timestamp >= ? AND timestamp < ?"
+            " ORDER BY timestamp, id".format(", ".join(ASSET_FIGURES), table_name, condition),
+            params + (start_timestamp, finish_timestamp),
+        )
+        timestamps = np.array([int(row["timestamp"]) for row in rows], dtype=np.int64)
+        values = {
+            figure: np.array([np.nan if row[figure] is None else float(row[figure]) for row in rows], dtype=np.float64)
+            for figure in ASSET_FIGURES
+        }
+        return timestamps, values
+
+    def load(self, start_timestamp: int, finish_timestamp: int) -> None:
+        """Load the records of all the keys in [start_timestamp, finish_timestamp) concurrently. """
+        with ThreadPoolExecutor(max_workers=self._max_workers or min(len(self.keys), 8)) as executor:
+            futures = [
+                executor.submit(self.__load_key, key, start_timestamp, finish_timestamp)
+                for key in self.keys
+            ]
+            self.records = [future.result() for future in futures]
+
+    def series(self, start_timestamp: int, finish_timestamp: int) -> dict:
+        """The aligned series of the keys in [start_timestamp, finish_timestamp).
+
+        Returns:
+            timestamp: the start_timestamp and all the record timestamps of the keys.
+            keys: the settle currency keys with their symbols, in the order of the rows of the figure matrices.
+            asset_total ... position_freeze: one row per key, nan before the first record of the key.
+            exposure: the sum of position_freeze of all the keys.
+        """
+        self.load(start_timestamp, finish_timestamp)
+        timestamps = np.unique(np.concatenate(
+            [np.array([start_timestamp], dtype=np.int64)] + [t for t, _ in self.records]
+        ))
+        timestamps = timestamps[(timestamps >= start_timestamp) & (timestamps < finish_timestamp)]
+
+        result = {"timestamp": timestamps, "keys": self.keys}
+        for figure in ASSET_FIGURES:
+            result[figure] = np.array(
+                [align(timestamps, t, values[figure]) for t, values in self.records],
+                dtype=np.float64,
+            ).reshape(len(self.keys), len(timestamps))
+        # 没有记录时没有占用仓位
+        result["exposure"] = np.nansum(result["position_freeze"], axis=0)
+        return result
+
+    def exposure(self, timestamp: int) -> List[float]:
+        """The position_freeze of every key as of the timestamp, the records must be loaded. """
+        return [
+            float(np.nan_to_num(align(np.array([timestamp]), t, values["position_freeze"], fill=0.0)[0]))
+            for t, values in self.records
+        ]
@@ -2,7 +2,7 @@ from typing import List
 from typing import Tuple
 from jsonschema import validate
 
-from pyanalysis.mysql import Conn
+from pyghostbt.tool.storage import connect
 from pyanalysis.moment import moment
 from pyghostbt.tool.runtime import Runtime
 from pyghostbt.tool.asset import Asset
@@ -60,7 +60,7 @@ class Strategy(Runtime):
 
         instance_id = kw.get("id")
         if instance_id is not None:
-            conn = Conn(self["db_name"])
+            conn = connect(self["db_name"])
             instance = conn.query_one(
                 "SELECT * FROM {trade_type}_instance_{mode} WHERE id = ?".format(
                     trade_type=self["trade_type"],
@@ -85,7 +85,7 @@ class Strategy(Runtime):
 
     # 获取instance 风险等级。 timestamp要设置为interval的起始时间。
     def _get_risk_level(self, timestamp: int, instance_id: int) -> int:
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         table_name = "{trade_type}_instance_{mode}".format(
             trade_type=self["trade_type"],
             mode=MODE_BACKTEST if self["mode"] == MODE_BACKTEST else MODE_STRATEGY,
@@ -149,7 +149,7 @@ class Strategy(Runtime):
                 self["strategy"], INSTANCE_STATUS_WAITING, 0,
             )
 
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         one = conn.query_one(
             query_sql.format(trade_type=self["trade_type"]),
             params,
@@ -157,7 +157,7 @@ class Strategy(Runtime):
         return one["id"] if one else 0
 
     def _is_opened(self, wait_start_timestamp: int) -> bool:
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         if self["trade_type"] == TRADE_TYPE_FUTURE:
             opened = conn.query(
                 "SELECT id FROM future_instance_{mode} WHERE symbol = ? AND exchange = ? AND contract_type = ?"
@@ -263,7 +263,7 @@ class Strategy(Runtime):
         )
 
     def load_from_db(self, instance_id):
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         tmp_instance = conn.query_one(
             "SELECT * FROM {trade_type}_instance_{mode} WHERE id = ?".format(
                 trade_type=self["trade_type"],
@@ -323,7 +323,7 @@ class Strategy(Runtime):
         self["indices"] = indices
 
     def _get_orders(self) -> List:
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         orders = conn.query(
             "SELECT * FROM {trade_type}_order_{mode} WHERE instance_id = ?"
             " ORDER BY sequence".format(
@@ -556,7 +556,7 @@ class Strategy(Runtime):
         if finish_timestamp == 0:
             finish_timestamp = moment.now().millisecond_timestamp
 
-        conn = Conn(self["db_name"])
+        conn = connect(self["db_name"])
         table_name = "{trade_type}_instance_{mode}".format(
             trade_type=self["trade_type"],
             mode=MODE_BACKTEST if self["mode"] == MODE_BACKTEST else MODE_STRATEGY,
@@ -0,0 +1,183 @@
+import copy
+import shutil
+import tempfile
+import itertools
+
+from typing import List
+from jsonschema import validate
+from concurrent.futures import ProcessPoolExecutor
+from pyghostbt.tool.kline import Kline
+from pyghostbt.tool.shared import SharedKline
+from pyghostbt.tool.asset import drop_ledgers
+from pyghostbt.util import uuid
+from pyghostbt.const import *
+
+sweep_input = {
+    "type": "object",
+    "required": ["start_timestamp", "finish_timestamp"],
+    "properties": {
+        "start_timestamp": {
+            "type": "integer",
+        },
+        "finish_timestamp": {
+            "type": "integer",
+        },
+        "kline_start_timestamp": {
+            "type": ["null", "integer"],
+        },
+        "intervals": {
+            "type": ["null", "array"],
+            "items": {
+                "type": "string",
+            },
+        },
+        "contracts": {
+            "type": ["null", "boolean"],
+        },
+        "kline_dir": {
+            "type": ["null", "string"],
+        },
+        "shared_memory": {
+            "type": ["null", "boolean"],
+        },
+        "max_workers": {
+            "type": ["null", "integer"],
+            "minimum": 1,
+        },
+    }
+}
+
+
+def param_grid(grid: dict) -> List[dict]:
+    """All the combinations of the param values, {"position": [0.5, 1.0]} -> [{"position": 0.5}, {"position": 1.0}]. """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def _run_backtest(backtest_class, config: dict, start_timestamp: int, finish_timestamp: int) -> dict:
+    try:
+        backtest = backtest_class(config)
+        with backtest.memory_scope():
+            backtest.run(start_timestamp, finish_timestamp)
+        backtest.finish()
+        return backtest.summary(finish_timestamp)
+    finally:
+        # 进程池中的进程会运行多次回测，释放这次回测的账本。
+        drop_ledgers(config["backtest_id"])
+
+
+class Sweep(object):
+    """Run a Backtest subclass once per combination of the param grid on a process pool.
+
+    The candles are exported once into the offline kline files before the runs, every run reads them
+    through kline_offline_dir instead of MySQL. With shared_memory, the candles are copied once into
+    the shared memory segments instead, every run attaches to them through kline_shared, so all the
+    workers hold one copy of the candles. The backtest class must be defined at the module level
+    and implement run(start_timestamp, finish_timestamp), so the worker processes can import it.
+    """
+
+    def __init__(self, backtest_class, config: dict, grid: dict, **kwargs):
+        validate(instance=kwargs, schema=sweep_input)
+        self._backtest_class = backtest_class
+        self._config = config
+        self._grid = grid
+
+        self.start_timestamp = kwargs.get("start_timestamp")
+        self.finish_timestamp = kwargs.get("finish_timestamp")
+        # 策略计算指标时可能需要更早的蜡烛。
+        self.kline_start_timestamp = kwargs.get("kline_start_timestamp") or self.start_timestamp
+        self.intervals = kwargs.get("intervals") or [KLINE_INTERVAL_1MIN, KLINE_INTERVAL_1DAY]
+        self.contracts = kwargs.get("contracts") or False
+        self.kline_dir = kwargs.get("kline_dir") or config.get("kline_offline_dir")
+        self.shared_memory = kwargs.get("shared_memory") or False
+        self.max_workers = kwargs.get("max_workers")
+        self._segments = []
+        self._temp_dir = None  # preload创建的临时目录
+
+    def preload(self) -> dict:
+        """Load the candles of the sweep range once, return the kline config of the runs. """
+        if self._config.get("kline_offline_dir") or self._config.get("kline_shared"):
+            return {
+                "kline_offline_dir": self._config.get("kline_offline_dir"),
+                "kline_shared": self._config.get("kline_shared"),
+            }
+
+        kline = Kline(
+            trade_type=self._config.get("trade_type"),
+            symbol=self._config.get("symbol"),
+            exchange=self._config.get("exchange"),
+            contract_type=self._config.get("contract_type"),
+            db_name=self._config.get("db_name_kline") or self._config.get("db_name"),
+            page_size=self._config.get("kline_page_size"),
+            cache_dir=self._config.get("kline_cache_dir"),
+        )
+        ranges = [(interval, False) for interval in self.intervals]
+        if self.contracts:
+            ranges.append((KLINE_INTERVAL_1MIN, True))
+
+        if self.shared_memory:
+            for interval, contracts in ranges:
+                records = kline.query_records(self.kline_start_timestamp, self.finish_timestamp, interval, contracts)
+                self._segments.append(SharedKline.create(records, **kline.records_meta(
+                    self.kline_start_timestamp,
+                    self.finish_timestamp,
+                    interval,
+                    contracts,
+                )))
+            return {"kline_shared": [segment.spec for segment in self._segments]}
+
+        if self.kline_dir is None:
+            self._temp_dir = self.kline_dir = tempfile.mkdtemp(prefix="pyghostbt_sweep_")
+        for interval, contracts in ranges:
+            kline.export(self.kline_dir, self.kline_start_timestamp, self.finish_timestamp, interval, contracts)
+        return {"kline_offline_dir": self.kline_dir}
+
+    def close(self) -> None:
+        """Remove the shared memory segments and the temporary kline directory created by preload. """
+        for segment in self._segments:
+            segment.unlink()
+        self._segments = []
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = self.kline_dir = None
+
+    def configs(self) -> List[dict]:
+        """The config of every run, each with its own backtest_id. """
+        kline_config = self.preload()
+        configs, backtest_ids = [], set()
+        for params in param_grid(self._grid):
+            config = copy.deepcopy(self._config)
+            config["param"] = dict(config.get("param") or {}, **params)
+            config.update(kline_config)
+            # 多个进程中同时生成的uuid可能重复，统一在这里生成。
+            backtest_id = uuid()
+            while backtest_id in backtest_ids:
+                backtest_id = uuid()
+            backtest_ids.add(backtest_id)
+            config["backtest_id"] = backtest_id
+            configs.append(config)
+        return configs
+
+    def run(self) -> List[dict]:
+        """Run all the combinations, return the summary of every run in the order of the grid.
+
+        The failed run has an error instead of the summary metrics, the other runs are not affected.
+        """
+        configs = self.configs()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    executor.submit(_run_backtest, self._backtest_class, c, self.start_timestamp, self.finish_timestamp)
+                    for c in configs
+                ]
+                results = []
+                for config, future in zip(configs, futures):
+                    result = {"backtest_id": config["backtest_id"], "param": config["param"]}
+                    try:
+                        result.update(future.result())
+                    except Exception as e:
+                        result["error"] = repr(e)
+                    results.append(result)
+        finally:
+            self.close()
+        return results
@@ -1,8 +1,12 @@
+import bisect
+import threading
+
 from jsonschema import validate
 from pyghostbt.const import *
 from pyghostbt.util import standard_number
 from pyghostbt.util import real_number
-from pyanalysis.mysql import Conn
+from pyghostbt.tool.storage import connect
+from pyghostbt.tool.storage import upsert
 from pyanalysis.moment import moment
 
 asset_input = {
@@ -101,6 +105,161 @@ account_flow_input = {
 }
 
 
+# 计算资产时各部分包含的流水科目
+LEDGER_SUBJECTS = {
+    "total": (SUBJECT_INVEST, SUBJECT_DIVEST, SUBJECT_SETTLE),
+    "freeze": (SUBJECT_FREEZE, SUBJECT_UNFREEZE),
+    "sub": (SUBJECT_TRANSFER_IN, SUBJECT_TRANSFER_OUT, SUBJECT_SETTLE),
+}
+
+# 资产记录中的数值
+ASSET_FIGURES = ("asset_total", "asset_sub", "asset_freeze", "position_total", "position_sub", "position_freeze")
+
+_ledgers = {}
+_snapshots = {}
+_ledgers_lock = threading.Lock()
+
+
+def _real_amount(amount):
+    # 保留流水的全部精度，MySQL中的 SUM(amount)/100000000 只保留4位小数。
+    return None if amount is None else int(amount) / 100000000
+
+
+def _add_sums(sums: dict, subject: str, amount: int, position: float, count: int = 1) -> None:
+    for part, subjects in LEDGER_SUBJECTS.items():
+        if subject in subjects:
+            part_sums = sums[part]
+            part_sums[0] += amount
+            part_sums[1] += position
+            part_sums[2] += count
+
+
+def _figures(sums: dict) -> dict:
+    """The asset figures of the sums, the same as the SUM queries of the account flows. """
+    total, freeze, sub = sums["total"], sums["freeze"], sums["sub"]
+    return {
+        "position_total": (total[1] if total[2] else None) or 20,
+        "asset_total": (_real_amount(total[0]) if total[2] else None) or 0.0,
+        "position_freeze": -((freeze[1] if freeze[2] else None) or 0.0),
+        "asset_freeze": -((_real_amount(freeze[0]) if freeze[2] else None) or 0.0),
+        "position_sub": sub[1] if sub[2] else None,
+        "asset_sub": _real_amount(sub[0]) if sub[2] else None,
+    }
+
+
+class AssetLedger(object):
+    """The running sums of the account flows of one (exchange, settle_mode, settle_currency, backtest_id).
+
+    The sums of every part are loaded with one query when the ledger is created, then every new flow
+    is added as a delta. The ledger is shared by all the Asset objects of the same key in the process.
+
+    Every __CHECKPOINT_FLOWS__ flows, the sums are kept as a checkpoint at the latest flow timestamp,
+    the sums as of an earlier timestamp only need the flows after the checkpoint before it.
+    """
+    __CHECKPOINT_FLOWS__ = 200
+
+    def __init__(self, conn, table_name: str, exchange: str, settle_mode: int, settle_currency: str, backtest_id: str):
+        self.timestamp = 0  # 最晚的流水时间
+        self.sums = {part: [0, 0.0, 0] for part in LEDGER_SUBJECTS}  # amount, position, count
+        self._checkpoint_timestamps = []
+        self._checkpoint_sums = []
+        self._added = 0  # 上一个检查点之后的流水数量
+        rows = conn.query(
+            "SELECT subject, SUM(amount) AS amount, SUM(position) AS position, COUNT(*) AS count,"
+            " MAX(timestamp) AS timestamp FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ?"
+            " AND backtest_id = ? GROUP BY subject".format(table_name),
+            (exchange, settle_mode, settle_currency, backtest_id),
+        )
+        for row in rows:
+            _add_sums(self.sums, row["subject"], int(row["amount"]), float(row["position"]), int(row["count"]))
+            self.timestamp = max(self.timestamp, int(row["timestamp"]))
+        if rows:
+            self.__take_checkpoint()
+
+    def __take_checkpoint(self) -> None:
+        sums = {part: list(part_sums) for part, part_sums in self.sums.items()}
+        if self._checkpoint_timestamps and self._checkpoint_timestamps[-1] == self.timestamp:
+            self._checkpoint_sums[-1] = sums
+        else:
+            self._checkpoint_timestamps.append(self.timestamp)
+            self._checkpoint_sums.append(sums)
+        self._added = 0
+
+    def add(self, subject: str, amount: int, position: float, timestamp: int) -> None:
+        _add_sums(self.sums, subject, amount, position)
+        # 早于检查点的流水也计入之后的检查点
+        for i in range(bisect.bisect_left(self._checkpoint_timestamps, timestamp), len(self._checkpoint_sums)):
+            _add_sums(self._checkpoint_sums[i], subject, amount, position)
+        self.timestamp = max(self.timestamp, timestamp)
+        self._added += 1
+        if self._added >= self.__CHECKPOINT_FLOWS__:
+            self.__take_checkpoint()
+
+    def checkpoint(self, timestamp: int) -> tuple:
+        """The latest checkpoint not after the timestamp, (0, the zero sums) if there is none. """
+        i = bisect.bisect_right(self._checkpoint_timestamps, timestamp)
+        if i == 0:
+            return 0, {part: [0, 0.0, 0] for part in LEDGER_SUBJECTS}
+        return self._checkpoint_timestamps[i - 1], {part: list(s) for part, s in self._checkpoint_sums[i - 1].items()}
+
+    def figures(self) -> dict:
+        return _figures(self.sums)
+
+
+class AssetSnapshots(object):
+    """The asset records of one (exchange, settle_mode, settle_currency, backtest_id) sorted by timestamp.
+
+    The records are loaded with one query, then Asset.load() finds the record as of a timestamp with
+    bisect. The records written by Asset are updated in place, so the loads of a backtest do not
+    query the database again.
+    """
+
+    def __init__(self, conn, table_name: str, exchange: str, settle_mode: int, settle_currency: str, backtest_id: str):
+        rows = conn.query(
+            "SELECT timestamp, {} FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ?"
+            " AND backtest_id = ? ORDER BY timestamp, id".format(", ".join(ASSET_FIGURES), table_name),
+            (exchange, settle_mode, settle_currency, backtest_id),
+        )
+        self.timestamps = [int(row["timestamp"]) for row in rows]
+        self.records = [{key: row[key] for key in ASSET_FIGURES} for row in rows]
+
+    def get(self, timestamp: int):
+        """The last record not after the timestamp, None if there is none. """
+        i = bisect.bisect_right(self.timestamps, timestamp)
+        return self.records[i - 1] if i else None
+
+    def put(self, timestamp: int, figures: dict) -> None:
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        record = {key: figures[key] for key in ASSET_FIGURES}
+        if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+            self.records[i] = record
+        else:
+            self.timestamps.insert(i, timestamp)
+            self.records.insert(i, record)
+
+    def shift(self, timestamp: int, deltas: dict) -> None:
+        """Add the deltas of the flows to the records after the timestamp, the same as the bulk UPDATE. """
+        for record in self.records[bisect.bisect_right(self.timestamps, timestamp):]:
+            if "total" in deltas:
+                record["asset_total"] += _real_amount(deltas["total"][0])
+                record["position_total"] += deltas["total"][1]
+            if "freeze" in deltas:
+                record["asset_freeze"] -= _real_amount(deltas["freeze"][0])
+                record["position_freeze"] -= deltas["freeze"][1]
+            if "sub" in deltas:
+                record["asset_sub"] = (record["asset_sub"] or 0) + _real_amount(deltas["sub"][0])
+                record["position_sub"] = (record["position_sub"] or 0) + deltas["sub"][1]
+
+
+def drop_ledgers(backtest_id: str) -> None:
+    """Forget the ledgers and the asset snapshots of the backtest, e.g. after its rows are deleted. """
+    with _ledgers_lock:
+        for key in [k for k in _ledgers if k[-1] == backtest_id]:
+            del _ledgers[key]
+        for key in [k for k in _snapshots if k[-1] == backtest_id]:
+            del _snapshots[key]
+
+
 class Asset(dict):
     __ASSET_TABLE_NAME_FORMAT__ = "{trade_type}_asset_{mode}"
     __ACCOUNT_FLOW_TABLE_NAME_FORMAT__ = "{trade_type}_account_flow_{mode}"
@@ -118,6 +277,7 @@ class Asset(dict):
         self._settle_currency = self._symbol.split("_")[self._settle_mode - 1]
 
         self._db_name = kwargs.get("db_name_asset") or kwargs.get("db_name")
+        self._flows = []  # 写入了流水，还没有更新资产的流水
         self._asset_table_name = self.__ASSET_TABLE_NAME_FORMAT__.format(
             trade_type=self._trade_type,
             mode=self._mode if self._mode == MODE_BACKTEST else "strategy",
@@ -142,7 +302,7 @@ class Asset(dict):
         if self._mode != MODE_BACKTEST:
             raise RuntimeError("Only backtest mode can insert data into table. ")
         validate(instance=kwargs, schema=account_flow_input)
-        conn = Conn(self._db_name)
+        conn = connect(self._db_name)
         item = conn.query_one(
             """SELECT * FROM {} WHERE symbol = ? AND exchange = ? AND settle_mode = ? AND settle_currency = ?
              AND subject = ? AND timestamp = ? AND backtest_id = ?""".format(self._account_flow_table_name),
@@ -151,16 +311,43 @@ class Asset(dict):
                 kwargs.get("subject"), kwargs.get("timestamp"), self._backtest_id,
             ),
         )
-        conn.insert(
-            """INSERT INTO {} (symbol, exchange, settle_mode, settle_currency, backtest_id, 
-            subject, amount, position, timestamp, datetime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """.format(self._account_flow_table_name),
-            (
-                self._symbol, self._exchange, self._settle_mode, self._settle_currency, self._backtest_id,
-                kwargs.get("subject"), kwargs.get("amount"), kwargs.get("position"),
-                kwargs.get("timestamp") + 1 if item else kwargs.get("timestamp"), kwargs.get("datetime"),
-            ),
+        # 先加载账本，再写入新的流水
+        self.__ledger()
+        flow = {
+            "symbol": self._symbol,
+            "exchange": self._exchange,
+            "settle_mode": self._settle_mode,
+            "settle_currency": self._settle_currency,
+            "backtest_id": self._backtest_id,
+            "subject": kwargs.get("subject"),
+            "amount": kwargs.get("amount"),
+            "position": kwargs.get("position"),
+            "timestamp": kwargs.get("timestamp") + 1 if item else kwargs.get("timestamp"),
+            "datetime": kwargs.get("datetime"),
+        }
+        upsert(self._db_name, self._account_flow_table_name, [flow])
+        self._flows.append(flow)
+
+    def __snapshots(self, create: bool = True):
+        key = (
+            self._db_name, self._asset_table_name,
+            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id,
         )
+        with _ledgers_lock:
+            # 还没有加载时不需要更新，之后加载时从数据库中读取
+            if key not in _snapshots and create:
+                _snapshots[key] = AssetSnapshots(connect(self._db_name), *key[1:])
+            return _snapshots.get(key)
+
+    def __ledger(self) -> AssetLedger:
+        key = (
+            self._db_name, self._account_flow_table_name,
+            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id,
+        )
+        with _ledgers_lock:
+            if key not in _ledgers:
+                _ledgers[key] = AssetLedger(connect(self._db_name), *key[1:])
+            return _ledgers[key]
 
     def __invest(self, amount: int, position: float, timestamp: int, datetime: str):
         if amount <= 0 or position < 0.0:
@@ -229,112 +416,98 @@ class Asset(dict):
         )
 
     def __insert_asset_item(self, timestamp, datetime):
-        position_total, asset_total = self.__calculate_total(timestamp)
-        position_freeze, asset_freeze = self.__calculate_freeze(timestamp)
-        position_sub, asset_sub = self.__calculate_sub(timestamp)
-
-        conn = Conn(self._db_name)
-        one = conn.query_one(
-            """SELECT * FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? 
-            AND timestamp = ? AND backtest_id = ?""".format(self._asset_table_name),
-            (self._exchange, self._settle_mode, self._settle_currency, timestamp, self._backtest_id)
-        )
-        if one:
-            conn.execute(
-                """
-                UPDATE {} SET asset_total = ?, asset_sub = ?, asset_freeze = ?, 
-                position_total = ?, position_sub = ?, position_freeze = ? WHERE id = ? 
-                """.format(self._asset_table_name),
-                (
-                    asset_total,
-                    asset_sub,
-                    asset_freeze,
-                    position_total,
-                    position_sub,
-                    position_freeze,
-                    one["id"],
-                ),
-            )
+        ledger = self.__ledger()
+        flows, self._flows = self._flows, []
+        # 之前的流水都不晚于这个时间时，这个时间之后没有资产记录，账本的累计值就是这个时间的资产。
+        in_order = timestamp >= ledger.timestamp
+        for flow in flows:
+            if flow["timestamp"] <= timestamp:
+                ledger.add(flow["subject"], flow["amount"], flow["position"], flow["timestamp"])
+        if in_order:
+            figures = ledger.figures()
         else:
-            conn.insert(
-                """
-                INSERT INTO {} (exchange, settle_mode, settle_currency, backtest_id, 
-                asset_total, asset_sub, asset_freeze, 
-                position_total, position_sub, position_freeze,
-                timestamp, datetime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """.format(self._asset_table_name),
-                (
-                    self._exchange,
-                    self._settle_mode,
-                    self._settle_currency,
-                    self._backtest_id,
-                    asset_total,
-                    asset_sub,
-                    asset_freeze,
-                    position_total,
-                    position_sub,
-                    position_freeze,
-                    timestamp,
-                    datetime,
-                ),
-            )
+            figures = self.__calculate(timestamp)
+        # 同一时间重复的科目记在下一毫秒，不计入这个时间的资产
+        for flow in flows:
+            if flow["timestamp"] > timestamp:
+                ledger.add(flow["subject"], flow["amount"], flow["position"], flow["timestamp"])
+
+        upsert(self._db_name, self._asset_table_name, [dict(
+            figures,
+            exchange=self._exchange,
+            settle_mode=self._settle_mode,
+            settle_currency=self._settle_currency,
+            backtest_id=self._backtest_id,
+            timestamp=timestamp,
+            datetime=datetime,
+        )], unique_key=("exchange", "settle_mode", "settle_currency", "timestamp", "backtest_id"))
+        snapshots = self.__snapshots(create=False)
+        if snapshots is not None:
+            snapshots.put(timestamp, figures)
+        if not in_order:
+            self.__shift_later_assets(timestamp, flows)
+
+    def __shift_later_assets(self, timestamp: int, flows: list) -> None:
+        """Add the new flows to all the asset records after the timestamp with one UPDATE. """
+        deltas = {}
+        for flow in flows:
+            for part, subjects in LEDGER_SUBJECTS.items():
+                if flow["subject"] in subjects:
+                    amount, position = deltas.get(part, (0, 0.0))
+                    deltas[part] = (amount + flow["amount"], position + flow["position"])
+
+        columns, params = [], []
+        if "total" in deltas:
+            columns += ["asset_total = asset_total + ?", "position_total = position_total + ?"]
+            params += [_real_amount(deltas["total"][0]), deltas["total"][1]]
+        if "freeze" in deltas:
+            columns += ["asset_freeze = asset_freeze - ?", "position_freeze = position_freeze - ?"]
+            params += [_real_amount(deltas["freeze"][0]), deltas["freeze"][1]]
+        if "sub" in deltas:
+            columns += ["asset_sub = COALESCE(asset_sub, 0) + ?", "position_sub = COALESCE(position_sub, 0) + ?"]
+            params += [_real_amount(deltas["sub"][0]), deltas["sub"][1]]
+        if not columns:
+            return
 
-        one = conn.query_one(
-            """SELECT * FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? 
-            AND timestamp > ? AND backtest_id = ? ORDER BY timestamp LIMIT 1""".format(self._asset_table_name),
-            (self._exchange, self._settle_mode, self._settle_currency, timestamp, self._backtest_id)
+        conn = connect(self._db_name)
+        conn.execute(
+            "UPDATE {} SET {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? AND timestamp > ?"
+            " AND backtest_id = ?".format(self._asset_table_name, ", ".join(columns)),
+            tuple(params) + (self._exchange, self._settle_mode, self._settle_currency, timestamp, self._backtest_id),
         )
-        if one:
-            self.__insert_asset_item(one["timestamp"], one["datetime"])
+        snapshots = self.__snapshots(create=False)
+        if snapshots is not None:
+            snapshots.shift(timestamp, deltas)
 
-    # calculate the total position and total asset
-    def __calculate_total(self, timestamp: int) -> (float, float):
-        query_sql = """
-        SELECT SUM(position) AS position, SUM(amount)/100000000 AS amount FROM {} WHERE exchange = ?
-         AND settle_mode = ? AND settle_currency = ? AND backtest_id = ? AND timestamp <= ?
-         AND subject IN (?, ?, ?)""".format(self._account_flow_table_name)
-        query_param = (
-            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id,
-            timestamp, SUBJECT_INVEST, SUBJECT_DIVEST, SUBJECT_SETTLE,
-        )
-        conn = Conn(self._db_name)
-        result = conn.query_one(query_sql, query_param)
-        position_total = result.get("position") or 20
-        asset_total = result.get("amount") or 0.0
-        return position_total, asset_total
-
-    # calculate the freeze position and freeze asset
-    def __calculate_freeze(self, timestamp: int) -> (float, float):
-        query_sql = """
-            SELECT SUM(amount)/100000000 AS asset_freeze, SUM(position) AS position_freeze FROM {} 
-            WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? AND backtest_id = ? 
-            AND timestamp <= ? AND subject IN (?, ?)
-        """.format(self._account_flow_table_name)
-        query_param = (
-            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id, timestamp,
-            SUBJECT_FREEZE, SUBJECT_UNFREEZE,
-        )
-        conn = Conn(self._db_name)
-        result = conn.query_one(query_sql, query_param)
-        position_freeze = -(result.get("position_freeze") or 0.0)
-        asset_freeze = -(result.get("asset_freeze") or 0.0)
-        return position_freeze, asset_freeze
-
-    # calculate the sub position and sub asset
-    def __calculate_sub(self, timestamp: int) -> (float, float):
+    def __calculate(self, timestamp: int) -> dict:
+        """Calculate the total, freeze and sub figures as of the timestamp with one grouped query.
+
+        The flows are summed from the latest ledger checkpoint not after the timestamp.
+        """
+        since, sums = self.__ledger().checkpoint(timestamp)
+        columns, params = [], []
+        for part, subjects in LEDGER_SUBJECTS.items():
+            condition = "subject IN ({})".format(", ".join(["?"] * len(subjects)))
+            columns += [
+                "SUM(CASE WHEN {} THEN amount ELSE 0 END) AS {}_amount".format(condition, part),
+                "SUM(CASE WHEN {} THEN position ELSE 0 END) AS {}_position".format(condition, part),
+                "SUM(CASE WHEN {} THEN 1 ELSE 0 END) AS {}_count".format(condition, part),
+            ]
+            params += list(subjects) * 3
         query_sql = """
-            SELECT SUM(amount)/100000000 AS asset_sub, SUM(position) AS position_sub FROM {} 
-            WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? AND backtest_id = ?
-            AND timestamp <= ? AND subject IN (?, ?, ?)
-        """.format(self._account_flow_table_name)
-        query_param = (
-            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id,
-            timestamp, SUBJECT_TRANSFER_IN, SUBJECT_TRANSFER_OUT, SUBJECT_SETTLE,
+            SELECT {} FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? AND backtest_id = ?
+            AND timestamp > ? AND timestamp <= ?
+        """.format(", ".join(columns), self._account_flow_table_name)
+        query_param = tuple(params) + (
+            self._exchange, self._settle_mode, self._settle_currency, self._backtest_id, since, timestamp,
         )
-        conn = Conn(self._db_name)
-        result = conn.query_one(query_sql, query_param)
-        position_sub, asset_sub = result["position_sub"], result["asset_sub"]
-        return position_sub, asset_sub
+        conn = connect(self._db_name)
+        result = conn.query_one(query_sql, query_param) or {}
+        for part, part_sums in sums.items():
+            part_sums[0] += int(result.get(part + "_amount") or 0)
+            part_sums[1] += float(result.get(part + "_position") or 0.0)
+            part_sums[2] += int(result.get(part + "_count") or 0)
+        return _figures(sums)
 
     # 回测是初始化账户，主要是注资，设置总position
     def first_invest(
@@ -355,7 +528,7 @@ class Asset(dict):
             self._backtest_id,
         )
 
-        conn = Conn(self._db_name)
+        conn = connect(self._db_name)
         one = conn.query_one(query_sql, query_param)
         if one:
             return
@@ -421,33 +594,20 @@ class Asset(dict):
         )
 
     def load(self, timestamp: int) -> dict:
-        sql = """
-        SELECT * FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? 
-        AND timestamp <= ? ORDER BY timestamp DESC, id DESC LIMIT 1""".format(self._asset_table_name)
-        params = (
-            self._exchange, self._settle_mode, self._settle_currency, timestamp,
-        )
-
         if self._mode == MODE_BACKTEST:
-            sql = """
-            SELECT * FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? 
-            AND timestamp <= ? AND backtest_id = ? ORDER BY timestamp DESC, id DESC LIMIT 1
-            """.format(self._asset_table_name)
-            params = (
-                self._exchange, self._settle_mode, self._settle_currency,
-                timestamp, self._backtest_id
+            # 回测中的资产记录都由Asset写入，按时间排好序放在内存中查找。
+            result = self.__snapshots().get(timestamp)
+        else:
+            conn = connect(self._db_name)
+            result = conn.query_one(
+                """
+                SELECT * FROM {} WHERE exchange = ? AND settle_mode = ? AND settle_currency = ? 
+                AND timestamp <= ? ORDER BY timestamp DESC, id DESC LIMIT 1""".format(self._asset_table_name),
+                (self._exchange, self._settle_mode, self._settle_currency, timestamp),
             )
-
-        conn = Conn(self._db_name)
-        result = conn.query_one(sql, params)
         if result is None:
             raise RuntimeError("you must init_amount before load the asset. ")
 
-        self["asset_total"] = result["asset_total"]
-        self["asset_sub"] = result["asset_sub"]
-        self["asset_freeze"] = result["asset_freeze"]
-
-        self["position_total"] = result["position_total"]
-        self["position_sub"] = result["position_sub"]
-        self["position_freeze"] = result["position_freeze"]
+        for key in ASSET_FIGURES:
+            self[key] = result[key]
         return self
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import zlib
+import numpy as np
+
+from pyanalysis.moment import moment
+
+# 缓存文件中每根蜡烛固定宽度的二进制格式，价格保存原始值。
+CANDLE_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("vol", "<f8"),
+    ("due_timestamp", "<i8"),
+])
+
+DAY_MILLISECONDS = 24 * 60 * 60 * 1000
+
+
+class KlineCache(object):
+    """Local disk cache of the kline table, one fixed width binary chunk per day.
+
+    The chunks are read through numpy.memmap. Every chunk has a json file beside it, which
+    records the format version, rows count, crc32 checksum and whether the day was finished
+    when it was cached. The unfinished days are treated as missing, so they are read again.
+    """
+    __VERSION__ = 1
+    __PATH_FORMAT__ = "{root}/{trade_type}/{symbol}/{exchange}/{contract_type}/{interval}"
+
+    def __init__(
+            self,
+            root: str,
+            trade_type: str,
+            symbol: str,
+            exchange: str,
+            contract_type: str = None,
+    ):
+        self._root = root
+        self._trade_type = trade_type
+        self._symbol = symbol
+        self._exchange = exchange
+        self._contract_type = contract_type or "none"
+
+    @staticmethod
+    def days(start_timestamp: int, finish_timestamp: int):
+        """The UTC day start timestamps covering [start_timestamp, finish_timestamp). """
+        day_timestamp = start_timestamp - start_timestamp % DAY_MILLISECONDS
+        while day_timestamp < finish_timestamp:
+            yield day_timestamp
+            day_timestamp += DAY_MILLISECONDS
+
+    def _path(self, interval: str, day_timestamp: int) -> str:
+        return os.path.join(
+            self.__PATH_FORMAT__.format(
+                root=self._root,
+                trade_type=self._trade_type,
+                symbol=self._symbol,
+                exchange=self._exchange,
+                contract_type=self._contract_type,
+                interval=interval,
+            ),
+            time.strftime("%Y%m%d", time.gmtime(day_timestamp // 1000)),
+        )
+
+    def load(self, interval: str, day_timestamp: int):
+        """Get the cached candles of the day, None if the day is not cached or broken. """
+        path = self._path(interval, day_timestamp)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            size = os.path.getsize(path + ".bin")
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("version") != self.__VERSION__ or not meta.get("complete"):
+            return None
+        if size != meta["rows"] * CANDLE_DTYPE.itemsize:
+            return None
+        if meta["rows"] == 0:
+            return np.zeros(0, dtype=CANDLE_DTYPE)
+
+        records = np.memmap(path + ".bin", dtype=CANDLE_DTYPE, mode="r")
+        if zlib.crc32(records.tobytes()) != meta["crc32"]:
+            return None
+        return records
+
+    def save(self, interval: str, day_timestamp: int, records: np.ndarray, complete: bool) -> None:
+        path = self._path(interval, day_timestamp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        records = np.ascontiguousarray(records, dtype=CANDLE_DTYPE)
+        # 先写临时文件再替换，读到的永远是完整的文件。
+        records.tofile(path + ".bin.tmp")
+        with open(path + ".json.tmp", "w") as f:
+            json.dump({
+                "version": self.__VERSION__,
+                "rows": len(records),
+                "crc32": zlib.crc32(records.tobytes()),
+                "complete": complete,
+                "cached_timestamp": moment.now().millisecond_timestamp,
+            }, f)
+        os.replace(path + ".bin.tmp", path + ".bin")
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def _series_path(self, interval: str) -> str:
+        return os.path.join(os.path.dirname(self._path(interval, 0)), "series")
+
+    def load_series(self, interval: str, start_timestamp: int = None, finish_timestamp: int = None):
+        """Get the whole materialized series of the interval, and the covered ranges.
+
+        If start_timestamp and finish_timestamp are set, return (None, ranges) when the range is not
+        fully covered.
+        """
+        path = self._series_path(interval)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            size = os.path.getsize(path + ".bin")
+        except (OSError, ValueError):
+            return None, []
+
+        ranges = meta.get("ranges") or []
+        if meta.get("version") != self.__VERSION__ or size != meta["rows"] * CANDLE_DTYPE.itemsize:
+            return None, []
+        if start_timestamp is not None:
+            for covered_start, covered_finish in ranges:
+                if covered_start <= start_timestamp and finish_timestamp <= covered_finish:
+                    break
+            else:
+                return None, ranges
+        if meta["rows"] == 0:
+            return np.zeros(0, dtype=CANDLE_DTYPE), ranges
+
+        records = np.memmap(path + ".bin", dtype=CANDLE_DTYPE, mode="r")
+        if zlib.crc32(records.tobytes()) != meta["crc32"]:
+            return None, []
+        return records, ranges
+
+    def save_series(self, interval: str, records: np.ndarray, ranges: list) -> None:
+        path = self._series_path(interval)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        records = np.ascontiguousarray(records, dtype=CANDLE_DTYPE)
+        records.tofile(path + ".bin.tmp")
+        with open(path + ".json.tmp", "w") as f:
+            json.dump({
+                "version": self.__VERSION__,
+                "rows": len(records),
+                "crc32": zlib.crc32(records.tobytes()),
+                "ranges": ranges,
+                "cached_timestamp": moment.now().millisecond_timestamp,
+            }, f)
+        os.replace(path + ".bin.tmp", path + ".bin")
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def invalidate(self, interval: str, day_timestamp: int) -> None:
+        path = self._path(interval, day_timestamp)
+        for suffix in (".json", ".bin"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def invalidate_open(self, interval: str) -> int:
+        """Remove the days which were not finished when they were cached, return the removed count. """
+        directory = os.path.dirname(self._path(interval, 0))
+        if not os.path.isdir(directory):
+            return 0
+
+        count = 0
+        for name in os.listdir(directory):
+            # 只检查按天缓存的文件，金字塔的series没有complete标记
+            if not name.endswith(".json") or not name[:-len(".json")].isdigit():
+                continue
+            path = os.path.join(directory, name[:-len(".json")])
+            try:
+                with open(path + ".json") as f:
+                    complete = json.load(f).get("complete")
+            except (OSError, ValueError):
+                complete = False
+            if not complete:
+                for suffix in (".json", ".bin"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                count += 1
+        return count
@@ -0,0 +1,34 @@
+import os
+import pickle
+
+
+class CheckpointFile(object):
+    """The checkpoint of a backtest, one pickle file per backtest_id in the checkpoint directory.
+
+    The file is replaced as a whole, a crash while saving keeps the previous checkpoint.
+    """
+    __VERSION__ = 1
+
+    @staticmethod
+    def path(directory: str, backtest_id: str) -> str:
+        return os.path.join(directory, "{}.checkpoint".format(backtest_id))
+
+    @classmethod
+    def save(cls, directory: str, backtest_id: str, state: dict) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = cls.path(directory, backtest_id)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(dict(state, version=cls.__VERSION__), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        return path
+
+    @classmethod
+    def load(cls, directory: str, backtest_id: str) -> dict:
+        path = cls.path(directory, backtest_id)
+        if not os.path.exists(path):
+            raise RuntimeError("the backtest has no checkpoint", backtest_id)
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != cls.__VERSION__:
+            raise RuntimeError("unsupported checkpoint version", path)
+        return state
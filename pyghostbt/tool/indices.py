@@ -4,7 +4,8 @@ import numpy as np
 
 from jsonschema import validate
 from typing import List
-from pyanalysis.mysql import Conn
+from pyghostbt.tool.storage import connect
+from pyghostbt.tool.storage import upsert
 from pyghostbt.const import *
 
 # 在此处设置对应的指标名称常量名称
@@ -132,7 +133,7 @@ class Indices(dict):
             self[indices_name] = indices[indices_name]
 
     def load(self, instance_id):
-        conn = Conn(self._db_name)
+        conn = connect(self._db_name)
         results = conn.query(
             "SELECT * FROM {} WHERE instance_id = ?".format(self._table_name),
             (instance_id,),
@@ -151,28 +152,18 @@ class Indices(dict):
         # 入库前保证属性没有被篡改
         validate(instance=self, schema=indices_input)
 
+        rows = []
         for name in self:
             if isinstance(self[name], int):
-                sql_param = (PARAM_TYPE_INTEGER, str(self[name]), instance_id, name)
+                indices_type, indices_value = PARAM_TYPE_INTEGER, str(self[name])
             elif isinstance(self[name], float):
-                sql_param = (PARAM_TYPE_FLOAT, str(self[name]), instance_id, name)
+                indices_type, indices_value = PARAM_TYPE_FLOAT, str(self[name])
             else:
-                sql_param = (PARAM_TYPE_STRING, self[name], instance_id, name)
-
-            conn = Conn(self._db_name)
-            one = conn.query_one(
-                "SELECT * FROM {} WHERE instance_id = ? AND indices_name = ?".format(self._table_name),
-                (instance_id, name)
-            )
-            if one:
-                conn.execute(
-                    "UPDATE {} SET indices_type = ?, indices_value = ?"
-                    " WHERE instance_id = ? AND indices_name = ?".format(self._table_name),
-                    sql_param,
-                )
-            else:
-                conn.insert(
-                    "INSERT INTO {} (indices_type, indices_value, instance_id, indices_name)"
-                    " VALUES (?, ?, ?, ?)".format(self._table_name),
-                    sql_param,
-                )
+                indices_type, indices_value = PARAM_TYPE_STRING, self[name]
+            rows.append({
+                "instance_id": instance_id,
+                "indices_name": name,
+                "indices_type": indices_type,
+                "indices_value": indices_value,
+            })
+        upsert(self._db_name, self._table_name, rows, unique_key=("instance_id", "indices_name"))
@@ -1,7 +1,23 @@
+import os
+import queue
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
 from jsonschema import validate
+from typing import List
 from pyanalysis.mysql import Conn
 from pyanalysis.moment import moment
 from pyghostbt.util import standard_number
+from pyghostbt.util import standard_numbers
+from pyghostbt.util import datetime_strings
+from pyghostbt.tool.cache import KlineCache
+from pyghostbt.tool.cache import CANDLE_DTYPE
+from pyghostbt.tool.cache import DAY_MILLISECONDS
+from pyghostbt.tool.offline import KlineFile
+from pyghostbt.tool.offline import KlineFileSource
+from pyghostbt.tool.shared import SharedKlineSource
 from pyghostbt.const import *
 
 kline_input = {
@@ -41,13 +57,431 @@ kline_input = {
         "db_name": {
             "type": "string",
             "minLength": 1,
-        }
+        },
+        "page_size": {
+            "type": ["null", "integer"],
+            "minimum": 1,
+        },
+        "cache_dir": {
+            "type": ["null", "string"],
+        },
+        "prefetch": {
+            "type": ["null", "integer"],
+            "minimum": 0,
+        },
+        "lru_rows": {
+            "type": ["null", "integer"],
+            "minimum": 0,
+        },
+        "offline_dir": {
+            "type": ["null", "string"],
+        },
+        "shared": {
+            "type": ["null", "array"],
+            "items": {
+                "type": "object",
+            },
+        },
     }
 }
 
 
+class KlineFrame(object):
+    """Columnar candles, one numpy array per column.
+
+    The prices are standardised once per column instead of once per candle. Iterate the
+    frame to get the candles as dict rows, so the callers of the dict candles still work.
+    """
+    __PRICE_COLUMNS__ = ("open", "high", "low", "close")
+
+    def __init__(
+            self,
+            timestamp,
+            open,
+            high,
+            low,
+            close,
+            vol,
+            due_timestamp=None,
+            date=None,
+            due_date=None,
+            standard: bool = False,
+            **meta
+    ):
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.open = np.asarray(open, dtype=np.int64 if standard else np.float64)
+        self.high = np.asarray(high, dtype=np.int64 if standard else np.float64)
+        self.low = np.asarray(low, dtype=np.int64 if standard else np.float64)
+        self.close = np.asarray(close, dtype=np.int64 if standard else np.float64)
+        self.vol = np.asarray(vol, dtype=np.float64)
+        # only the future candles have the due_timestamp, the others fill 0.
+        self.has_due = due_timestamp is not None
+        self.due_timestamp = np.asarray(due_timestamp, dtype=np.int64) if self.has_due \
+            else np.zeros(len(self.timestamp), dtype=np.int64)
+        self.standard = standard
+        # symbol, exchange, contract_type, interval, the same value in every candle.
+        self.meta = meta
+
+        self._date = None if date is None else np.asarray(date, dtype=object)
+        self._due_date = None if due_date is None else np.asarray(due_date, dtype=object)
+
+    @classmethod
+    def from_candles(cls, candles: List[dict], standard: bool = False):
+        meta = {}
+        if len(candles):
+            for key in ("symbol", "exchange", "contract_type", "interval"):
+                if key in candles[0]:
+                    meta[key] = candles[0][key]
+
+        columns = {}
+        for key in ("open", "high", "low", "close"):
+            column = np.array([c[key] for c in candles], dtype=np.float64)
+            columns[key] = standard_numbers(column) if standard else column
+
+        has_due = len(candles) > 0 and candles[0].get("due_timestamp") is not None
+        return cls(
+            [c["timestamp"] for c in candles],
+            columns["open"],
+            columns["high"],
+            columns["low"],
+            columns["close"],
+            np.array([c["vol"] for c in candles], dtype=np.float64),
+            due_timestamp=[c["due_timestamp"] for c in candles] if has_due else None,
+            date=[c.get("date") for c in candles] if len(candles) and "date" in candles[0] else None,
+            due_date=[c.get("due_date") for c in candles] if has_due and "due_date" in candles[0] else None,
+            standard=standard,
+            **meta
+        )
+
+    @classmethod
+    def from_records(cls, records: np.ndarray, has_due: bool = False, **meta):
+        return cls(
+            records["timestamp"],
+            records["open"],
+            records["high"],
+            records["low"],
+            records["close"],
+            records["vol"],
+            due_timestamp=records["due_timestamp"] if has_due else None,
+            **meta
+        )
+
+    def to_records(self) -> np.ndarray:
+        records = np.zeros(len(self), dtype=CANDLE_DTYPE)
+        for key in ("timestamp", "open", "high", "low", "close", "vol", "due_timestamp"):
+            records[key] = getattr(self, key)
+        return records
+
+    @classmethod
+    def concat(cls, frames: list):
+        if len(frames) == 0:
+            return cls([], [], [], [], [], [])
+        if len(frames) == 1:
+            return frames[0]
+        return cls(
+            np.concatenate([f.timestamp for f in frames]),
+            np.concatenate([f.open for f in frames]),
+            np.concatenate([f.high for f in frames]),
+            np.concatenate([f.low for f in frames]),
+            np.concatenate([f.close for f in frames]),
+            np.concatenate([f.vol for f in frames]),
+            due_timestamp=np.concatenate([f.due_timestamp for f in frames]) if frames[0].has_due else None,
+            date=np.concatenate([f.date for f in frames]),
+            due_date=np.concatenate([f.due_date for f in frames]) if frames[0].has_due else None,
+            standard=frames[0].standard,
+            **frames[0].meta
+        )
+
+    @property
+    def date(self) -> np.ndarray:
+        if self._date is None:
+            self._date = datetime_strings(self.timestamp).astype(object)
+        return self._date
+
+    @property
+    def due_date(self) -> np.ndarray:
+        if self._due_date is None:
+            self._due_date = datetime_strings(self.due_timestamp).astype(object)
+        return self._due_date
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __iter__(self):
+        columns = [
+            self.timestamp.tolist(),
+            self.date.tolist(),
+            self.open.tolist(),
+            self.high.tolist(),
+            self.low.tolist(),
+            self.close.tolist(),
+            self.vol.tolist(),
+        ]
+        keys = ["timestamp", "date", "open", "high", "low", "close", "vol"]
+        if self.has_due:
+            columns += [self.due_timestamp.tolist(), self.due_date.tolist()]
+            keys += ["due_timestamp", "due_date"]
+
+        for values in zip(*columns):
+            candle = dict(self.meta)
+            candle.update(zip(keys, values))
+            yield candle
+
+    def row(self, i: int) -> dict:
+        candle = dict(self.meta)
+        candle["timestamp"] = int(self.timestamp[i])
+        candle["date"] = self.date[i]
+        for key in self.__PRICE_COLUMNS__:
+            candle[key] = getattr(self, key)[i].item()
+        candle["vol"] = float(self.vol[i])
+        if self.has_due:
+            candle["due_timestamp"] = int(self.due_timestamp[i])
+            candle["due_date"] = self.due_date[i]
+        return candle
+
+    def slice(self, lo: int, hi: int):
+        return KlineFrame(
+            self.timestamp[lo:hi],
+            self.open[lo:hi],
+            self.high[lo:hi],
+            self.low[lo:hi],
+            self.close[lo:hi],
+            self.vol[lo:hi],
+            due_timestamp=self.due_timestamp[lo:hi] if self.has_due else None,
+            date=None if self._date is None else self._date[lo:hi],
+            due_date=None if self._due_date is None else self._due_date[lo:hi],
+            standard=self.standard,
+            **self.meta
+        )
+
+    def resample(self, edges):
+        """Fold the candles into the buckets [edges[i], edges[i + 1]), the empty buckets are dropped.
+
+        The frame must be sorted by timestamp. Every bucket is labeled with its start timestamp.
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+        frame = self.between(int(edges[0]), int(edges[-1])) if len(edges) else self.slice(0, 0)
+        starts = np.searchsorted(frame.timestamp, edges[:-1])
+        stops = np.searchsorted(frame.timestamp, edges[1:])
+        filled = starts < stops
+        starts, stops = starts[filled], stops[filled]
+        if len(starts) == 0:
+            return frame.slice(0, 0)
+
+        return KlineFrame(
+            edges[:-1][filled],
+            frame.open[starts],
+            np.maximum.reduceat(frame.high, starts),
+            np.minimum.reduceat(frame.low, starts),
+            frame.close[stops - 1],
+            np.add.reduceat(frame.vol, starts),
+            due_timestamp=frame.due_timestamp[starts] if frame.has_due else None,
+            due_date=None if frame._due_date is None else frame._due_date[starts],
+            standard=frame.standard,
+            **frame.meta
+        )
+
+    def to_standard(self):
+        """The same candles with the standardised prices. """
+        if self.standard:
+            return self
+        return KlineFrame(
+            self.timestamp,
+            standard_numbers(self.open),
+            standard_numbers(self.high),
+            standard_numbers(self.low),
+            standard_numbers(self.close),
+            self.vol,
+            due_timestamp=self.due_timestamp if self.has_due else None,
+            date=self._date,
+            due_date=self._due_date,
+            standard=True,
+            **self.meta
+        )
+
+    def between(self, start_timestamp: int, finish_timestamp: int):
+        """The candles in [start_timestamp, finish_timestamp), the frame must be sorted by timestamp. """
+        lo, hi = np.searchsorted(self.timestamp, [start_timestamp, finish_timestamp])
+        return self.slice(int(lo), int(hi))
+
+
+class ContractMatrix(object):
+    """The candles of all the contracts aligned as a timestamp x due_timestamp matrix.
+
+    close, high, low are 2d arrays, mask marks which (timestamp, due_timestamp) has a candle.
+    """
+
+    def __init__(self, timestamp, due_timestamp, close, high, low, mask, standard: bool = False):
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.due_timestamp = np.asarray(due_timestamp, dtype=np.int64)
+        self.close = close
+        self.high = high
+        self.low = low
+        self.mask = mask
+        self.standard = standard
+
+    @classmethod
+    def from_candles(cls, candles: List[dict], standard: bool = False):
+        timestamps, rows = np.unique([c["timestamp"] for c in candles], return_inverse=True)
+        due_timestamps, columns = np.unique([c["due_timestamp"] for c in candles], return_inverse=True)
+        shape = (len(timestamps), len(due_timestamps))
+
+        matrix = {}
+        for key in ("close", "high", "low"):
+            column = np.array([c[key] for c in candles], dtype=np.float64)
+            if standard:
+                matrix[key] = np.zeros(shape, dtype=np.int64)
+                matrix[key][rows, columns] = standard_numbers(column)
+            else:
+                matrix[key] = np.full(shape, np.nan)
+                matrix[key][rows, columns] = column
+        mask = np.zeros(shape, dtype=bool)
+        mask[rows, columns] = True
+        return cls(
+            timestamps,
+            due_timestamps,
+            matrix["close"],
+            matrix["high"],
+            matrix["low"],
+            mask,
+            standard=standard,
+        )
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def column(self, due_timestamp: int) -> int:
+        j = int(np.searchsorted(self.due_timestamp, due_timestamp))
+        if j == len(self.due_timestamp) or self.due_timestamp[j] != due_timestamp:
+            raise RuntimeError("the contract is not in the matrix", due_timestamp)
+        return j
+
+    def aligned(self, due_timestamps: list) -> np.ndarray:
+        """The rows which have the candles of all the due_timestamps. """
+        if len(due_timestamps) == 0:
+            return np.ones(len(self), dtype=bool)
+        return self.mask[:, [self.column(d) for d in due_timestamps]].all(axis=1)
+
+    def candle(self, i: int, due_timestamp: int) -> dict:
+        j = self.column(due_timestamp)
+        if not self.mask[i, j]:
+            return {}
+        return {
+            "timestamp": int(self.timestamp[i]),
+            "date": str(datetime_strings(self.timestamp[i:i + 1])[0]),
+            "close": self.close[i, j].item(),
+            "high": self.high[i, j].item(),
+            "low": self.low[i, j].item(),
+            "due_timestamp": int(due_timestamp),
+            "due_date": str(datetime_strings([due_timestamp])[0]),
+        }
+
+
+class KlineLRU(object):
+    """Size bounded LRU cache of the candle segments, keyed by interval and time range.
+
+    A segment [start, finish) holds every candle of the range. A query partly covered by the cached
+    segments only reads the uncovered gaps, then the overlapped segments are merged into one. A merged
+    segment longer than max_rows keeps the queried range and drops the candles farthest from it, a query
+    longer than max_rows is not cached. The returned frames share the arrays of the segments, so the
+    arrays are read only.
+    """
+
+    def __init__(self, max_rows: int):
+        self.max_rows = max_rows
+        self.rows = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        # (interval, standard, start_timestamp) -> (finish_timestamp, frame)
+        self._segments = OrderedDict()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "misses": self.misses,
+            "rows": self.rows,
+            "segments": len(self._segments),
+        }
+
+    @staticmethod
+    def __freeze(frame: KlineFrame) -> KlineFrame:
+        for column in (frame.timestamp, frame.open, frame.high, frame.low, frame.close, frame.vol, frame.due_timestamp,
+                       frame._date, frame._due_date):
+            if column is not None:
+                column.flags.writeable = False
+        return frame
+
+    def get(self, interval: str, standard: bool, start_timestamp: int, finish_timestamp: int, read) -> KlineFrame:
+        """Get the candles in [start_timestamp, finish_timestamp), read(start, finish) fetches the gaps. """
+        overlapped = sorted([
+            (key[2], self._segments[key][0], key)
+            for key in self._segments
+            if key[0] == interval and key[1] == standard
+            and key[2] <= finish_timestamp and self._segments[key][0] >= start_timestamp
+        ])
+
+        gaps = []
+        flag_timestamp = start_timestamp
+        for segment_start, segment_finish, _ in overlapped:
+            if segment_start > flag_timestamp:
+                gaps.append((flag_timestamp, min(segment_start, finish_timestamp)))
+            flag_timestamp = max(flag_timestamp, segment_finish)
+        if flag_timestamp < finish_timestamp:
+            gaps.append((flag_timestamp, finish_timestamp))
+
+        if len(gaps) == 0:
+            self.hits += 1
+        elif len(overlapped):
+            self.partial_hits += 1
+        else:
+            self.misses += 1
+
+        if len(gaps) == 0 and len(overlapped) == 1:
+            key = overlapped[0][2]
+            self._segments.move_to_end(key)
+            return self._segments[key][1].between(start_timestamp, finish_timestamp)
+
+        frames = [self._segments[key][1] for _, _, key in overlapped] + [read(s, f) for s, f in gaps]
+        frames = [f for f in frames if len(f)]
+        frames.sort(key=lambda f: int(f.timestamp[0]))
+        for _, _, key in overlapped:
+            self.rows -= len(self._segments.pop(key)[1])
+
+        # 重叠的各段合并成一段。
+        merged_start = min([start_timestamp] + [s for s, _, _ in overlapped])
+        merged_finish = max([finish_timestamp] + [f for _, f, _ in overlapped])
+        timestamps = np.concatenate([f.timestamp for f in frames]) if len(frames) else np.zeros(0, dtype=np.int64)
+        lo, hi = np.searchsorted(timestamps, [start_timestamp, finish_timestamp])
+        if hi - lo > self.max_rows:
+            # 查询范围本身就超过容量，不缓存。
+            return KlineFrame.concat(frames).between(start_timestamp, finish_timestamp)
+        if len(timestamps) > self.max_rows:
+            # 合并后超过容量时只保留查询范围及其附近的蜡烛，两端离查询范围远的先丢弃。
+            spare = self.max_rows - (hi - lo)
+            after = min(len(timestamps) - hi, spare // 2)
+            before = min(lo, spare - after)
+            after = min(len(timestamps) - hi, spare - before)
+            if lo - before > 0:
+                merged_start = int(timestamps[lo - before])
+            if hi + after < len(timestamps):
+                merged_finish = int(timestamps[hi + after])
+            frames = [f.between(merged_start, merged_finish) for f in frames]
+            frames = [f for f in frames if len(f)]
+        frame = self.__freeze(KlineFrame.concat(frames))
+        self._segments[(interval, standard, merged_start)] = (merged_finish, frame)
+        self.rows += len(frame)
+
+        while self.rows > self.max_rows and len(self._segments) > 1:
+            _, (_, evicted) = self._segments.popitem(last=False)
+            self.rows -= len(evicted)
+        return frame.between(start_timestamp, finish_timestamp)
+
+
 class Kline(object):
     __TABLE_NAME_FORMAT__ = "{trade_type}_kline_{symbol}"
+    __DEFAULT_PAGE_SIZE__ = 10000
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -59,18 +493,59 @@ class Kline(object):
         self.contract_type = kwargs.get("contract_type")
 
         self.db_name = kwargs.get("db_name", "default")
+        # 每次从数据库读取蜡烛的数量。
+        self.page_size = kwargs.get("page_size") or self.__DEFAULT_PAGE_SIZE__
+        # 后台线程预先读取的页数，0表示不预读。
+        self.prefetch = kwargs.get("prefetch") or 0
+        # 缓存最近读取过的蜡烛，lru_rows为缓存的最大蜡烛数量。
+        self.lru = KlineLRU(kwargs.get("lru_rows")) if kwargs.get("lru_rows") else None
         self.table_name = self.__TABLE_NAME_FORMAT__.format(
             trade_type=self.trade_type,
             symbol=self.symbol,
         )
 
         self.sql = """SELECT * FROM {} WHERE symbol = ? AND exchange = ?{}
-         AND `interval` = ? AND timestamp >= ? AND timestamp < ? 
-         ORDER BY timestamp LIMIT 100
+         AND `interval` = ? AND timestamp >= ? AND timestamp < ?
+         ORDER BY timestamp LIMIT {}
         """.format(
             self.table_name,
             "" if self.trade_type != TRADE_TYPE_FUTURE else " AND contract_type = ? ",
+            self.page_size,
         )
+        # 设置了cache_dir时，query_range优先从本地缓存读取。
+        self.cache = None
+        if kwargs.get("cache_dir"):
+            self.cache = KlineCache(
+                kwargs.get("cache_dir"),
+                self.trade_type,
+                self.symbol,
+                self.exchange,
+                contract_type=self.contract_type if self.trade_type == TRADE_TYPE_FUTURE else None,
+            )
+        # 设置了offline_dir时，只从导出的离线文件读取，不再访问数据库。
+        self.offline = None
+        if kwargs.get("offline_dir"):
+            self.offline = KlineFileSource(
+                kwargs.get("offline_dir"),
+                self.trade_type,
+                self.symbol,
+                self.exchange,
+                contract_type=self.contract_type,
+            )
+        # 设置了shared时，从其他进程创建的共享内存读取，同样不再访问数据库。
+        if kwargs.get("shared"):
+            self.offline = SharedKlineSource(
+                kwargs.get("shared"),
+                self.trade_type,
+                self.symbol,
+                self.exchange,
+                contract_type=self.contract_type,
+            )
+        # 按照 (timestamp, due_timestamp) 翻页，不会漏掉或者重复同一时间不同contract的蜡烛。
+        self.contracts_sql = """SELECT * FROM {} WHERE symbol = ? AND exchange = ? AND `interval` = ?
+         AND (timestamp > ? OR (timestamp = ? AND due_timestamp > ?)) AND timestamp < ?
+         ORDER BY timestamp, due_timestamp LIMIT {}
+        """.format(self.table_name, self.page_size)
 
     @staticmethod
     def __standard_candle(candle):
@@ -87,9 +562,65 @@ class Kline(object):
             interval: str,
             standard: bool = False,
     ) -> list:
+        if self.lru is not None:
+            return [c for c in self.query_frame(start_timestamp, finish_timestamp, interval, standard=standard)]
         candles = self.query_range(start_timestamp, finish_timestamp, interval, standard=standard)
         return [c for c in candles]
 
+    def query_frame(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False,
+    ) -> KlineFrame:
+        # 还没结束的时间段数据会变化，不放入缓存。
+        if self.lru is not None and finish_timestamp <= moment.now().millisecond_timestamp:
+            return self.lru.get(
+                interval,
+                standard,
+                start_timestamp,
+                finish_timestamp,
+                lambda s, f: self.__read_frame(s, f, interval, standard),
+            )
+        return self.__read_frame(start_timestamp, finish_timestamp, interval, standard)
+
+    def __read_frame(self, start_timestamp: int, finish_timestamp: int, interval: str, standard: bool) -> KlineFrame:
+        frames = self.query_frames(start_timestamp, finish_timestamp, interval, standard=standard)
+        return KlineFrame.concat([f for f in frames])
+
+    def query_pyramid(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False,
+    ):
+        """Get the materialized candles of the interval touching [start_timestamp, finish_timestamp).
+
+        The candles are labeled with the bucket start timestamp, see KlinePyramid.
+
+        Returns:
+            (frame, ranges), the ranges are the covered ranges of the series, in which the empty
+            buckets have no candle. (None, []) if the interval is not materialized.
+        """
+        if self.cache is None or self.offline is not None:
+            return None, []
+        records, ranges = self.cache.load_series(interval)
+        if records is None:
+            return None, []
+
+        frame = KlineFrame.from_records(
+            records,
+            has_due=self.trade_type == TRADE_TYPE_FUTURE,
+            symbol=self.symbol,
+            exchange=self.exchange,
+            contract_type=self.contract_type,
+            interval=interval,
+        )
+        frame = frame.between(start_timestamp - INTERVAL_MILLISECONDS[interval] + 1, finish_timestamp)
+        return frame.to_standard() if standard else frame, ranges
+
     def query_by_group(
             self,
             start_timestamp: int,
@@ -97,65 +628,179 @@ class Kline(object):
             interval: str,
             standard: bool = False,
     ):
+        """Fold the 1min candles into the groups of the interval from start_timestamp.
+
+        Every group is labeled with its start timestamp, the same as the candles of the interval read
+        from the kline table or the pyramid.
+        """
         if interval == KLINE_INTERVAL_1MIN:
             return self.query(start_timestamp, finish_timestamp, interval, standard)
 
-        intervals = {
-            KLINE_INTERVAL_1DAY: 24 * 60 * 60 * 1000,
-            KLINE_INTERVAL_4HOUR: 4 * 60 * 60 * 1000,
-            KLINE_INTERVAL_1HOUR: 60 * 60 * 1000,
-            KLINE_INTERVAL_15MIN: 15 * 60 * 1000,
-        }
-
-        if intervals.get(interval) is None:
+        num = INTERVAL_MILLISECONDS.get(interval)
+        if num is None:
             raise RuntimeError("can not use the interval", interval)
+        if start_timestamp >= finish_timestamp:
+            return []
 
-        num = intervals[interval]
-        flag_timestamp = start_timestamp
-        result = []
+        # 一次读取全部1min蜡烛，最后一组可能超出finish_timestamp。
+        edges = np.arange(start_timestamp, finish_timestamp + num, num, dtype=np.int64)
+        frame = self.query_frame(start_timestamp, int(edges[-1]), KLINE_INTERVAL_1MIN, standard)
+        return [c for c in frame.resample(edges)]
 
-        while flag_timestamp < finish_timestamp:
-            candles = self.query(flag_timestamp, flag_timestamp + num, KLINE_INTERVAL_1MIN, standard)
-            flag_timestamp += num
-            if len(candles) == 0:
-                continue
+    def query_range(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False
+    ):
+        for frame in self.query_frames(start_timestamp, finish_timestamp, interval, standard=standard):
+            yield from frame
 
-            tmp_candle = candles[0].copy()
-            tmp_candle["high"] = candles[0]["high"]
-            tmp_candle["low"] = candles[0]["low"]
-            tmp_candle["close"] = candles[-1]["close"]
-            tmp_candle["vol"] = 0
-            tmp_candle["timestamp"] = flag_timestamp
-            tmp_candle["date"] = moment.get(flag_timestamp).to("Asia/Shanghai").format("YYYY-MM-DD HH:mm:ss")
+    # 每页蜡烛数据生成一个KlineFrame，价格按列标准化。
+    def query_frames(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False
+    ):
+        if self.offline is not None:
+            records = self.offline.records(start_timestamp, finish_timestamp, interval)
+            frame = KlineFrame.from_records(records, has_due=self.trade_type == TRADE_TYPE_FUTURE, **{
+                "symbol": self.symbol,
+                "exchange": self.exchange,
+                "contract_type": self.contract_type,
+                "interval": interval,
+            })
+            if len(frame):
+                yield frame.to_standard() if standard else frame
+            return
+        if self.cache is not None:
+            yield from self._query_cached_frames(start_timestamp, finish_timestamp, interval, standard=standard)
+            return
 
-            for candle in candles:
-                if candle["high"] > tmp_candle["high"]:
-                    tmp_candle["high"] = candle["high"]
-                if candle["low"] < tmp_candle["low"]:
-                    tmp_candle["low"] = candle["low"]
-                tmp_candle["vol"] += candle["vol"]
+        pages = self._query_pages(start_timestamp, finish_timestamp, interval)
+        if self.prefetch:
+            pages = self._prefetch_pages(pages)
+        try:
+            for candles in pages:
+                yield KlineFrame.from_candles(candles, standard=standard)
+        finally:
+            # 提前关闭时也停止预读线程并释放链接
+            pages.close()
 
-            result.append(tmp_candle)
-        return result
+    def _prefetch_pages(self, pages):
+        """Read the pages on a worker thread, keep at most self.prefetch pages in flight.
 
-    def query_range(
+        When the consumer stops early, the worker stops after the page it is reading.
+        """
+        pending = queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def work():
+            try:
+                for page in pages:
+                    if not put(page):
+                        break
+                put(finished)
+            except Exception as e:
+                put(e)
+            finally:
+                pages.close()
+
+        threading.Thread(target=work, daemon=True).start()
+        try:
+            while True:
+                item = pending.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    def _query_cached_frames(
             self,
             start_timestamp: int,
             finish_timestamp: int,
             interval: str,
             standard: bool = False
     ):
+        meta = {
+            "symbol": self.symbol,
+            "exchange": self.exchange,
+            "contract_type": self.contract_type,
+            "interval": interval,
+        }
+        has_due = self.trade_type == TRADE_TYPE_FUTURE
+        if interval != KLINE_INTERVAL_1MIN:
+            # 金字塔中已经生成的大周期蜡烛，一次范围读取。
+            records, _ = self.cache.load_series(interval, start_timestamp, finish_timestamp)
+            if records is not None:
+                frame = KlineFrame.from_records(records, has_due=has_due, **meta)
+                frame = frame.between(start_timestamp, finish_timestamp)
+                if len(frame):
+                    yield frame.to_standard() if standard else frame
+                return
+
+        for day_timestamp in KlineCache.days(start_timestamp, finish_timestamp):
+            records = self.cache.load(interval, day_timestamp)
+            if records is None:
+                frame = KlineFrame.concat([
+                    KlineFrame.from_candles(candles)
+                    for candles in self._query_pages(day_timestamp, day_timestamp + DAY_MILLISECONDS, interval)
+                ])
+                records = frame.to_records()
+                # 还没结束的一天也缓存下来，但标记为未完成，下次读取时重新从数据库获取。
+                complete = day_timestamp + DAY_MILLISECONDS <= moment.now().millisecond_timestamp
+                self.cache.save(interval, day_timestamp, records, complete)
+
+            frame = KlineFrame.from_records(records, has_due=has_due, **meta)
+            frame = frame.between(start_timestamp, finish_timestamp)
+            if len(frame):
+                yield frame.to_standard() if standard else frame
+
+    def _query_pages(self, start_timestamp: int, finish_timestamp: int, interval: str):
+        """Read the candles page by page with keyset pagination, one connection for the whole range. """
         conn = Conn(self.db_name)
-        params = (self.symbol, self.exchange, interval, start_timestamp, finish_timestamp)
-        if self.trade_type == TRADE_TYPE_FUTURE:
-            params = (self.symbol, self.exchange, self.contract_type, interval, start_timestamp, finish_timestamp)
+        try:
+            while start_timestamp < finish_timestamp:
+                params = (self.symbol, self.exchange, interval, start_timestamp, finish_timestamp)
+                if self.trade_type == TRADE_TYPE_FUTURE:
+                    params = (
+                        self.symbol, self.exchange, self.contract_type, interval, start_timestamp, finish_timestamp,
+                    )
 
-        candles = conn.query(self.sql, params)
-        conn.close()  # 手动关闭链接。
-        for candle in candles:
-            yield self.__standard_candle(candle) if standard else candle
-        if len(candles) == 100:
-            yield from self.query_range(candles[-1]["timestamp"] + 1000, finish_timestamp, interval, standard=standard)
+                candles = conn.query(self.sql, params)
+                if len(candles):
+                    yield candles
+                if len(candles) < self.page_size:
+                    break
+                start_timestamp = candles[-1]["timestamp"] + 1
+        finally:
+            conn.close()  # 手动关闭链接。
+
+    def query_contracts_matrix(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False,
+    ) -> ContractMatrix:
+        candles = [c for c in self.query_range_contracts(start_timestamp, finish_timestamp, interval)]
+        return ContractMatrix.from_candles(candles, standard=standard)
 
     def query_range_contracts(
             self,
@@ -163,31 +808,229 @@ class Kline(object):
             finish_timestamp: int,
             interval: str,
             standard: bool = False,
-            due_timestamp: int = 0,  # 辅助参数
+            due_timestamp: int = 0,  # 辅助参数，从start_timestamp时 due_timestamp 之后的contract开始
     ):
+        if self.offline is not None:
+            yield from self._query_offline_contracts(
+                start_timestamp, finish_timestamp, interval, standard=standard, due_timestamp=due_timestamp,
+            )
+            return
+
+        # 上一页最后一根蜡烛的位置，没有due_timestamp时包含start_timestamp的所有contract。
+        last_timestamp, last_due_timestamp = start_timestamp, due_timestamp if due_timestamp else -1
         conn = Conn(self.db_name)
-        params = (start_timestamp, finish_timestamp, self.symbol, self.exchange, interval)
-        candles = conn.query(
-            "SELECT * FROM {} WHERE timestamp >= ? AND timestamp < ? AND symbol = ? AND exchange = ?"
-            " AND `interval` = ? ORDER BY timestamp, due_timestamp LIMIT 100".format(self.table_name),
-            params,
-        )
+        try:
+            while True:
+                candles = conn.query(
+                    self.contracts_sql,
+                    (
+                        self.symbol, self.exchange, interval,
+                        last_timestamp, last_timestamp, last_due_timestamp, finish_timestamp,
+                    ),
+                )
+                for candle in candles:
+                    yield self.__standard_candle(candle) if standard else candle
+                if len(candles) < self.page_size:
+                    break
+                last_timestamp, last_due_timestamp = candles[-1]["timestamp"], candles[-1]["due_timestamp"]
+        finally:
+            conn.close()  # 手动关闭链接。
 
+    def _query_offline_contracts(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            standard: bool = False,
+            due_timestamp: int = 0,
+    ):
+        records = self.offline.records(start_timestamp, finish_timestamp, interval, contracts=True)
         if due_timestamp:
-            tmp_candles = conn.query(
-                "SELECT * FROM {} WHERE timestamp = ? AND symbol = ? AND exchange = ? AND `interval` = ?"
-                " AND due_timestamp > ? ORDER BY due_timestamp".format(self.table_name),
-                (start_timestamp, self.symbol, self.exchange, interval, due_timestamp)
-            )
-            candles = tmp_candles + candles
-        conn.close()  # 手动关闭链接。
-        for candle in candles:
-            yield self.__standard_candle(candle) if standard else candle
-        if len(candles) >= 100:
-            yield from self.query_range_contracts(
-                candles[-1]["timestamp"] + 1000,
-                finish_timestamp,
+            mask = (records["timestamp"] > start_timestamp) | (records["due_timestamp"] > due_timestamp)
+            records = {key: records[key][mask] for key in CANDLE_DTYPE.names}
+        frame = KlineFrame.from_records(records, has_due=True, symbol=self.symbol, exchange=self.exchange, interval=interval)
+        yield from frame.to_standard() if standard else frame
+
+    def export(
+            self,
+            path: str,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            contracts: bool = False,
+    ) -> str:
+        """Export the candles in [start_timestamp, finish_timestamp) to an offline kline file.
+
+        Args:
+            path: the file path, or a directory to save the file with the default name.
+            start_timestamp: the start of the range.
+            finish_timestamp: the end of the range, exclusive.
+            interval: the interval of the candles.
+            contracts: export the candles of all the contracts, which are read by query_range_contracts.
+
+        Returns:
+            The path of the exported file.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, KlineFile.name(
+                self.trade_type,
+                self.symbol,
+                self.exchange,
+                self.contract_type,
                 interval,
-                standard=standard,
-                due_timestamp=candles[-1].get("due_timestamp") or 0,
-            )
+                start_timestamp,
+                finish_timestamp,
+                contracts=contracts,
+            ))
+
+        records = self.query_records(start_timestamp, finish_timestamp, interval, contracts=contracts)
+        KlineFile.save(path, records, **self.records_meta(start_timestamp, finish_timestamp, interval, contracts))
+        return path
+
+    def query_records(
+            self,
+            start_timestamp: int,
+            finish_timestamp: int,
+            interval: str,
+            contracts: bool = False,
+    ) -> np.ndarray:
+        """Get the raw candles in [start_timestamp, finish_timestamp) as the CANDLE_DTYPE records. """
+        if contracts:
+            candles = [c for c in self.query_range_contracts(start_timestamp, finish_timestamp, interval)]
+            return KlineFrame.from_candles(candles).to_records()
+        return KlineFrame.concat([
+            f for f in self.query_frames(start_timestamp, finish_timestamp, interval)
+        ]).to_records()
+
+    def records_meta(self, start_timestamp: int, finish_timestamp: int, interval: str, contracts: bool = False) -> dict:
+        """The meta of the records, saved with the offline kline file or the shared kline segment. """
+        return {
+            "trade_type": self.trade_type,
+            "symbol": self.symbol,
+            "exchange": self.exchange,
+            "contract_type": self.contract_type,
+            "interval": interval,
+            "start_timestamp": start_timestamp,
+            "finish_timestamp": finish_timestamp,
+            "contracts": contracts,
+            "exported_timestamp": moment.now().millisecond_timestamp,
+        }
+
+    def import_file(self, path: str) -> int:
+        """Import an offline kline file into the local cache, return the count of the imported days.
+
+        Only the days fully covered by the file are imported, the contracts files can not be imported.
+        """
+        if self.cache is None:
+            raise RuntimeError("The kline file must be imported into the kline with cache_dir. ")
+        records, meta = KlineFile.load(path)
+        if meta["contracts"]:
+            raise RuntimeError("The contracts kline file can not be imported into the cache. ")
+        if (meta["trade_type"], meta["symbol"], meta["exchange"]) != (self.trade_type, self.symbol, self.exchange):
+            raise RuntimeError("The kline file does not belong to the kline", path)
+        if self.trade_type == TRADE_TYPE_FUTURE and meta["contract_type"] != self.contract_type:
+            raise RuntimeError("The kline file does not belong to the kline", path)
+
+        count = 0
+        for day_timestamp in KlineCache.days(meta["start_timestamp"], meta["finish_timestamp"]):
+            day_finish = day_timestamp + DAY_MILLISECONDS
+            if day_timestamp < meta["start_timestamp"] or day_finish > meta["finish_timestamp"]:
+                continue
+            lo, hi = np.searchsorted(records["timestamp"], [day_timestamp, day_finish])
+            self.cache.save(meta["interval"], day_timestamp, records[lo:hi], day_finish <= meta["exported_timestamp"])
+            count += 1
+        return count
+
+
+class KlineCursor(object):
+    """Resumable scan over the candles of one interval, for the successive stage calls of one instance.
+
+    The cursor keeps the open page stream of the kline and the buffered frames from its position, a
+    later scan at or after the position continues from the buffer and the same stream, so the
+    overlapping candles are not queried or standardised again. A scan before the position restarts
+    the stream. A frame is dropped from the buffer once the scan asks for the next one, since the
+    caller only seeks into the frame it stopped at. Call close() to release the stream.
+    """
+
+    def __init__(self, kline: Kline, interval: str = KLINE_INTERVAL_1MIN, standard: bool = True):
+        self._kline = kline
+        self.interval = interval
+        self.standard = standard
+        self.position = 0  # 缓存中第一根蜡烛不早于这个时间
+        self._buffer = []  # 从position开始连续的蜡烛
+        self._pages = None
+        self._loaded = 0  # 已经读取到的时间，不包含
+        self._stream_finish = 0
+
+    def seek(self, timestamp: int) -> None:
+        """Move the position to the timestamp, the buffered candles before it are dropped. """
+        if timestamp < self.position or timestamp > self._loaded:
+            # 往回移动，或者跳过了还没读取的蜡烛，都重新打开数据流。
+            self.close()
+            self._loaded = timestamp
+        else:
+            while self._buffer and self._buffer[0].timestamp[-1] < timestamp:
+                self._buffer.pop(0)
+            if self._buffer:
+                self._buffer[0] = self._buffer[0].between(timestamp, self._loaded)
+        self.position = timestamp
+
+    def close(self) -> None:
+        """Close the open page stream and drop the buffered candles. """
+        if self._pages is not None:
+            self._pages.close()
+        self._buffer = []
+        self._pages = None
+        self._loaded = self.position
+
+    def _release(self, frame: KlineFrame) -> None:
+        # 扫描过且没有停下的蜡烛不会再读取，position移到它后面
+        if self._buffer and self._buffer[0] is frame:
+            self._buffer.pop(0)
+            self.position = int(frame.timestamp[-1]) + 1
+
+    def _next_frame(self, finish_timestamp: int):
+        while self._loaded < finish_timestamp:
+            if self._pages is None:
+                self._stream_finish = finish_timestamp
+                self._pages = self._kline.query_frames(
+                    self._loaded,
+                    finish_timestamp,
+                    self.interval,
+                    standard=self.standard,
+                )
+            frame = next(self._pages, None)
+            if frame is None:
+                self._pages = None
+                self._loaded = self._stream_finish
+                continue
+            if len(frame) == 0:
+                continue
+            self._loaded = int(frame.timestamp[-1]) + 1
+            self._buffer.append(frame)
+            return frame
+        return None
+
+    def frames(self, start_timestamp: int, finish_timestamp: int):
+        """Yield the frames of the candles in [start_timestamp, finish_timestamp) from the start_timestamp.
+
+        The position moves to the start_timestamp, the frame the caller stops at stays in the buffer,
+        call seek() with the triggered candle timestamp to continue from it next time.
+        """
+        self.seek(start_timestamp)
+        for frame in list(self._buffer):
+            if frame.timestamp[-1] >= finish_timestamp:
+                yield frame.between(start_timestamp, finish_timestamp)
+                return
+            yield frame
+            self._release(frame)
+
+        while True:
+            frame = self._next_frame(finish_timestamp)
+            if frame is None:
+                return
+            if frame.timestamp[-1] >= finish_timestamp:
+                yield frame.between(start_timestamp, finish_timestamp)
+                return
+            yield frame
+            self._release(frame)
@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+
+from pyghostbt.tool.cache import CANDLE_DTYPE
+
+
+class KlineFile(object):
+    """Offline kline file, every column of the candles saved as one array of a compressed .npz file.
+
+    The file also keeps its meta: trade_type, symbol, exchange, contract_type, interval, the exported
+    range [start_timestamp, finish_timestamp) and whether it holds the candles of all the contracts.
+    """
+    __VERSION__ = 1
+    __NAME_FORMAT__ = "{trade_type}_{symbol}_{exchange}_{contract_type}_{interval}{contracts}_{start}_{finish}.npz"
+
+    @classmethod
+    def name(
+            cls,
+            trade_type: str,
+            symbol: str,
+            exchange: str,
+            contract_type: str,
+            interval: str,
+            start_timestamp: int,
+            finish_timestamp: int,
+            contracts: bool = False,
+    ) -> str:
+        return cls.__NAME_FORMAT__.format(
+            trade_type=trade_type,
+            symbol=symbol,
+            exchange=exchange,
+            contract_type=contract_type or "none",
+            interval=interval,
+            contracts="_contracts" if contracts else "",
+            start=start_timestamp,
+            finish=finish_timestamp,
+        )
+
+    @classmethod
+    def save(cls, path: str, records: np.ndarray, **meta) -> None:
+        meta["version"] = cls.__VERSION__
+        meta["rows"] = len(records)
+        columns = {key: np.ascontiguousarray(records[key]) for key in CANDLE_DTYPE.names}
+        # np.savez会在没有.npz后缀的文件名后面追加后缀，先写临时文件再替换。
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, meta=np.array(json.dumps(meta)), **columns)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load_meta(path: str) -> dict:
+        with np.load(path) as f:
+            return json.loads(str(f["meta"]))
+
+    @classmethod
+    def load(cls, path: str):
+        """Get (records, meta) of the file. """
+        with np.load(path) as f:
+            meta = json.loads(str(f["meta"]))
+            if meta.get("version") != cls.__VERSION__:
+                raise RuntimeError("unsupported kline file version", path)
+            records = np.zeros(meta["rows"], dtype=CANDLE_DTYPE)
+            for key in CANDLE_DTYPE.names:
+                records[key] = f[key]
+        return records, meta
+
+
+class KlineFileSource(object):
+    """Read the candles from the offline kline files of a directory instead of the database.
+
+    Only the files of the same trade_type, symbol, exchange and contract_type are used, a query must
+    be covered by the exported ranges, so the backtest never runs on the partial data silently.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            trade_type: str,
+            symbol: str,
+            exchange: str,
+            contract_type: str = None,
+    ):
+        self._directory = directory
+        self._key = (trade_type, symbol, exchange, contract_type or "none")
+        self._metas = None
+        self._records = {}
+
+    def _files(self, interval: str, contracts: bool) -> list:
+        if self._metas is None:
+            self._metas = {}
+            for name in sorted(os.listdir(self._directory)):
+                if not name.endswith(".npz"):
+                    continue
+                path = os.path.join(self._directory, name)
+                self._metas[path] = KlineFile.load_meta(path)
+
+        files = []
+        for path, meta in self._metas.items():
+            key = (meta["trade_type"], meta["symbol"], meta["exchange"], meta["contract_type"] or "none")
+            if key == self._key and meta["interval"] == interval and meta["contracts"] == contracts:
+                files.append((meta["start_timestamp"], meta["finish_timestamp"], path))
+        files.sort()
+        return files
+
+    def _load(self, path: str) -> np.ndarray:
+        if path not in self._records:
+            self._records[path], _ = KlineFile.load(path)
+        return self._records[path]
+
+    def records(self, start_timestamp: int, finish_timestamp: int, interval: str, contracts: bool = False):
+        """Get the candles in [start_timestamp, finish_timestamp) as the CANDLE_DTYPE records. """
+        parts = []
+        flag_timestamp = start_timestamp
+        for file_start, file_finish, path in self._files(interval, contracts):
+            if flag_timestamp >= finish_timestamp:
+                break
+            if file_finish <= flag_timestamp:
+                continue
+            if file_start > flag_timestamp:
+                break
+            records = self._load(path)
+            lo, hi = np.searchsorted(records["timestamp"], [flag_timestamp, min(file_finish, finish_timestamp)])
+            parts.append(records[lo:hi])
+            flag_timestamp = file_finish
+
+        if flag_timestamp < finish_timestamp:
+            raise RuntimeError(
+                "the offline kline files do not cover the range",
+                self._key, interval, start_timestamp, finish_timestamp,
+            )
+        if len(parts) == 0:
+            return np.zeros(0, dtype=CANDLE_DTYPE)
+        return np.concatenate(parts)
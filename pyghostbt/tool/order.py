@@ -1,5 +1,6 @@
 from jsonschema import validate
-from pyanalysis.mysql import Conn
+from pyghostbt.tool.storage import connect
+from pyghostbt.tool.storage import upsert
 from pyanalysis.moment import moment
 from pyghostbt.const import *
 from pyghostbt.util import real_number
@@ -115,48 +116,32 @@ class CommonOrder(dict):
             # 检验参数可用性
             validate(instance=self, schema=order_input)
 
-        conn = Conn(self._db_name)
-        one = conn.query_one(
-            "SELECT id FROM {} WHERE instance_id = ? AND sequence = ?".format(self._table_name),
-            (self["instance_id"], self["sequence"]),
-        )
-
-        if one:
-            conn.execute(
-                "UPDATE {} SET place_type = ?, `type` = ?, price = ?, amount = ?,"
-                " avg_price = ?, deal_amount = ?, status = ?, lever = ?, fee = ?,"
-                " symbol = ?, exchange = ?, unit_amount = ?, place_timestamp = ?, place_datetime = ?,"
-                " deal_timestamp = ?, deal_datetime = ?, swap_timestamp = ?, swap_datetime = ?,"
-                " cancel_timestamp = ?, cancel_datetime = ?, raw_order_data = ?, raw_market_data = ?"
-                " WHERE instance_id = ? AND sequence = ?".format(self._table_name),
-                (
-                    self["place_type"], self["type"], self["price"], self["amount"],
-                    self["avg_price"], self["deal_amount"], self["status"], self["lever"], self["fee"],
-                    self["symbol"], self["exchange"], self["unit_amount"], self["place_timestamp"], self["place_datetime"],
-                    self["deal_timestamp"], self["deal_datetime"], self["swap_timestamp"], self["swap_datetime"],
-                    self["cancel_timestamp"], self["cancel_datetime"], raw_order_data, raw_market_data,
-                    self["instance_id"], self["sequence"],
-                ),
-            )
-        else:
-            conn.insert(
-                "INSERT INTO {} (instance_id, sequence, place_type, `type`, price,"
-                " amount, avg_price, deal_amount, status, lever,"
-                " fee, symbol, exchange, unit_amount, place_timestamp, place_datetime, deal_timestamp, deal_datetime,"
-                " cancel_timestamp, cancel_datetime, raw_order_data, raw_market_data) VALUES"
-                " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(
-                    self._table_name,
-                ),
-                (
-                    self["instance_id"], self["sequence"], self["place_type"], self["type"], self["price"],
-                    self["amount"], self["avg_price"], self["deal_amount"], self["status"], self["lever"],
-                    self["fee"], self["symbol"], self["exchange"], self["unit_amount"],
-                    self["place_timestamp"], self["place_datetime"], self["deal_timestamp"], self["deal_datetime"],
-                    self["cancel_timestamp"], self["cancel_datetime"],
-                    raw_order_data, raw_market_data,
-                ),
-            )
-
+        upsert(self._db_name, self._table_name, [{
+            "instance_id": self["instance_id"],
+            "sequence": self["sequence"],
+            "place_type": self["place_type"],
+            "type": self["type"],
+            "price": self["price"],
+            "amount": self["amount"],
+            "avg_price": self["avg_price"],
+            "deal_amount": self["deal_amount"],
+            "status": self["status"],
+            "lever": self["lever"],
+            "fee": self["fee"],
+            "symbol": self["symbol"],
+            "exchange": self["exchange"],
+            "unit_amount": self["unit_amount"],
+            "place_timestamp": self["place_timestamp"],
+            "place_datetime": self["place_datetime"],
+            "deal_timestamp": self["deal_timestamp"],
+            "deal_datetime": self["deal_datetime"],
+            "cancel_timestamp": self["cancel_timestamp"],
+            "cancel_datetime": self["cancel_datetime"],
+            "raw_order_data": raw_order_data,
+            "raw_market_data": raw_market_data,
+        }], unique_key=("instance_id", "sequence"))
+
+        conn = connect(self._db_name)
         orders = conn.query(
             "SELECT * FROM {} WHERE instance_id = ? ORDER BY sequence".format(self._table_name),
             (self["instance_id"],),
@@ -378,55 +363,39 @@ class FutureOrder(CommonOrder):
             validate(instance=self, schema=future_order_init)
             validate(instance=self, schema=future_order_save)
 
-        conn = Conn(self._db_name)
-        one = conn.query_one(
-            "SELECT id FROM {} WHERE instance_id = ? AND sequence = ?".format(self._table_name),
-            (self["instance_id"], self["sequence"]),
-        )
-
-        if one:
-            conn.execute(
-                "UPDATE {} SET place_type = ?, `type` = ?, price = ?, amount = ?,"
-                " avg_price = ?, deal_amount = ?, status = ?, lever = ?, fee = ?,"
-                " symbol = ?, exchange = ?, contract_type = ?, unit_amount = ?, "
-                " place_timestamp = ?, place_datetime = ?, deal_timestamp = ?, deal_datetime = ?,"
-                " due_timestamp = ?, due_datetime = ?, swap_timestamp = ?, swap_datetime = ?,"
-                " cancel_timestamp = ?, cancel_datetime = ?, raw_order_data = ?, raw_market_data = ?"
-                " WHERE instance_id = ? AND sequence = ?".format(self._table_name),
-                (
-                    self["place_type"], self["type"], self["price"], self["amount"],
-                    self["avg_price"], self["deal_amount"], self["status"], self["lever"], self["fee"],
-                    self["symbol"], self["exchange"], self["contract_type"], self["unit_amount"],
-                    self["place_timestamp"], self["place_datetime"], self["deal_timestamp"], self["deal_datetime"],
-                    self["due_timestamp"], self["due_datetime"], self["swap_timestamp"], self["swap_datetime"],
-                    self["cancel_timestamp"], self["cancel_datetime"], raw_order_data, raw_market_data,
-                    self["instance_id"], self["sequence"],
-                ),
-            )
-        else:
-            conn.insert(
-                "INSERT INTO {} (instance_id, sequence, place_type, `type`, price,"
-                " amount, avg_price, deal_amount, status, lever,"
-                " fee, symbol, exchange, contract_type, unit_amount,"
-                " place_timestamp, place_datetime, deal_timestamp, deal_datetime,"
-                " due_timestamp, due_datetime, swap_timestamp, swap_datetime,"
-                " cancel_timestamp, cancel_datetime, raw_order_data, raw_market_data) VALUES"
-                " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(
-                    self._table_name,
-                ),
-                (
-                    self["instance_id"], self["sequence"], self["place_type"], self["type"], self["price"],
-                    self["amount"], self["avg_price"], self["deal_amount"], self["status"], self["lever"],
-                    self["fee"], self["symbol"], self["exchange"], self["contract_type"], self["unit_amount"],
-                    self["place_timestamp"], self["place_datetime"], self["deal_timestamp"], self["deal_datetime"],
-                    self["due_timestamp"], self["due_datetime"], self["swap_timestamp"], self["swap_datetime"],
-                    self["cancel_timestamp"], self["cancel_datetime"], raw_order_data, raw_market_data,
-                ),
-            )
+        upsert(self._db_name, self._table_name, [{
+            "instance_id": self["instance_id"],
+            "sequence": self["sequence"],
+            "place_type": self["place_type"],
+            "type": self["type"],
+            "price": self["price"],
+            "amount": self["amount"],
+            "avg_price": self["avg_price"],
+            "deal_amount": self["deal_amount"],
+            "status": self["status"],
+            "lever": self["lever"],
+            "fee": self["fee"],
+            "symbol": self["symbol"],
+            "exchange": self["exchange"],
+            "contract_type": self["contract_type"],
+            "unit_amount": self["unit_amount"],
+            "place_timestamp": self["place_timestamp"],
+            "place_datetime": self["place_datetime"],
+            "deal_timestamp": self["deal_timestamp"],
+            "deal_datetime": self["deal_datetime"],
+            "due_timestamp": self["due_timestamp"],
+            "due_datetime": self["due_datetime"],
+            "swap_timestamp": self["swap_timestamp"],
+            "swap_datetime": self["swap_datetime"],
+            "cancel_timestamp": self["cancel_timestamp"],
+            "cancel_datetime": self["cancel_datetime"],
+            "raw_order_data": raw_order_data,
+            "raw_market_data": raw_market_data,
+        }], unique_key=("instance_id", "sequence"))
         self.__update_instance()
 
     def __update_instance(self):
-        conn = Conn(self._db_name)
+        conn = connect(self._db_name)
         orders = conn.query(
             "SELECT * FROM {} WHERE instance_id = ? ORDER BY sequence".format(self._table_name),
             (self["instance_id"],),
@@ -1,5 +1,6 @@
 from jsonschema import validate
-from pyanalysis.mysql import *
+from pyghostbt.tool.storage import connect
+from pyghostbt.tool.storage import upsert
 from pyghostbt.const import *
 
 
@@ -88,7 +89,7 @@ class Param(dict):
             self[param_name] = param[param_name]
 
     def load(self, instance_id):
-        conn = Conn(self._db_name)
+        conn = connect(self._db_name)
         results = conn.query(
             "SELECT * FROM {} WHERE instance_id = ?".format(self._table_name),
             (instance_id,),
@@ -107,28 +108,18 @@ class Param(dict):
         # 入库前保证属性没有被篡改
         validate(instance=self, schema=param_input)
 
-        conn = Conn(self._db_name)
+        rows = []
         for param_name in self:
             if isinstance(self[param_name], int):
-                sql_param = (PARAM_TYPE_INTEGER, str(self[param_name]), instance_id, param_name)
+                param_type, param_value = PARAM_TYPE_INTEGER, str(self[param_name])
             elif isinstance(self[param_name], float):
-                sql_param = (PARAM_TYPE_FLOAT, str(self[param_name]), instance_id, param_name)
+                param_type, param_value = PARAM_TYPE_FLOAT, str(self[param_name])
             else:
-                sql_param = (PARAM_TYPE_STRING, self[param_name], instance_id, param_name)
-            one = conn.query_one(
-                "SELECT * FROM {} WHERE instance_id = ? AND param_name = ?".format(self._table_name),
-                (instance_id, param_name)
-            )
-
-            if one:
-                conn.execute(
-                    "UPDATE {} SET param_type = ?, param_value = ?"
-                    " WHERE instance_id = ? AND param_name = ?".format(self._table_name),
-                    sql_param,
-                )
-            else:
-                conn.insert(
-                    "INSERT INTO {} (param_type, param_value, instance_id, param_name)"
-                    " VALUES (?, ?, ?, ?)".format(self._table_name),
-                    sql_param
-                )
+                param_type, param_value = PARAM_TYPE_STRING, self[param_name]
+            rows.append({
+                "instance_id": instance_id,
+                "param_name": param_name,
+                "param_type": param_type,
+                "param_value": param_value,
+            })
+        upsert(self._db_name, self._table_name, rows, unique_key=("instance_id", "param_name"))
@@ -0,0 +1,77 @@
+import numpy as np
+
+from pyghostbt.tool.kline import KlineFrame
+
+
+class MaxTree(object):
+    """Segment tree of the max values, find the first value over a bound in O(log n). """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.n = len(values)
+        self.size = 1
+        while self.size < max(self.n, 1):
+            self.size *= 2
+
+        pad = -np.inf if values.dtype.kind == "f" else np.iinfo(np.int64).min
+        self._tree = np.full(2 * self.size, pad, dtype=np.float64 if values.dtype.kind == "f" else np.int64)
+        self._tree[self.size:self.size + self.n] = values
+        # 自底向上逐层计算，每一层是下一层两两取最大值。
+        width = self.size
+        while width > 1:
+            half = width // 2
+            self._tree[half:width] = np.maximum(self._tree[width:2 * width:2], self._tree[width + 1:2 * width:2])
+            width = half
+
+    def first_over(self, bound, lo: int = 0) -> int:
+        """The first index i >= lo with values[i] > bound, -1 if none. """
+        if lo >= self.n:
+            return -1
+        tree, size = self._tree, self.size
+        i = lo + size
+        while True:
+            if tree[i] > bound:
+                while i < size:
+                    i = 2 * i if tree[2 * i] > bound else 2 * i + 1
+                return i - size
+            # 向上找到下一个紧邻的右侧节点。
+            while i & 1:
+                i >>= 1
+            if i == 0:
+                return -1
+            i += 1
+
+
+class FirstPassageIndex(object):
+    """First passage index over the candles, answer when high first exceeds or low first goes below a price.
+
+    The low prices are negated, so one kind of max tree answers both of the directions.
+    """
+
+    def __init__(self, frame: KlineFrame, start_timestamp: int, finish_timestamp: int):
+        self.frame = frame
+        # 加载蜡烛的范围 [start_timestamp, finish_timestamp)
+        self.start_timestamp = start_timestamp
+        self.finish_timestamp = finish_timestamp
+        self._high = MaxTree(frame.high)
+        self._low = MaxTree(-frame.low)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def index(self, timestamp: int) -> int:
+        """The index of the first candle at or after the timestamp. """
+        return int(np.searchsorted(self.frame.timestamp, timestamp))
+
+    def covers(self, start_timestamp: int, finish_timestamp: int) -> bool:
+        return self.start_timestamp <= start_timestamp and finish_timestamp <= self.finish_timestamp
+
+    def first_above(self, price, lo: int = 0, hi: int = None) -> int:
+        """The first index in [lo, hi) with high > price, -1 if none. """
+        i = self._high.first_over(price, lo)
+        return i if 0 <= i < (len(self) if hi is None else hi) else -1
+
+    def first_below(self, price, lo: int = 0, hi: int = None) -> int:
+        """The first index in [lo, hi) with low < price, -1 if none. """
+        i = self._low.first_over(-price, lo)
+        return i if 0 <= i < (len(self) if hi is None else hi) else -1
@@ -0,0 +1,92 @@
+import numpy as np
+
+from pyanalysis.moment import moment
+from pyghostbt.tool.kline import Kline
+from pyghostbt.tool.cache import CANDLE_DTYPE
+from pyghostbt.const import *
+
+PYRAMID_INTERVALS = (
+    KLINE_INTERVAL_15MIN,
+    KLINE_INTERVAL_1HOUR,
+    KLINE_INTERVAL_4HOUR,
+    KLINE_INTERVAL_1DAY,
+    KLINE_INTERVAL_1WEEK,
+)
+
+
+class KlinePyramid(object):
+    """Materialize the higher interval candles from the 1min candles into the local kline cache.
+
+    The buckets are aligned to the Asia/Shanghai calendar, the week starts at monday, and every
+    candle is labeled with its bucket start timestamp. Each interval is saved as one sorted series,
+    so the Kline with the same cache_dir reads a range of it with one binary search.
+    """
+    __UTC_OFFSET__ = 8 * 60 * 60 * 1000  # Asia/Shanghai
+    __WEEK_ANCHOR__ = 4 * 24 * 60 * 60 * 1000  # 1970-01-05 is monday
+
+    def __init__(self, kline: Kline, intervals: tuple = PYRAMID_INTERVALS):
+        if kline.cache is None:
+            raise RuntimeError("The pyramid must be built on the kline with cache_dir. ")
+        for interval in intervals:
+            if interval not in INTERVAL_MILLISECONDS or interval == KLINE_INTERVAL_1MIN:
+                raise RuntimeError("can not build the interval", interval)
+
+        self._kline = kline
+        self._intervals = intervals
+
+    def floor(self, timestamp: int, interval: str) -> int:
+        """The start timestamp of the bucket which the timestamp belongs to. """
+        num = INTERVAL_MILLISECONDS[interval]
+        shift = self.__UTC_OFFSET__ - (self.__WEEK_ANCHOR__ if interval == KLINE_INTERVAL_1WEEK else 0)
+        return (timestamp + shift) // num * num - shift
+
+    def ceil(self, timestamp: int, interval: str) -> int:
+        floor_timestamp = self.floor(timestamp, interval)
+        if floor_timestamp == timestamp:
+            return timestamp
+        return floor_timestamp + INTERVAL_MILLISECONDS[interval]
+
+    @staticmethod
+    def __merge_ranges(ranges: list) -> list:
+        merged = []
+        for start_timestamp, finish_timestamp in sorted(ranges):
+            if merged and start_timestamp <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], finish_timestamp)
+            else:
+                merged.append([start_timestamp, finish_timestamp])
+        return merged
+
+    def refresh(self, start_timestamp: int, finish_timestamp: int) -> None:
+        """Rebuild the buckets touched by the 1min candles in [start_timestamp, finish_timestamp). """
+        bounds = {}
+        for interval in self._intervals:
+            bounds[interval] = (
+                self.floor(start_timestamp, interval),
+                self.ceil(finish_timestamp, interval),
+            )
+
+        # 所有周期需要的1min蜡烛只读取一次。
+        frame = self._kline.query_frame(
+            min([b[0] for b in bounds.values()]),
+            max([b[1] for b in bounds.values()]),
+            KLINE_INTERVAL_1MIN,
+        )
+        now_timestamp = moment.now().millisecond_timestamp
+        for interval in self._intervals:
+            bucket_start, bucket_finish = bounds[interval]
+            edges = np.arange(bucket_start, bucket_finish + 1, INTERVAL_MILLISECONDS[interval], dtype=np.int64)
+            bars = frame.resample(edges).to_records()
+
+            records, ranges = self._kline.cache.load_series(interval)
+            if records is None:
+                records, ranges = np.zeros(0, dtype=CANDLE_DTYPE), []
+            kept = records[(records["timestamp"] < bucket_start) | (records["timestamp"] >= bucket_finish)]
+            merged = np.concatenate([kept, bars])
+            merged = merged[np.argsort(merged["timestamp"], kind="stable")]
+            del records, kept
+
+            # 还没结束的一组不算作已覆盖，读取时回到数据库，下次refresh时重新计算。
+            covered_finish = min(bucket_finish, self.floor(now_timestamp, interval))
+            if covered_finish > bucket_start:
+                ranges = self.__merge_ranges(ranges + [[bucket_start, covered_finish]])
+            self._kline.cache.save_series(interval, merged, ranges)
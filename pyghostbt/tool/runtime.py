@@ -1,6 +1,7 @@
 from pyghostbt.tool.kline import Kline
 from pyghostbt.tool.factor import Factor
 from pyghostbt.tool.signal import Signal
+from pyghostbt.tool import storage
 from pyghostbt.util import uuid
 from pyghostbt.const import *
 from jsonschema import validate
@@ -64,7 +65,26 @@ runtime_input = {
                 KLINE_INTERVAL_1DAY,
                 KLINE_INTERVAL_1WEEK,
             ],
-        }
+        },
+        "backtest_storage": {
+            "type": ["null", "string"],
+            "enum": [None, STORAGE_MYSQL, STORAGE_MEMORY],
+        },
+        "backtest_buffer_rows": {
+            "type": ["null", "integer"],
+            "minimum": 1,
+        },
+        "backtest_buffer_seconds": {
+            "type": ["null", "number"],
+            "minimum": 0,
+        },
+        "backtest_checkpoint_dir": {
+            "type": ["null", "string"],
+        },
+        "backtest_checkpoint_interval": {
+            "type": ["null", "integer"],
+            "minimum": 0,
+        },
     }
 }
 
@@ -77,12 +97,38 @@ class Runtime(dict):
             if self.get("mode") == MODE_BACKTEST:
                 self.__setitem__("backtest_id", uuid())
 
+        # 回测表所在的数据库
+        self._storage_db_names = sorted(set([
+            self.get("db_name"),
+            self.get("db_name_asset") or self.get("db_name"),
+            self.get("db_name_param") or self.get("db_name"),
+        ]))
+        self._memory_storages = {}  # 只在memory_scope()中使用
+        if self.get("backtest_storage") == STORAGE_MEMORY:
+            if self.get("mode") != MODE_BACKTEST:
+                raise RuntimeError("Only backtest mode can keep the data in memory. ")
+        if self.get("backtest_buffer_rows"):
+            if self.get("mode") != MODE_BACKTEST:
+                raise RuntimeError("Only backtest mode can buffer the writes. ")
+            for db_name in self._storage_db_names:
+                storage.use_write_buffer(
+                    db_name,
+                    max_rows=self.get("backtest_buffer_rows"),
+                    max_seconds=self.get("backtest_buffer_seconds") or 5.0,
+                )
+
         self._kline = Kline(
             trade_type=self.get("trade_type"),
             symbol=self.get("symbol"),
             exchange=self.get("exchange"),
             contract_type=self.get("contract_type"),
             db_name=self.get("db_name_kline") or self.get("db_name"),
+            page_size=self.get("kline_page_size"),
+            cache_dir=self.get("kline_cache_dir"),
+            prefetch=self.get("kline_prefetch"),
+            lru_rows=self.get("kline_lru_rows"),
+            offline_dir=self.get("kline_offline_dir"),
+            shared=self.get("kline_shared"),
         )
 
         self._factor = Factor(
@@ -100,6 +146,17 @@ class Runtime(dict):
             db_name=self.get("db_name_kline") or self.get("db_name"),
         )
 
+    def memory_scope(self):
+        """The with block keeping the backtest tables in memory when the backtest_storage is memory.
+
+        Run the backtest inside the block, e.g. with backtest.memory_scope(): backtest.run(...), the
+        backtests created in the block share its storages. The connections outside the block, or of
+        the other runtimes, are not affected.
+        """
+        if self.get("backtest_storage") == STORAGE_MEMORY and not self._memory_storages:
+            self._memory_storages = {db_name: storage.MemoryStorage(db_name) for db_name in self._storage_db_names}
+        return storage.scope(self._memory_storages)
+
 # class StrategyRuntime(Runtime):
 #     def __init__(self, kw):
 #         super().__init__(kw)
@@ -0,0 +1,115 @@
+import numpy as np
+
+from multiprocessing import shared_memory
+from pyghostbt.tool.cache import CANDLE_DTYPE
+
+
+class SharedKline(object):
+    """The candles of a range in one shared memory segment, every column stored as one contiguous array.
+
+    The creator process copies the candles in once, the other processes attach to the segment by its
+    spec and read the columns through the read-only numpy views, so N processes hold one copy of the
+    candles. The spec is a small dict, it can be passed to the worker processes in the config.
+    """
+
+    def __init__(self, spec: dict, shm: shared_memory.SharedMemory = None):
+        self.spec = spec
+        self._owner = shm is not None
+        if shm is None:
+            shm = self.__attach(spec["name"])
+        self._shm = shm
+
+        rows = spec["rows"]
+        self.columns = {}
+        for i, key in enumerate(CANDLE_DTYPE.names):
+            column = np.ndarray(
+                (rows,),
+                dtype=CANDLE_DTYPE.fields[key][0],
+                buffer=shm.buf,
+                offset=i * rows * 8,
+            )
+            if not self._owner:
+                column.flags.writeable = False
+            self.columns[key] = column
+
+    @staticmethod
+    def __attach(name: str) -> shared_memory.SharedMemory:
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python3.13以前没有track参数，进程池的子进程和创建者共用同一个resource_tracker，不会提前删除。
+            return shared_memory.SharedMemory(name=name)
+
+    @classmethod
+    def create(cls, records: np.ndarray, **meta):
+        """Copy the CANDLE_DTYPE records into a new segment, meta is the same as the offline kline file. """
+        # 每列 rows * 8 字节，按CANDLE_DTYPE的顺序依次排列。
+        shm = shared_memory.SharedMemory(create=True, size=max(len(records) * CANDLE_DTYPE.itemsize, 1))
+        spec = dict(meta, name=shm.name, rows=len(records))
+        shared = cls(spec, shm=shm)
+        for key in CANDLE_DTYPE.names:
+            shared.columns[key][:] = records[key]
+        return shared
+
+    def __len__(self):
+        return self.spec["rows"]
+
+    def between(self, start_timestamp: int, finish_timestamp: int) -> dict:
+        """The column views of the candles in [start_timestamp, finish_timestamp). """
+        lo, hi = np.searchsorted(self.columns["timestamp"], [start_timestamp, finish_timestamp])
+        return {key: column[lo:hi] for key, column in self.columns.items()}
+
+    def close(self) -> None:
+        self.columns = {}
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """Remove the segment, only the creator should call it after all the processes finished. """
+        self.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class SharedKlineSource(object):
+    """Read the candles from the shared kline segments instead of the database.
+
+    The same interface as KlineFileSource, a query must be covered by one of the segments.
+    """
+
+    def __init__(
+            self,
+            specs: list,
+            trade_type: str,
+            symbol: str,
+            exchange: str,
+            contract_type: str = None,
+    ):
+        key = (trade_type, symbol, exchange, contract_type or "none")
+        self._key = key
+        self._specs = [
+            s for s in specs
+            if (s["trade_type"], s["symbol"], s["exchange"], s["contract_type"] or "none") == key
+        ]
+        self._segments = {}
+
+    def _segment(self, spec: dict) -> SharedKline:
+        if spec["name"] not in self._segments:
+            self._segments[spec["name"]] = SharedKline(spec)
+        return self._segments[spec["name"]]
+
+    def records(self, start_timestamp: int, finish_timestamp: int, interval: str, contracts: bool = False) -> dict:
+        """Get the column views of the candles in [start_timestamp, finish_timestamp). """
+        for spec in self._specs:
+            if spec["interval"] != interval or spec["contracts"] != contracts:
+                continue
+            if spec["start_timestamp"] <= start_timestamp and finish_timestamp <= spec["finish_timestamp"]:
+                return self._segment(spec).between(start_timestamp, finish_timestamp)
+        raise RuntimeError(
+            "the shared kline segments do not cover the range",
+            self._key, interval, start_timestamp, finish_timestamp,
+        )
+
+    def close(self) -> None:
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
@@ -0,0 +1,448 @@
+import re
+import time
+import sqlite3
+import threading
+import contextvars
+
+from contextlib import contextmanager
+from pyanalysis.mysql import Conn
+
+# 回测过程中可以放在内存中的表，{trade_type}_{kind}_backtest
+MEMORY_TABLE_KINDS = ("instance", "order", "param", "indices", "account_flow", "asset")
+
+_TABLE_PATTERN = re.compile(r"(?:FROM|INTO|(?<!KEY )UPDATE|JOIN)\s+`?(\w+)`?", re.IGNORECASE)
+_MEMORY_TABLE_PATTERN = re.compile(r"^[a-z]+_({})_backtest$".format("|".join(MEMORY_TABLE_KINDS)))
+_ON_DUPLICATE_PATTERN = re.compile(r"ON DUPLICATE KEY UPDATE", re.IGNORECASE)
+
+# 当前with storage.scope()中的内存表，只影响在其中运行的代码
+_scoped_storages = contextvars.ContextVar("scoped_storages", default={})
+_buffers = {}
+_storages_lock = threading.Lock()
+
+
+def table_names(sql: str) -> list:
+    return _TABLE_PATTERN.findall(sql)
+
+
+def upsert_sql(table_name: str, columns: list, count: int, unique_key: tuple = ()) -> str:
+    """The multi-row INSERT of count rows, the rows with the same unique key are updated. """
+    sql = "INSERT INTO {} ({}) VALUES ".format(table_name, ", ".join(["`{}`".format(c) for c in columns]))
+    sql += ", ".join(["({})".format(", ".join(["?"] * len(columns)))] * count)
+    update_columns = [c for c in columns if c not in unique_key]
+    if unique_key and update_columns:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(["`{c}` = VALUES(`{c}`)".format(c=c) for c in update_columns])
+    return sql
+
+
+class MemoryStorage(object):
+    """In-memory sqlite copy of the backtest tables of one database.
+
+    The tables are created on the first use with the columns and the unique keys read from the
+    information_schema of the MySQL database, so the same SQL runs against them. An instance is
+    inserted into MySQL at once to reserve its id, the memory row uses the same id, so the strategy,
+    the checkpoints and MySQL see the same instance ids. The other inserted and updated rows are
+    recorded, flush() writes them to MySQL in bulk, the rows of the tables written by upsert() are
+    updated by the unique key passed to it. The SQL runs as sqlite SQL, e.g. the division of two
+    integers is an integer division.
+    """
+    __FLUSH_BATCH_SIZE__ = 500
+
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("CREATE TABLE _dirty_rows (table_name TEXT, id INTEGER, PRIMARY KEY (table_name, id))")
+        self._columns = {}  # table name -> column names
+        self._unique_keys = {}  # table name -> the unique key passed to upsert()
+
+    @staticmethod
+    def is_memory_table(table_name: str) -> bool:
+        return _MEMORY_TABLE_PATTERN.match(table_name) is not None
+
+    @staticmethod
+    def is_instance_table(table_name: str) -> bool:
+        return table_name.endswith("_instance_backtest")
+
+    def _create_table(self, table_name: str) -> None:
+        conn = Conn(self.db_name)
+        columns = conn.query(
+            "SELECT COLUMN_NAME, DATA_TYPE, COLUMN_DEFAULT FROM information_schema.COLUMNS"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? ORDER BY ORDINAL_POSITION",
+            (table_name,),
+        )
+        if len(columns) == 0:
+            raise RuntimeError("the table does not exist", self.db_name, table_name)
+        unique_keys = conn.query(
+            "SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()"
+            " AND TABLE_NAME = ? AND NON_UNIQUE = 0 AND INDEX_NAME <> 'PRIMARY' ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+            (table_name,),
+        )
+
+        definitions = []
+        for column in columns:
+            name, data_type, default = column["COLUMN_NAME"], column["DATA_TYPE"].lower(), column["COLUMN_DEFAULT"]
+            if name == "id":
+                definitions.append("`id` INTEGER PRIMARY KEY AUTOINCREMENT")
+                continue
+            if data_type.endswith("int"):
+                affinity = "INTEGER"
+            elif data_type in ("decimal", "float", "double"):
+                affinity = "REAL"
+            else:
+                affinity = "TEXT"
+            definition = "`{}` {}".format(name, affinity)
+            if default is not None:
+                if default.upper().startswith("CURRENT_TIMESTAMP"):
+                    definition += " DEFAULT (datetime('now', 'localtime'))"
+                else:
+                    definition += " DEFAULT '{}'".format(default.strip("'").replace("'", "''"))
+            definitions.append(definition)
+
+        keys = {}
+        for key in unique_keys:
+            keys.setdefault(key["INDEX_NAME"], []).append(key["COLUMN_NAME"])
+        for key_columns in keys.values():
+            definitions.append("UNIQUE ({})".format(", ".join(["`{}`".format(c) for c in key_columns])))
+
+        self._db.execute("CREATE TABLE `{}` ({})".format(table_name, ", ".join(definitions)))
+        # upsert的冲突处理会覆盖触发器中的 OR IGNORE，所以先判断是否已经记录。
+        for event in ("INSERT", "UPDATE"):
+            self._db.execute(
+                "CREATE TRIGGER `{table}_{event}` AFTER {event} ON `{table}` BEGIN"
+                " INSERT INTO _dirty_rows SELECT '{table}', NEW.id WHERE NOT EXISTS"
+                " (SELECT 1 FROM _dirty_rows WHERE table_name = '{table}' AND id = NEW.id); END".format(
+                    table=table_name,
+                    event=event.lower(),
+                )
+            )
+        self._columns[table_name] = [c["COLUMN_NAME"] for c in columns]
+
+    def _prepare(self, sql: str) -> str:
+        if _ON_DUPLICATE_PATTERN.search(sql):
+            raise RuntimeError("the upsert of the memory table must use upsert() with its unique key", sql)
+        for table_name in table_names(sql):
+            if table_name not in self._columns:
+                self._create_table(table_name)
+        return sql
+
+    def query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return [dict(r) for r in self._db.execute(self._prepare(sql), params).fetchall()]
+
+    def insert(self, sql: str, params=()) -> int:
+        with self._lock:
+            cursor = self._db.execute(self._prepare(sql), params)
+            names = table_names(sql)
+            if len(names) == 0 or not self.is_instance_table(names[0]):
+                return cursor.lastrowid
+
+            # 先在MySQL中插入得到id，内存中的行改用同样的id，写入的行不用再写一次。
+            table_name, row_id = names[0], Conn(self.db_name).insert(sql, params)
+            self._db.execute("UPDATE `{}` SET id = ? WHERE id = ?".format(table_name), (row_id, cursor.lastrowid))
+            self._db.execute(
+                "DELETE FROM _dirty_rows WHERE table_name = ? AND id IN (?, ?)",
+                (table_name, cursor.lastrowid, row_id),
+            )
+            return row_id
+
+    def upsert(self, table_name: str, columns: list, count: int, params: tuple, unique_key: tuple = ()) -> int:
+        """The upsert_sql() of sqlite, the rows conflicting on the unique_key are updated. """
+        with self._lock:
+            self._prepare("INSERT INTO {}".format(table_name))
+            sql = upsert_sql(table_name, columns, count)
+            update_columns = [c for c in columns if c not in unique_key]
+            if unique_key and update_columns:
+                self._unique_keys[table_name] = tuple(unique_key)
+                sql += " ON CONFLICT ({}) DO UPDATE SET {}".format(
+                    ", ".join(["`{}`".format(c) for c in unique_key]),
+                    ", ".join(["`{c}` = excluded.`{c}`".format(c=c) for c in update_columns]),
+                )
+            return self._db.execute(sql, params).rowcount
+
+    def execute(self, sql: str, params=()) -> int:
+        with self._lock:
+            cursor = self._db.execute(self._prepare(sql), params)
+            return cursor.rowcount
+
+    def flush(self) -> int:
+        """Write the inserted and updated rows into MySQL, return the count of the written rows. """
+        with self._lock:
+            conn = Conn(self.db_name)
+            count = 0
+            for table_name in self._columns:
+                rows = self._db.execute(
+                    "SELECT t.* FROM `{}` t JOIN _dirty_rows d ON d.table_name = ? AND d.id = t.id"
+                    " ORDER BY t.id".format(table_name),
+                    (table_name,),
+                ).fetchall()
+                if len(rows) == 0:
+                    continue
+                rows = [dict(r) for r in rows]
+                columns = [c for c in self._columns[table_name] if c not in ("id", "create_at", "update_at")]
+
+                if self.is_instance_table(table_name):
+                    self._flush_instances(conn, table_name, columns, rows)
+                else:
+                    self._flush_rows(conn, table_name, columns, rows)
+
+                self._db.execute("DELETE FROM _dirty_rows WHERE table_name = ?", (table_name,))
+                count += len(rows)
+            self._db.commit()
+            return count
+
+    @staticmethod
+    def _flush_instances(conn: Conn, table_name: str, columns: list, rows: list) -> None:
+        # instance在插入时已经写入MySQL，id相同
+        for row in rows:
+            conn.execute(
+                "UPDATE {} SET {} WHERE id = ?".format(
+                    table_name,
+                    ", ".join(["`{}` = ?".format(c) for c in columns]),
+                ),
+                tuple([row[c] for c in columns]) + (row["id"],),
+            )
+
+    def _flush_rows(self, conn: Conn, table_name: str, columns: list, rows: list) -> None:
+        # upsert()写入的表，之前写入过的行按它的唯一键更新；其他的表只会追加。
+        for i in range(0, len(rows), self.__FLUSH_BATCH_SIZE__):
+            batch = rows[i:i + self.__FLUSH_BATCH_SIZE__]
+            params = []
+            for row in batch:
+                params.extend([row[c] for c in columns])
+            conn.execute(upsert_sql(table_name, columns, len(batch), self._unique_keys.get(table_name, ())),
+                         tuple(params))
+
+
+class WriteBuffer(object):
+    """Write-behind buffer of the upserted rows of one database.
+
+    The rows with the same unique key are coalesced, and written as the multi-row upserts when the
+    buffer holds max_rows rows, when the oldest row waited max_seconds, or when flush() is called.
+    A read of a table flushes the rows of the table first, so the run always reads its own writes.
+    """
+    __FLUSH_BATCH_SIZE__ = 500
+
+    def __init__(self, db_name: str, max_rows: int = 1000, max_seconds: float = 5.0):
+        self.db_name = db_name
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self._lock = threading.RLock()
+        self._pending = {}  # table name -> {key: row}
+        self._unique_keys = {}  # table name -> unique key columns
+        self._rows = 0
+        self._first_timestamp = 0.0
+        self._sequence = 0  # 没有唯一键的行的key
+
+    def add(self, table_name: str, rows: list, unique_key: tuple = ()) -> None:
+        with self._lock:
+            pending = self._pending.setdefault(table_name, {})
+            self._unique_keys[table_name] = tuple(unique_key)
+            if self._rows == 0:
+                self._first_timestamp = time.time()
+            for row in rows:
+                if unique_key:
+                    key = tuple([row[c] for c in unique_key])
+                else:
+                    key = self._sequence
+                    self._sequence += 1
+                if key in pending:
+                    pending[key].update(row)
+                else:
+                    pending[key] = dict(row)
+                    self._rows += 1
+
+            if self._rows >= self.max_rows or time.time() - self._first_timestamp >= self.max_seconds:
+                self.flush()
+
+    def flush(self, tables: list = None) -> int:
+        """Write the pending rows of the tables, or of all the tables if tables is None. """
+        with self._lock:
+            tables = [t for t in (self._pending if tables is None else tables) if self._pending.get(t)]
+            if len(tables) == 0:
+                return 0
+            conn = _connect(self.db_name)
+            count = 0
+            for table_name in tables:
+                rows = list(self._pending.pop(table_name).values())
+                # 列相同的行才能写在同一条语句中。
+                groups = {}
+                for row in rows:
+                    groups.setdefault(tuple(row.keys()), []).append(row)
+                for columns, group in groups.items():
+                    for i in range(0, len(group), self.__FLUSH_BATCH_SIZE__):
+                        batch = group[i:i + self.__FLUSH_BATCH_SIZE__]
+                        params = []
+                        for row in batch:
+                            params.extend([row[c] for c in columns])
+                        _upsert(conn, table_name, list(columns), len(batch), tuple(params),
+                                self._unique_keys[table_name])
+                count += len(rows)
+            self._rows -= count
+            return count
+
+
+class BufferedConn(object):
+    """Flush the buffered rows of the tables before running any SQL on them. """
+
+    def __init__(self, conn, buffer: WriteBuffer):
+        self._conn = conn
+        self._buffer = buffer
+
+    def query(self, sql: str, params=()) -> list:
+        self._buffer.flush(table_names(sql))
+        return self._conn.query(sql, params)
+
+    def query_one(self, sql: str, params=()):
+        self._buffer.flush(table_names(sql))
+        return self._conn.query_one(sql, params)
+
+    def query_range(self, sql: str, params=()):
+        self._buffer.flush(table_names(sql))
+        return self._conn.query_range(sql, params)
+
+    def insert(self, sql: str, params=()) -> int:
+        self._buffer.flush(table_names(sql))
+        return self._conn.insert(sql, params)
+
+    def execute(self, sql: str, params=()):
+        self._buffer.flush(table_names(sql))
+        return self._conn.execute(sql, params)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class StorageConn(object):
+    """The same interface as pyanalysis.mysql.Conn, the SQL on the memory tables runs in the MemoryStorage. """
+
+    def __init__(self, db_name: str, storage: MemoryStorage):
+        self._db_name = db_name
+        self._storage = storage
+        self._conn = None
+
+    def _route(self, sql: str):
+        names = table_names(sql)
+        in_memory = [MemoryStorage.is_memory_table(name) for name in names]
+        if names and all(in_memory):
+            return self._storage
+        if any(in_memory):
+            raise RuntimeError("can not join the memory table with the MySQL table", sql)
+        if self._conn is None:
+            self._conn = Conn(self._db_name)
+        return self._conn
+
+    def query(self, sql: str, params=()) -> list:
+        return self._route(sql).query(sql, params)
+
+    def query_one(self, sql: str, params=()):
+        results = self._route(sql).query(sql, params)
+        return results[0] if results else None
+
+    def query_range(self, sql: str, params=()):
+        route = self._route(sql)
+        if route is self._storage:
+            yield from route.query(sql, params)
+        else:
+            yield from route.query_range(sql, params)
+
+    def insert(self, sql: str, params=()) -> int:
+        return self._route(sql).insert(sql, params)
+
+    def execute(self, sql: str, params=()):
+        return self._route(sql).execute(sql, params)
+
+    def upsert(self, table_name: str, columns: list, count: int, params: tuple, unique_key: tuple = ()):
+        if MemoryStorage.is_memory_table(table_name):
+            return self._storage.upsert(table_name, columns, count, params, unique_key)
+        return self._route("INSERT INTO {}".format(table_name)).execute(
+            upsert_sql(table_name, columns, count, unique_key),
+            params,
+        )
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+def _upsert(conn, table_name: str, columns: list, count: int, params: tuple, unique_key: tuple = ()):
+    if isinstance(conn, StorageConn):
+        return conn.upsert(table_name, columns, count, params, unique_key)
+    return conn.execute(upsert_sql(table_name, columns, count, unique_key), params)
+
+
+@contextmanager
+def scope(storages: dict):
+    """Keep the backtest tables of the databases in the {db_name: MemoryStorage} inside the with block.
+
+    Only the code running in the block connects to the storages, the other threads and the code
+    outside the block connect to MySQL. An inner block replaces the storages of the outer one, an
+    empty dict connects to MySQL.
+    """
+    token = _scoped_storages.set(dict(storages))
+    try:
+        yield storages
+    finally:
+        _scoped_storages.reset(token)
+
+
+def use_write_buffer(db_name: str, max_rows: int = 1000, max_seconds: float = 5.0) -> WriteBuffer:
+    """Buffer the upserts of the database, see WriteBuffer. """
+    with _storages_lock:
+        if db_name not in _buffers:
+            _buffers[db_name] = WriteBuffer(db_name, max_rows=max_rows, max_seconds=max_seconds)
+        return _buffers[db_name]
+
+
+def use_direct(db_name: str) -> None:
+    """Stop buffering the upserts of the database, the buffered rows are flushed first. """
+    with _storages_lock:
+        buffer = _buffers.pop(db_name, None)
+    if buffer is not None:
+        buffer.flush()
+
+
+def _connect(db_name: str):
+    storage = _scoped_storages.get().get(db_name)
+    if storage is None:
+        return Conn(db_name)
+    return StorageConn(db_name, storage)
+
+
+def connect(db_name: str):
+    """Get the connection of the database.
+
+    The backtest tables are routed to memory inside the scope() of their storage, and the buffered
+    rows are flushed before the SQL on their tables if use_write_buffer is called.
+    """
+    buffer = _buffers.get(db_name)
+    if buffer is None:
+        return _connect(db_name)
+    return BufferedConn(_connect(db_name), buffer)
+
+
+def upsert(db_name: str, table_name: str, rows: list, unique_key: tuple = ()) -> None:
+    """Insert the rows, the rows with the same unique key are updated. The table without unique key is
+    only appended.
+
+    The rows are buffered if use_write_buffer is called, otherwise written at once.
+    """
+    if len(rows) == 0:
+        return
+    buffer = _buffers.get(db_name)
+    if buffer is not None:
+        return buffer.add(table_name, rows, unique_key)
+
+    columns = list(rows[0].keys())
+    params = []
+    for row in rows:
+        params.extend([row[c] for c in columns])
+    _upsert(_connect(db_name), table_name, columns, len(rows), tuple(params), unique_key)
+
+
+def flush(db_name: str = None) -> int:
+    """Flush the buffered rows of the database, or of all the databases if db_name is None. Return the
+    count of the flushed rows. The memory tables are flushed by MemoryStorage.flush().
+    """
+    db_names = [db_name] if db_name is not None else sorted(_buffers)
+    return sum([_buffers[name].flush() for name in db_names if name in _buffers])
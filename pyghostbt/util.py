@@ -1,6 +1,7 @@
 import hashlib
 import random
 import math
+import numpy as np
 
 from typing import List
 from datetime import datetime
@@ -55,6 +56,35 @@ def real_number(std_num: float) -> float:
     return float(std_num) / 100000000
 
 
+def standard_numbers(input_nums) -> np.ndarray:
+    """Get the standard number values of a whole column at once.
+
+    The vectorized version of standard_number, rounds every item the same way.
+
+    Args:
+        input_nums: The numbers you want to standard, any array like object.
+
+    Returns:
+        The standard nums as int64 array.
+    """
+    input_nums = np.asarray(input_nums, dtype=np.float64)
+    return np.trunc(input_nums * 100000000 + np.where(input_nums > 0, 0.5, -0.5)).astype(np.int64)
+
+
+def datetime_strings(timestamps, utc_offset: int = 8 * 60 * 60 * 1000) -> np.ndarray:
+    """Format millisecond timestamps to "YYYY-MM-DD HH:mm:ss" strings at once.
+
+    Args:
+        timestamps: The millisecond timestamps, any array like object.
+        utc_offset: The timezone offset in millisecond, default is Asia/Shanghai.
+
+    Returns:
+        The datetime strings array.
+    """
+    ms = np.asarray(timestamps, dtype=np.int64) + utc_offset
+    return np.char.replace(np.datetime_as_string(ms.astype("datetime64[ms]"), unit="s"), "T", " ")
+
+
 def interval_time_series(
         start_ts: int = 1199116800000,
         timezone: str = "Asia/Shanghai",
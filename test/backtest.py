@@ -1,3 +1,20 @@
+import re
+import copy
+import random
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+
+from unittest import mock
+from pyghostbt.backtest import Backtest
+from pyghostbt.backtest import SwapWindow
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.tool.kline import KlineCursor
+from pyghostbt.tool.checkpoint import CheckpointFile
+from pyghostbt.tool import storage
+from pyghostbt.const import *
+
 
 strategy_1st_config = {
     "mode": "backtest",
@@ -21,3 +38,504 @@ strategy_1st_config = {
 
 
 # class
+
+
+def matcher(kline=None, **kwargs) -> Backtest:
+    """A Backtest with only the kline, enough for the candle matching. """
+    backtest = Backtest.__new__(Backtest)
+    backtest.update(trade_type=TRADE_TYPE_FUTURE, **kwargs)
+    backtest._kline = kline
+    backtest._passage = None
+    backtest._cursor = None
+    return backtest
+
+
+def random_frame(rnd: random.Random, count: int, start_timestamp: int = 1571184000000) -> KlineFrame:
+    closes, price = [], 1000000000000
+    for _ in range(count):
+        price += rnd.randrange(-2000000000, 2000000001)
+        closes.append(price)
+    highs = [c + rnd.randrange(0, 3000000000) for c in closes]
+    lows = [c - rnd.randrange(0, 3000000000) for c in closes]
+    return KlineFrame(
+        [start_timestamp + i * 60000 for i in range(count)],
+        closes, highs, lows, closes, [1.0] * count,
+        due_timestamp=[1577433600000] * count,
+        standard=True,
+    )
+
+
+def random_instances(rnd: random.Random, frame: KlineFrame, count: int) -> list:
+    instances = []
+    for i in range(count):
+        place_type = rnd.choice([ORDER_PLACE_TYPE_T_TAKER, ORDER_PLACE_TYPE_B_TAKER])
+        if place_type == ORDER_PLACE_TYPE_T_TAKER:
+            price = int(frame.close[0]) + rnd.randrange(0, 15000000000)
+        else:
+            price = int(frame.close[0]) - rnd.randrange(0, 15000000000)
+        instances.append({"id": i, "order": {"place_type": place_type, "price": price}})
+    return instances
+
+
+L_DUE, N_DUE, O_DUE = 1571990400000, 1572595200000, 1577433600000
+
+
+class ContractsKline(object):
+    def __init__(self, candles: list):
+        self.candles = candles
+
+    def query_range_contracts(self, start_timestamp, finish_timestamp, interval, standard=False):
+        return iter(copy.deepcopy([c for c in self.candles if start_timestamp <= c["timestamp"] < finish_timestamp]))
+
+
+def contract_candle(timestamp: int, due_timestamp: int, close: int) -> dict:
+    return {
+        "timestamp": timestamp, "date": str(timestamp), "open": close, "high": close, "low": close, "close": close,
+        "due_timestamp": due_timestamp, "due_date": str(due_timestamp),
+    }
+
+
+def swap_stream(rnd: random.Random, count: int, start_timestamp: int = 1571184000000) -> list:
+    """The l contract and the o contract, the spread narrows from 6% to 0, some candles are missing. """
+    candles = []
+    for i in range(count):
+        timestamp = start_timestamp + i * 60000
+        l_close = 100000 + rnd.randrange(-500, 501)
+        o_close = int(l_close * (1.06 - 0.06 * i / count)) + rnd.randrange(-300, 301)
+        if rnd.random() > 0.05:
+            candles.append(contract_candle(timestamp, L_DUE, l_close))
+        if rnd.random() > 0.2:
+            candles.append(contract_candle(timestamp, N_DUE, l_close))
+        if rnd.random() > 0.1:
+            candles.append(contract_candle(timestamp, O_DUE, o_close))
+    return candles
+
+
+def old_swap(backtest: Backtest, candles: list, instances: list) -> list:
+    """The former matcher, which recounts all the candle groups at every minute. """
+    def compare(candles_kv, instances):
+        if len(candles_kv) == 0:
+            return []
+        contracts_kv, flag = {}, 0
+        candle_timestamps = sorted(candles_kv.keys(), reverse=True)
+        for timestamp in candle_timestamps:
+            if all(i["order"]["due_timestamp"] in candles_kv[timestamp] for i in instances):
+                for due_timestamp in candles_kv[timestamp]:
+                    contracts_kv.setdefault(due_timestamp, []).append(candles_kv[timestamp][due_timestamp])
+                flag += 1
+
+        prices = {}
+        for instance in instances:
+            order = instance["order"]
+            if order["place_type"] in (ORDER_PLACE_TYPE_L_SWAP, ORDER_PLACE_TYPE_O_SWAP):
+                if flag < 15:
+                    continue
+                the_candles = contracts_kv[order["due_timestamp"]]
+                prices[order["place_type"]] = (
+                    the_candles[0]["close"], sum([c["close"] for c in the_candles[:15]]) / 15, instance,
+                )
+                order["price"] = the_candles[0]["close"]
+                order["place_timestamp"] = order["deal_timestamp"] = the_candles[0]["timestamp"]
+                order["place_datetime"] = order["deal_datetime"] = the_candles[0]["date"]
+            else:
+                the_candle = candles_kv[candle_timestamps[0]].get(order["due_timestamp"])
+                if the_candle and backtest._Backtest__compare_candle_with_instance(the_candle, instance):
+                    return [instance]
+        if len(prices) == 2:
+            (l_price, l_avg_price, l_instance) = prices[ORDER_PLACE_TYPE_L_SWAP]
+            (o_price, o_avg_price, o_instance) = prices[ORDER_PLACE_TYPE_O_SWAP]
+            if (-0.03 < o_price / l_price - 1 < 0.03) and (-0.03 < o_avg_price / l_avg_price - 1 < 0.03):
+                return [l_instance, o_instance]
+        return []
+
+    frag_candles_kv, last_timestamp = {}, 0
+    for candle in candles:
+        if candle["timestamp"] != last_timestamp:
+            matched = compare(frag_candles_kv, instances)
+            if matched:
+                return matched
+            frag_candles_kv[candle["timestamp"]] = {}
+        last_timestamp = candle["timestamp"]
+        frag_candles_kv[candle["timestamp"]][candle["due_timestamp"]] = candle
+    return compare(frag_candles_kv, instances)
+
+
+def swap_instances(b_taker_price: int = 0) -> list:
+    instances = [
+        {"id": 0, "order": {"place_type": ORDER_PLACE_TYPE_L_SWAP, "due_timestamp": L_DUE}},
+        {"id": 1, "order": {"place_type": ORDER_PLACE_TYPE_O_SWAP, "due_timestamp": O_DUE}},
+    ]
+    if b_taker_price:
+        instances.append({"id": 2, "order": {
+            "place_type": ORDER_PLACE_TYPE_B_TAKER, "due_timestamp": L_DUE, "price": b_taker_price,
+        }})
+    return instances
+
+
+class PyramidKline(object):
+    """The 1min candles, and the 1hour pyramid bars of the covered ranges. """
+    HOUR = INTERVAL_MILLISECONDS[KLINE_INTERVAL_1HOUR]
+
+    def __init__(self, frame: KlineFrame, ranges: list):
+        self.frame = frame
+        self.ranges = ranges
+
+    def query_frames(self, start_timestamp, finish_timestamp, interval, standard=False):
+        frame = self.frame.between(start_timestamp, finish_timestamp)
+        for i in range(0, len(frame), 50):
+            yield frame.slice(i, i + 50)
+
+    def query_pyramid(self, start_timestamp, finish_timestamp, interval, standard=False):
+        bars = KlineFrame.concat([
+            self.frame.resample(list(range(covered_start, covered_finish + 1, self.HOUR)))
+            for covered_start, covered_finish in self.ranges
+        ])
+        return bars.between(start_timestamp - self.HOUR + 1, finish_timestamp), self.ranges
+
+
+class SqliteConn(object):
+    """The interface of pyanalysis.mysql.Conn on one sqlite database shared by all the connections. """
+    db = None
+
+    def __init__(self, db_name: str):
+        pass
+
+    def query(self, sql, params=()):
+        # MySQL中表结构的查询
+        if "information_schema.COLUMNS" in sql:
+            data_types = {"INTEGER": "int", "REAL": "decimal", "TEXT": "varchar"}
+            return [
+                {"COLUMN_NAME": c["name"], "DATA_TYPE": data_types[c["type"]], "COLUMN_DEFAULT": c["dflt_value"]}
+                for c in self.db.execute("PRAGMA table_info({})".format(params[0]))
+            ]
+        if "information_schema.STATISTICS" in sql:
+            return [
+                {"INDEX_NAME": i["name"], "COLUMN_NAME": c["name"]}
+                for i in self.db.execute("PRAGMA index_list({})".format(params[0])) if i["unique"]
+                for c in self.db.execute("PRAGMA index_info({})".format(i["name"]))
+            ]
+        return [dict(row) for row in self.db.execute(sql, params).fetchall()]
+
+    def query_one(self, sql, params=()):
+        rows = self.query(sql, params)
+        return rows[0] if rows else None
+
+    def insert(self, sql, params=()):
+        return self.db.execute(sql, params).lastrowid
+
+    def execute(self, sql, params=()):
+        # MySQL的upsert写法
+        sql = re.sub(r"VALUES\((`\w+`)\)", r"excluded.\1", sql.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET"))
+        return self.db.execute(sql, params).rowcount
+
+    def close(self):
+        pass
+
+    @classmethod
+    def setup(cls):
+        cls.db = sqlite3.connect(":memory:")
+        cls.db.row_factory = sqlite3.Row
+        for sql in (
+                "CREATE TABLE future_instance_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, backtest_id TEXT,"
+                " status INTEGER, asset_pnl REAL)",
+                "CREATE TABLE future_order_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, instance_id INTEGER,"
+                " sequence INTEGER, status INTEGER, UNIQUE (instance_id, sequence))",
+                "CREATE TABLE future_param_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, instance_id INTEGER,"
+                " param_name TEXT, param_value TEXT)",
+                "CREATE TABLE future_indices_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, instance_id INTEGER,"
+                " indices_name TEXT, indices_value TEXT)",
+                "CREATE TABLE future_account_flow_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, backtest_id TEXT,"
+                " timestamp INTEGER, amount REAL)",
+                "CREATE TABLE future_asset_backtest (id INTEGER PRIMARY KEY AUTOINCREMENT, backtest_id TEXT,"
+                " timestamp INTEGER, asset_total REAL)",
+        ):
+            cls.db.execute(sql)
+
+
+class NoopBacktest(Backtest):
+    def run(self, start_timestamp, finish_timestamp):
+        pass
+
+
+class TestBacktestMatch(unittest.TestCase):
+    def assertSameTrigger(self, backtest: Backtest, frames: list, instances: list):
+        # 原来的逐根蜡烛、逐个instance比较
+        expected = {}
+        candidates = copy.deepcopy(instances)
+        for frame in frames:
+            for candle in frame:
+                for instance in candidates:
+                    if backtest._Backtest__compare_candle_with_instance(candle, instance):
+                        expected = instance
+                        break
+                if expected:
+                    break
+            if expected:
+                break
+
+        passed = backtest._Backtest__match_frames(frames, copy.deepcopy(instances))
+        self.assertEqual(passed.get("id"), expected.get("id"))
+        self.assertEqual(passed.get("order"), expected.get("order"))
+
+    def test_match_frames(self):
+        rnd = random.Random(11)
+        backtest = matcher()
+        for _ in range(200):
+            frame = random_frame(rnd, rnd.randrange(1, 120))
+            instances = random_instances(rnd, frame, rnd.randrange(1, 6))
+            pages = [frame.slice(i, i + 25) for i in range(0, len(frame), 25)]
+            self.assertSameTrigger(backtest, pages, instances)
+
+    def test_match_frames_tie(self):
+        backtest = matcher()
+        frame = KlineFrame(
+            [1571184000000, 1571184060000, 1571184120000],
+            [100, 100, 100], [101, 120, 130], [99, 80, 70], [100, 100, 100], [1.0] * 3,
+            due_timestamp=[1577433600000] * 3,
+            standard=True,
+        )
+        # 同一根蜡烛触发多个instance时，排在前面的优先
+        instances = [
+            {"id": 0, "order": {"place_type": ORDER_PLACE_TYPE_T_TAKER, "price": 125}},
+            {"id": 1, "order": {"place_type": ORDER_PLACE_TYPE_B_TAKER, "price": 90}},
+            {"id": 2, "order": {"place_type": ORDER_PLACE_TYPE_T_TAKER, "price": 110}},
+        ]
+        passed = backtest._Backtest__match_frames([frame], copy.deepcopy(instances))
+        self.assertEqual(passed["id"], 1)
+        self.assertEqual(passed["order"]["place_timestamp"], 1571184060000)
+        self.assertEqual(passed["order"]["due_timestamp"], 1577433600000)
+        self.assertSameTrigger(backtest, [frame], instances)
+
+        # 市价单在第一根蜡烛成交
+        instances.append({"id": 3, "order": {"place_type": ORDER_PLACE_TYPE_MARKET, "price": 0}})
+        passed = backtest._Backtest__match_frames([frame], copy.deepcopy(instances))
+        self.assertEqual(passed["id"], 3)
+        self.assertEqual(passed["order"]["avg_price"], 100)
+        self.assertSameTrigger(backtest, [frame], instances)
+        self.assertEqual(backtest._Backtest__match_frames([frame], []), {})
+
+    def test_swap_window(self):
+        window = SwapWindow(swap_instances(b_taker_price=1))
+        # 缺少某个contract的蜡烛组不计入
+        window.push({L_DUE: contract_candle(0, L_DUE, 1), O_DUE: contract_candle(0, O_DUE, 1)})
+        window.push({L_DUE: contract_candle(60000, L_DUE, 2)})
+        self.assertEqual(window.flag, 1)
+        self.assertEqual(window.latest[L_DUE]["close"], 1)
+
+        closes = [1]
+        for i in range(2, 40):
+            closes.append(i * i)
+            window.push({L_DUE: contract_candle(i * 60000, L_DUE, i * i), O_DUE: contract_candle(i * 60000, O_DUE, i)})
+        self.assertEqual(window.flag, 39)
+        self.assertEqual(window.avg_price(L_DUE), sum(closes[-15:]) / 15)
+        self.assertEqual(window.avg_price(O_DUE), sum(range(25, 40)) / 15)
+        self.assertEqual(window.latest[O_DUE]["close"], 39)
+
+    def test_swap_after_window(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(20)]
+        candles = []
+        for i, timestamp in enumerate(timestamps):
+            candles.append(contract_candle(timestamp, L_DUE, 100000))
+            # 第3、4分钟缺少o contract
+            if i not in (3, 4):
+                candles.append(contract_candle(timestamp, O_DUE, 100000))
+        backtest = matcher(ContractsKline(candles))
+        # 对齐的蜡烛组不足15个时不换仓
+        self.assertEqual(backtest._back_test_swap_by_min_kline(timestamps[0], timestamps[16], swap_instances()), [])
+        swapped = backtest._back_test_swap_by_min_kline(timestamps[0], timestamps[-1], swap_instances())
+        self.assertEqual([i["id"] for i in swapped], [0, 1])
+        self.assertEqual(swapped[0]["order"]["place_timestamp"], timestamps[16])
+        self.assertEqual(swapped[1]["order"]["price"], 100000)
+
+    def test_swap_stream(self):
+        rnd = random.Random(12)
+        swaps = 0
+        for trial in range(60):
+            candles = swap_stream(rnd, rnd.randrange(10, 400))
+            b_taker_price = 99000 if trial % 3 == 0 else 0
+            backtest = matcher(ContractsKline(candles))
+            expected = old_swap(backtest, copy.deepcopy(candles), swap_instances(b_taker_price))
+            swapped = backtest._back_test_swap_by_min_kline(
+                candles[0]["timestamp"], candles[-1]["timestamp"] + 60000, swap_instances(b_taker_price),
+            )
+            self.assertEqual([i["id"] for i in swapped], [i["id"] for i in expected])
+            self.assertEqual([i["order"] for i in swapped], [i["order"] for i in expected])
+            swaps += len(swapped) == 2
+        self.assertGreater(swaps, 10)
+
+    def test_coarse_ranges(self):
+        hour = PyramidKline.HOUR
+        frame = KlineFrame([0, hour, 2 * hour], [5] * 3, [6, 9, 7], [4, 1, 3], [5] * 3, [1.0] * 3, standard=True)
+        self.assertEqual(Backtest._coarse_possible(frame, [
+            {"order": {"place_type": ORDER_PLACE_TYPE_T_TAKER, "price": 8}},
+        ]).tolist(), [False, True, False])
+        self.assertEqual(Backtest._coarse_possible(frame, [
+            {"order": {"place_type": ORDER_PLACE_TYPE_T_TAKER, "price": 8}},
+            {"order": {"place_type": ORDER_PLACE_TYPE_B_TAKER, "price": 4}},
+        ]).tolist(), [False, True, True])
+
+        # 覆盖的范围内只扫描可能触发的组，组在范围的边界上截断，没有覆盖的部分全部扫描
+        segments = Backtest._coarse_ranges(
+            30 * 60000, 10 * hour + 30 * 60000, [[0, 4 * hour], [6 * hour, 12 * hour]],
+            np.array([0, 2 * hour, 3 * hour, 7 * hour, 10 * hour], dtype=np.int64), hour,
+        )
+        self.assertEqual(segments, [
+            [30 * 60000, hour], [2 * hour, 6 * hour], [7 * hour, 8 * hour],
+            [10 * hour, 10 * hour + 30 * 60000],
+        ])
+        self.assertEqual(Backtest._coarse_ranges(0, hour, [], np.zeros(0, dtype=np.int64), hour), [[0, hour]])
+
+    def assertSameCoarse(self, kline: PyramidKline, start_timestamp: int, finish_timestamp: int, instances: list):
+        expected = matcher(kline)._back_test_by_min_kline(start_timestamp, finish_timestamp, copy.deepcopy(instances))
+        coarse = matcher(kline, backtest_coarse_interval=KLINE_INTERVAL_1HOUR)
+        passed = coarse._back_test_by_min_kline(start_timestamp, finish_timestamp, copy.deepcopy(instances))
+        self.assertEqual(passed.get("id"), expected.get("id"))
+        self.assertEqual(passed.get("order"), expected.get("order"))
+        return passed
+
+    def test_coarse_edges(self):
+        hour = PyramidKline.HOUR
+        start = 1571184000000 - 1571184000000 % hour
+        timestamps = [start + i * 60000 for i in range(8 * 60)]
+        highs = [100] * len(timestamps)
+        # 开始时间之前和结束时间之后的最高价更高，所在的组可能触发
+        highs[3 * 60 + 10], highs[3 * 60 + 50] = 130, 115
+        highs[6 * 60 + 10], highs[6 * 60 + 40] = 112, 140
+        frame = KlineFrame(timestamps, [100] * len(timestamps), highs, [90] * len(timestamps), [100] * len(timestamps),
+                           [1.0] * len(timestamps), due_timestamp=[1577433600000] * len(timestamps), standard=True)
+        kline = PyramidKline(frame, [[start, start + 8 * hour]])
+
+        instances = [{"id": 0, "order": {"place_type": ORDER_PLACE_TYPE_T_TAKER, "price": 110}}]
+        passed = self.assertSameCoarse(kline, start + 3 * hour + 40 * 60000, start + 6 * hour + 30 * 60000, instances)
+        self.assertEqual(passed["order"]["place_timestamp"], timestamps[3 * 60 + 50])
+        passed = self.assertSameCoarse(kline, start + 4 * hour, start + 6 * hour + 30 * 60000, instances)
+        self.assertEqual(passed["order"]["place_timestamp"], timestamps[6 * 60 + 10])
+        passed = self.assertSameCoarse(kline, start + 4 * hour, start + 6 * hour + 5 * 60000, instances)
+        self.assertEqual(passed, {})
+
+    def test_coarse_random(self):
+        rnd = random.Random(13)
+        hour = PyramidKline.HOUR
+        for _ in range(100):
+            frame = random_frame(rnd, 10 * 60, start_timestamp=1571184000000 - 1571184000000 % hour)
+            start = int(frame.timestamp[0])
+            covered_start = start + rnd.randrange(0, 4) * hour
+            kline = PyramidKline(frame, [[covered_start, covered_start + rnd.randrange(1, 7) * hour]])
+            start_timestamp = start + rnd.randrange(0, 5 * 60) * 60000
+            finish_timestamp = start_timestamp + rnd.randrange(1, 5 * 60) * 60000
+            instances = random_instances(rnd, frame.between(start_timestamp, finish_timestamp), rnd.randrange(1, 4))
+            self.assertSameCoarse(kline, start_timestamp, finish_timestamp, instances)
+
+
+class TestBacktestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        SqliteConn.setup()
+        conn = SqliteConn("test")
+        backtest_id, timestamp = "c" * 32, 1571184000000
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch("pyghostbt.backtest.Conn", SqliteConn), \
+                mock.patch("pyghostbt.tool.storage.Conn", SqliteConn):
+            backtest = NoopBacktest(dict(
+                strategy_1st_config,
+                strategy="noop",
+                backtest_id=backtest_id,
+                backtest_checkpoint_dir=directory,
+            ))
+            # 检查点之前：一个结束的instance，一个还在进行的instance
+            conn.insert("INSERT INTO future_instance_backtest (backtest_id, status) VALUES (?, ?)",
+                        (backtest_id, INSTANCE_STATUS_FINISHED))
+            live_id = conn.insert("INSERT INTO future_instance_backtest (backtest_id, status) VALUES (?, ?)",
+                                  (backtest_id, INSTANCE_STATUS_OPENING))
+            conn.insert("INSERT INTO future_order_backtest (instance_id, sequence, status) VALUES (?, ?, ?)",
+                        (live_id, 0, ORDER_STATUS_FINISH))
+            conn.insert("INSERT INTO future_param_backtest (instance_id, param_name, param_value) VALUES (?, ?, ?)",
+                        (live_id, "position", "0.5"))
+            conn.insert("INSERT INTO future_account_flow_backtest (backtest_id, timestamp, amount) VALUES (?, ?, ?)",
+                        (backtest_id, timestamp - 1000, 10.0))
+            for t, total in ((timestamp - 1000, 10.0), (timestamp, 10.0)):
+                conn.insert("INSERT INTO future_asset_backtest (backtest_id, timestamp, asset_total) VALUES (?, ?, ?)",
+                            (backtest_id, t, total))
+            backtest._cursor = KlineCursor(backtest._kline)
+            backtest._cursor.seek(timestamp - 60000)
+            self.assertTrue(backtest.checkpoint(timestamp, timestamp + 86400000, state={"day": 1}))
+            saved = {
+                table: conn.query("SELECT * FROM future_{}_backtest ORDER BY id".format(table))
+                for table in ("instance", "order", "param", "account_flow", "asset")
+            }
+
+            # 检查点之后写入的数据
+            conn.execute("UPDATE future_instance_backtest SET status = ?, asset_pnl = ? WHERE id = ?",
+                         (INSTANCE_STATUS_FINISHED, 0.1, live_id))
+            created_id = conn.insert("INSERT INTO future_instance_backtest (backtest_id, status) VALUES (?, ?)",
+                                     (backtest_id, INSTANCE_STATUS_OPENING))
+            for instance_id in (live_id, created_id):
+                conn.insert("INSERT INTO future_order_backtest (instance_id, sequence, status) VALUES (?, ?, ?)",
+                            (instance_id, 1, ORDER_STATUS_FINISH))
+            conn.execute("UPDATE future_param_backtest SET param_value = ? WHERE instance_id = ?", ("1.0", live_id))
+            conn.insert("INSERT INTO future_account_flow_backtest (backtest_id, timestamp, amount) VALUES (?, ?, ?)",
+                        (backtest_id, timestamp + 1000, 0.1))
+            conn.execute("UPDATE future_asset_backtest SET asset_total = ? WHERE timestamp = ?", (10.1, timestamp))
+            conn.insert("INSERT INTO future_asset_backtest (backtest_id, timestamp, asset_total) VALUES (?, ?, ?)",
+                        (backtest_id, timestamp + 1000, 10.1))
+
+            resumed = NoopBacktest.resume(backtest_id, directory)
+            for table, rows in saved.items():
+                self.assertEqual(conn.query("SELECT * FROM future_{}_backtest ORDER BY id".format(table)), rows)
+            self.assertEqual(resumed.checkpoint_state, {"day": 1})
+            self.assertEqual(resumed.checkpoint_timestamp, timestamp)
+            self.assertEqual(resumed._cursor.position, timestamp - 60000)
+
+    def test_memory_ids(self):
+        SqliteConn.setup()
+        conn = SqliteConn("test")
+        backtest_id, timestamp = "d" * 32, 1571184000000
+        # 其他回测已经用了MySQL中的id
+        conn.insert("INSERT INTO future_instance_backtest (backtest_id, status) VALUES (?, ?)",
+                    ("e" * 32, INSTANCE_STATUS_FINISHED))
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch("pyghostbt.backtest.Conn", SqliteConn), \
+                mock.patch("pyghostbt.tool.storage.Conn", SqliteConn):
+            backtest = NoopBacktest(dict(
+                strategy_1st_config,
+                strategy="noop",
+                backtest_id=backtest_id,
+                backtest_checkpoint_dir=directory,
+                backtest_storage=STORAGE_MEMORY,
+            ))
+            # 创建内存回测不影响其他的连接
+            self.assertNotIsInstance(storage.connect("test"), storage.StorageConn)
+
+            instance_ids = []
+            with backtest.memory_scope():
+                memory = storage.connect("test")
+                self.assertIsInstance(memory, storage.StorageConn)
+                for day in range(2):
+                    instance_id = memory.insert(
+                        "INSERT INTO future_instance_backtest (backtest_id, status) VALUES (?, ?)",
+                        (backtest_id, INSTANCE_STATUS_OPENING),
+                    )
+                    instance_ids.append(instance_id)
+                    storage.upsert("test", "future_order_backtest", [
+                        {"instance_id": instance_id, "sequence": 0, "status": ORDER_STATUS_FINISH},
+                    ], unique_key=("instance_id", "sequence"))
+                    self.assertTrue(backtest.checkpoint(timestamp + day * 86400000, timestamp + 2 * 86400000))
+                self.assertEqual(
+                    [i["id"] for i in memory.query("SELECT id FROM future_instance_backtest ORDER BY id")],
+                    instance_ids,
+                )
+            backtest.finish()
+
+            # 策略看到的id，检查点中的id和MySQL中的id相同
+            self.assertEqual(instance_ids, [2, 3])
+            rows = CheckpointFile.load(directory, backtest_id)["rows"]
+            self.assertEqual([i["id"] for i in rows["instance"]], instance_ids)
+            self.assertEqual([o["instance_id"] for o in rows["order"]], instance_ids)
+            self.assertEqual(
+                [i["id"] for i in conn.query("SELECT id FROM future_instance_backtest WHERE backtest_id = ?",
+                                             (backtest_id,))],
+                instance_ids,
+            )
+            self.assertEqual(
+                [o["instance_id"] for o in conn.query("SELECT instance_id FROM future_order_backtest ORDER BY id")],
+                instance_ids,
+            )
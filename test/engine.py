@@ -0,0 +1,49 @@
+import unittest
+
+from pyghostbt.engine import Engine
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.const import *
+
+
+class FrameKline(object):
+    def __init__(self, frame: KlineFrame):
+        self.frame = frame
+        self.reads = 0
+
+    def query_frames(self, start_timestamp, finish_timestamp, interval, standard=False):
+        self.reads += 1
+        yield self.frame.between(start_timestamp, finish_timestamp)
+
+
+class StageInstance(dict):
+    def __init__(self, engine: Engine):
+        super().__init__(status=INSTANCE_STATUS_WAITING)
+        self.engine = engine
+        self.stages = []
+
+    def on_candle(self, candle):
+        self.stages.append((candle["timestamp"], self["status"]))
+        if self["status"] == INSTANCE_STATUS_WAITING:
+            self["status"] = INSTANCE_STATUS_OPENING
+            self.engine.add(StageInstance(self.engine))
+        elif self["status"] == INSTANCE_STATUS_OPENING:
+            self["status"] = INSTANCE_STATUS_FINISHED
+
+
+class TestEngine(unittest.TestCase):
+    def test_run(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(4)]
+        kline = FrameKline(KlineFrame(timestamps, [1.0] * 4, [1.0] * 4, [1.0] * 4, [1.0] * 4, [1.0] * 4))
+        engine = Engine(kline)
+        first = StageInstance(engine)
+        engine.add(first, start_timestamp=timestamps[1])
+
+        self.assertEqual(engine.run(timestamps[0], timestamps[-1] + 60000), 4)
+        self.assertEqual(kline.reads, 1)
+        self.assertEqual(first.stages, [
+            (timestamps[1], INSTANCE_STATUS_WAITING),
+            (timestamps[2], INSTANCE_STATUS_OPENING),
+        ])
+        # 每个instance运行两分钟后结束，只剩最后两分钟新建的instance。
+        self.assertNotIn(first, engine.instances)
+        self.assertEqual(len(engine.instances), 2)
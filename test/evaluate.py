@@ -0,0 +1,51 @@
+import unittest
+
+from pyghostbt.evaluate import EquityCurve
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.const import *
+
+
+class TestEquityCurve(unittest.TestCase):
+    def setUp(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(5)]
+        closes = [10000.0, 10500.0, 9800.0, 11000.0, 11200.0]
+        self.frame = KlineFrame(timestamps, closes, closes, closes, closes, [1.0] * 5)
+        self.instances = [{"id": 1, "unit_amount": 100}]
+        self.orders = {1: [
+            {"type": ORDER_TYPE_OPEN_LONG, "deal_amount": 10, "avg_price": 1000000000000, "fee": -0.001,
+             "deal_timestamp": timestamps[0], "due_timestamp": 1577433600000, "status": ORDER_STATUS_FINISH},
+            {"type": ORDER_TYPE_LIQUIDATE_LONG, "deal_amount": 10, "avg_price": 1100000000000, "fee": -0.001,
+             "deal_timestamp": timestamps[3], "due_timestamp": 1577433600000, "status": ORDER_STATUS_FINISH},
+        ]}
+
+    def curve(self, settle_mode):
+        curve = EquityCurve(
+            trade_type=TRADE_TYPE_FUTURE,
+            symbol="btc_usd",
+            exchange=EXCHANGE_OKEX,
+            db_name="test",
+            backtest_id="a" * 32,
+            settle_mode=settle_mode,
+            capital=10.0,
+        )
+        curve.instances, curve.orders = self.instances, self.orders
+        return curve.build(self.frame)
+
+    def test_basis(self):
+        curve = self.curve(SETTLE_MODE_BASIS)
+        self.assertAlmostEqual(curve["unrealized"][0], -0.001)
+        self.assertAlmostEqual(curve["unrealized"][1], 1000 * (1 / 10000 - 1 / 10500) - 0.001)
+        self.assertAlmostEqual(curve["unrealized"][2], 1000 * (1 / 10000 - 1 / 9800) - 0.001)
+        # 平仓以后计入已实现的盈亏
+        settle_pnl = 1000 * (1 / 10000 - 1 / 11000) - 0.002
+        self.assertEqual(curve["unrealized"][3:].tolist(), [0.0, 0.0])
+        self.assertEqual(curve["realized"][:3].tolist(), [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(curve["realized"][4], settle_pnl)
+        self.assertAlmostEqual(curve["equity"][4], 10.0 + settle_pnl)
+        self.assertLess(curve["drawdown"][2], 0.0)
+        self.assertEqual(curve["drawdown"][3], 0.0)
+
+    def test_counter(self):
+        curve = self.curve(SETTLE_MODE_COUNTER)
+        self.assertAlmostEqual(curve["unrealized"][2], 1000 * (9800 - 10000) - 0.001)
+        self.assertAlmostEqual(curve["realized"][3], 1000 * (11000 - 10000) - 0.002)
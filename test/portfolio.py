@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+from unittest import mock
+
+from pyghostbt.portfolio import align
+from pyghostbt.portfolio import PortfolioAsset
+from pyghostbt.tool.asset import ASSET_FIGURES
+from pyghostbt.const import *
+
+
+class TestPortfolio(unittest.TestCase):
+    def test_align(self):
+        timestamps = np.array([1, 2, 3, 5, 8], dtype=np.int64)
+        key_timestamps = np.array([2, 5], dtype=np.int64)
+        values = np.array([1.0, 4.0])
+        aligned = align(timestamps, key_timestamps, values)
+        self.assertTrue(np.isnan(aligned[0]))
+        self.assertEqual(aligned[1:].tolist(), [1.0, 1.0, 4.0, 4.0])
+        self.assertEqual(align(timestamps, key_timestamps, values, fill=0.0)[0], 0.0)
+
+    def test_backtest_id(self):
+        keys = [{"trade_type": TRADE_TYPE_FUTURE, "symbol": "btc_usd", "exchange": EXCHANGE_OKEX}]
+        with self.assertRaises(RuntimeError):
+            PortfolioAsset(keys=keys, mode=MODE_BACKTEST, db_name="test")
+        portfolio = PortfolioAsset(keys=keys, mode=MODE_BACKTEST, db_name="test", backtest_id="a" * 32)
+        self.assertEqual(portfolio.keys[0]["settle_currency"], "btc")
+
+    def test_shared_settle_currency(self):
+        class AssetConn(object):
+            queries = 0
+
+            def query(self, sql, params):
+                AssetConn.queries += 1
+                if "timestamp < ? ORDER BY timestamp DESC" in sql:
+                    return []
+                row = {figure: 1.0 for figure in ASSET_FIGURES}
+                row.update({"timestamp": 100, "position_freeze": 2.0})
+                return [row]
+
+        keys = [
+            {"trade_type": TRADE_TYPE_SWAP, "symbol": "btc_usdt", "exchange": EXCHANGE_OKEX,
+             "settle_mode": SETTLE_MODE_COUNTER},
+            {"trade_type": TRADE_TYPE_SWAP, "symbol": "eth_usdt", "exchange": EXCHANGE_OKEX,
+             "settle_mode": SETTLE_MODE_COUNTER},
+        ]
+        portfolio = PortfolioAsset(keys=keys, mode=MODE_BACKTEST, db_name="test", backtest_id="a" * 32)
+        # 两个币对共用usdt的资产记录，只算一次
+        self.assertEqual(len(portfolio.keys), 1)
+        self.assertEqual(portfolio.keys[0]["settle_currency"], "usdt")
+        self.assertEqual(portfolio.keys[0]["symbols"], ["btc_usdt", "eth_usdt"])
+        with mock.patch("pyghostbt.portfolio.connect", return_value=AssetConn()):
+            result = portfolio.series(0, 200)
+        self.assertEqual(AssetConn.queries, 2)
+        self.assertEqual(result["position_freeze"].shape, (1, 2))
+        self.assertEqual(result["exposure"].tolist(), [0.0, 2.0])
+        self.assertEqual(portfolio.exposure(150), [2.0])
@@ -0,0 +1,95 @@
+import os
+import unittest
+import tempfile
+
+from unittest import mock
+from pyghostbt.backtest import Backtest
+from pyghostbt.sweep import Sweep
+from pyghostbt.sweep import param_grid
+from pyghostbt.sweep import _run_backtest
+from pyghostbt.tool import asset
+from pyghostbt.tool.kline import Kline
+from pyghostbt.const import *
+
+config = {
+    "mode": MODE_BACKTEST,
+    "trade_type": TRADE_TYPE_FUTURE,
+    "symbol": "btc_usd",
+    "exchange": EXCHANGE_OKEX,
+    "contract_type": CONTRACT_TYPE_QUARTER,
+    "db_name": "test",
+    "param": {"position": 0.5},
+}
+
+
+class NoopBacktest(Backtest):
+    """Only runs the param, without the database. """
+
+    def __init__(self, kw):
+        dict.__init__(self, kw)
+        self._memory_storages = {}
+
+    def run(self, start_timestamp, finish_timestamp):
+        # 账本在回测过程中注册
+        asset._ledgers[("test", self["backtest_id"])] = None
+        if self["param"]["position"] == 0:
+            raise RuntimeError("broken")
+
+    def finish(self):
+        return 0
+
+    def summary(self, timestamp):
+        return {"instances": 0, "position": self["param"]["position"]}
+
+
+class TestSweep(unittest.TestCase):
+    def test_param_grid(self):
+        grid = param_grid({"position": [0.5, 1.0], "max_abs_loss": [0.05, 0.1, 0.2]})
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(grid[0], {"position": 0.5, "max_abs_loss": 0.05})
+        self.assertEqual(grid[-1], {"position": 1.0, "max_abs_loss": 0.2})
+        self.assertEqual(param_grid({}), [{}])
+
+    def test_run_backtest(self):
+        with self.assertRaises(RuntimeError):
+            _run_backtest(NoopBacktest, dict(config, param={"position": 0}, backtest_id="a" * 32), 0, 1)
+        self.assertNotIn(("test", "a" * 32), asset._ledgers)
+        result = _run_backtest(NoopBacktest, dict(config, backtest_id="b" * 32), 0, 1)
+        self.assertEqual(result["position"], 0.5)
+        self.assertNotIn(("test", "b" * 32), asset._ledgers)
+
+    def test_run(self):
+        exported = []
+
+        def export(kline, path, start_timestamp, finish_timestamp, interval, contracts=False):
+            exported.append(interval)
+            open(os.path.join(path, interval), "w").close()
+
+        sweep = Sweep(NoopBacktest, config, {"position": [0.5, 0, 1.0]}, start_timestamp=0, finish_timestamp=1,
+                      max_workers=2)
+        with mock.patch.object(Kline, "export", export):
+            configs = sweep.configs()
+        self.assertEqual(exported, [KLINE_INTERVAL_1MIN, KLINE_INTERVAL_1DAY])
+        self.assertEqual(len(set([c["backtest_id"] for c in configs])), 3)
+        kline_dir = configs[0]["kline_offline_dir"]
+        self.assertTrue(os.path.isdir(kline_dir))
+        sweep.close()
+        self.assertFalse(os.path.exists(kline_dir))
+
+        # 失败的回测不影响其他回测
+        with mock.patch.object(Kline, "export", export):
+            results = sweep.run()
+        self.assertEqual([r["param"]["position"] for r in results], [0.5, 0, 1.0])
+        self.assertEqual([r.get("position") for r in results], [0.5, None, 1.0])
+        self.assertIn("broken", results[1]["error"])
+        self.assertNotIn("error", results[0])
+        self.assertIsNone(sweep.kline_dir)
+
+        # 指定的目录不删除
+        with tempfile.TemporaryDirectory() as root:
+            sweep = Sweep(NoopBacktest, config, {"position": [0.5]}, start_timestamp=0, finish_timestamp=1,
+                          kline_dir=root)
+            with mock.patch.object(Kline, "export", export):
+                sweep.configs()
+            sweep.close()
+            self.assertTrue(os.path.isdir(root))
@@ -3,8 +3,9 @@ import unittest
 from pyanalysis.moment import moment
 from pyghostbt.util import uuid
 from pyghostbt.tool.asset import Asset
-from pyghostbt.const import MODE_BACKTEST
-from pyghostbt.const import TRADE_TYPE_FUTURE
+from pyghostbt.tool.asset import AssetLedger
+from pyghostbt.tool.asset import AssetSnapshots
+from pyghostbt.const import *
 
 
 class TestAsset(unittest.TestCase):
@@ -23,3 +24,67 @@ class TestAsset(unittest.TestCase):
         asset.first_invest(20.0, 20.0, 10.0)
         asset.ffreeze(1, 1, moment.now("Asia/Shanghai").millisecond_timestamp)
 
+    def test_ledger(self):
+        class FlowConn(object):
+            def query(self, sql, params=()):
+                return [
+                    {"subject": SUBJECT_INVEST, "amount": 1000000000, "position": 20, "count": 1,
+                     "timestamp": 1230739200000},
+                    {"subject": SUBJECT_TRANSFER_IN, "amount": 500000000, "position": 10, "count": 1,
+                     "timestamp": 1230739200000},
+                ]
+
+        ledger = AssetLedger(FlowConn(), "future_account_flow_backtest", "okex", 1, "btc", "a" * 32)
+        self.assertEqual(ledger.figures(), {
+            "position_total": 20, "asset_total": 10.0,
+            "position_freeze": -0.0, "asset_freeze": -0.0,
+            "position_sub": 10, "asset_sub": 5.0,
+        })
+
+        ledger.add(SUBJECT_FREEZE, -50000000, -1.0, 1571184000000)
+        ledger.add(SUBJECT_SETTLE, 12345678, 0.0, 1571184060000)
+        figures = ledger.figures()
+        self.assertEqual(ledger.timestamp, 1571184060000)
+        self.assertEqual((figures["position_freeze"], figures["asset_freeze"]), (1.0, 0.5))
+        self.assertAlmostEqual(figures["asset_total"], 10.12345678)
+        self.assertAlmostEqual(figures["asset_sub"], 5.12345678)
+
+    def test_ledger_checkpoint(self):
+        class FlowConn(object):
+            def query(self, sql, params=()):
+                return [{"subject": SUBJECT_INVEST, "amount": 1000000000, "position": 20, "count": 1,
+                         "timestamp": 1571184000000}]
+
+        ledger = AssetLedger(FlowConn(), "future_account_flow_backtest", "okex", 1, "btc", "a" * 32)
+        self.assertEqual(ledger.checkpoint(1571183999999), (0, {"total": [0, 0.0, 0], "freeze": [0, 0.0, 0],
+                                                                "sub": [0, 0.0, 0]}))
+        since, sums = ledger.checkpoint(1571270400000)
+        self.assertEqual(since, 1571184000000)
+        self.assertEqual(sums["total"], [1000000000, 20.0, 1])
+
+        # 早于检查点的流水计入检查点，之后的不计入
+        ledger.add(SUBJECT_SETTLE, 100000000, 0.0, 1571183940000)
+        ledger.add(SUBJECT_SETTLE, 200000000, 0.0, 1571184060000)
+        self.assertEqual(ledger.checkpoint(1571270400000)[1]["total"], [1100000000, 20.0, 2])
+        self.assertEqual(ledger.sums["total"], [1300000000, 20.0, 3])
+
+    def test_snapshots(self):
+        class AssetConn(object):
+            def query(self, sql, params=()):
+                return [{"timestamp": 1571184000000, "asset_total": 10.0, "asset_sub": 5.0, "asset_freeze": 0.0,
+                         "position_total": 20, "position_sub": 10, "position_freeze": 0.0}]
+
+        snapshots = AssetSnapshots(AssetConn(), "future_asset_backtest", "okex", 1, "btc", "a" * 32)
+        self.assertIsNone(snapshots.get(1571183999999))
+        self.assertEqual(snapshots.get(1571270400000)["asset_total"], 10.0)
+
+        snapshots.put(1571184060000, dict(snapshots.get(1571184000000), asset_freeze=0.5, position_freeze=1.0))
+        snapshots.put(1571183940000, dict(snapshots.get(1571184000000), asset_total=9.0))
+        self.assertEqual(snapshots.timestamps, [1571183940000, 1571184000000, 1571184060000])
+        self.assertEqual(snapshots.get(1571184059999)["asset_freeze"], 0.0)
+
+        # 更早的流水计入之后的记录
+        snapshots.shift(1571183940000, {"total": (100000000, 0.0), "sub": (100000000, 0.0)})
+        self.assertEqual(snapshots.get(1571183940000)["asset_total"], 9.0)
+        self.assertEqual(snapshots.get(1571184000000)["asset_total"], 11.0)
+        self.assertEqual(snapshots.get(1571184060000)["asset_sub"], 6.0)
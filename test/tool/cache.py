@@ -0,0 +1,37 @@
+import unittest
+import tempfile
+import numpy as np
+
+from pyghostbt.tool.cache import KlineCache
+from pyghostbt.tool.cache import CANDLE_DTYPE
+from pyghostbt.const import *
+
+
+class TestToolCache(unittest.TestCase):
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = KlineCache(root, TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE)
+            records = np.zeros(3, dtype=CANDLE_DTYPE)
+            records["timestamp"] = [1571184000000, 1571184060000, 1571184120000]
+            records["close"] = [8000.1, 8001.2, 8002.3]
+
+            cache.save(KLINE_INTERVAL_1MIN, 1571184000000, records, complete=False)
+            self.assertIsNone(cache.load(KLINE_INTERVAL_1MIN, 1571184000000))
+            self.assertEqual(cache.invalidate_open(KLINE_INTERVAL_1MIN), 1)
+
+            cache.save(KLINE_INTERVAL_1MIN, 1571184000000, records, complete=True)
+            loaded = cache.load(KLINE_INTERVAL_1MIN, 1571184000000)
+            self.assertEqual(loaded["close"].tolist(), records["close"].tolist())
+
+    def test_invalidate_open_keeps_series(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = KlineCache(root, TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE)
+            records = np.zeros(2, dtype=CANDLE_DTYPE)
+            records["timestamp"] = [1571184000000, 1571187600000]
+            cache.save_series(KLINE_INTERVAL_1HOUR, records, [[1571184000000, 1571191200000]])
+            cache.save(KLINE_INTERVAL_1HOUR, 1571184000000, records, complete=False)
+
+            self.assertEqual(cache.invalidate_open(KLINE_INTERVAL_1HOUR), 1)
+            loaded, ranges = cache.load_series(KLINE_INTERVAL_1HOUR)
+            self.assertEqual(loaded["timestamp"].tolist(), records["timestamp"].tolist())
+            self.assertEqual(ranges, [[1571184000000, 1571191200000]])
@@ -0,0 +1,28 @@
+import os
+import random
+import tempfile
+import unittest
+
+from pyghostbt.tool.checkpoint import CheckpointFile
+
+
+class TestCheckpointFile(unittest.TestCase):
+    def test_save_load(self):
+        directory = tempfile.mkdtemp()
+        state = {"timestamp": 1571184000000, "random": random.getstate(), "rows": {"instance": [{"id": 1}]}}
+        path = CheckpointFile.save(directory, "a" * 32, state)
+        self.assertEqual(path, os.path.join(directory, "a" * 32 + ".checkpoint"))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+        loaded = CheckpointFile.load(directory, "a" * 32)
+        self.assertEqual(loaded["timestamp"], state["timestamp"])
+        self.assertEqual(loaded["random"], state["random"])
+        self.assertEqual(loaded["rows"], state["rows"])
+
+        # 再次保存时整体替换
+        CheckpointFile.save(directory, "a" * 32, dict(state, timestamp=1571270400000))
+        self.assertEqual(CheckpointFile.load(directory, "a" * 32)["timestamp"], 1571270400000)
+
+    def test_missing(self):
+        with self.assertRaises(RuntimeError):
+            CheckpointFile.load(tempfile.mkdtemp(), "b" * 32)
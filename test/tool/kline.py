@@ -1,6 +1,14 @@
 import unittest
+import tempfile
+import threading
 
+from unittest import mock
 from pyghostbt.tool.kline import Kline
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.tool.kline import KlineCursor
+from pyghostbt.tool.kline import ContractMatrix
+from pyghostbt.tool.kline import KlineLRU
+from pyghostbt.tool.pyramid import KlinePyramid
 from pyghostbt.const import *
 
 config = {
@@ -12,6 +20,50 @@ config = {
 }
 
 
+class PagedKline(object):
+    def __init__(self, frame: KlineFrame, page_size: int):
+        self.frame = frame
+        self.page_size = page_size
+        self.rows = 0
+        self.closed = 0
+
+    def query_frames(self, start_timestamp, finish_timestamp, interval, standard=False):
+        frame = self.frame.between(start_timestamp, finish_timestamp)
+        try:
+            for i in range(0, len(frame), self.page_size):
+                self.rows += len(frame.slice(i, i + self.page_size))
+                yield frame.slice(i, i + self.page_size)
+        finally:
+            self.closed += 1
+
+
+class RowsConn(object):
+    """Answer the page queries of Kline from the rows in memory. """
+
+    def __init__(self, rows, page_size: int):
+        self.rows = rows
+        self.page_size = page_size
+        self.queries = 0
+
+    def query(self, sql, params):
+        self.queries += 1
+        if "due_timestamp >" in sql:
+            last_timestamp, _, last_due_timestamp, finish_timestamp = params[3:]
+            rows = [r for r in self.rows if r["timestamp"] < finish_timestamp and (
+                r["timestamp"] > last_timestamp
+                or (r["timestamp"] == last_timestamp and r["due_timestamp"] > last_due_timestamp)
+            )]
+            rows.sort(key=lambda r: (r["timestamp"], r["due_timestamp"]))
+        else:
+            start_timestamp, finish_timestamp = params[-2:]
+            rows = [r for r in self.rows if start_timestamp <= r["timestamp"] < finish_timestamp]
+            rows.sort(key=lambda r: r["timestamp"])
+        return [dict(r) for r in rows[:self.page_size]]
+
+    def close(self):
+        pass
+
+
 class TestToolKline(unittest.TestCase):
     def test_raw_query(self):
         k = Kline(**config)
@@ -27,3 +79,235 @@ class TestToolKline(unittest.TestCase):
             i += 1
             print(result)
             print(i)
+
+    def test_frame_rows(self):
+        candles = [
+            {"timestamp": 1571180400000, "date": "2019-10-16 07:00:00", "open": 1.1, "high": 1.3, "low": 1.0,
+             "close": 1.2, "vol": 10.0, "due_timestamp": 1577433600000, "due_date": "2019-12-27 16:00:00"},
+            {"timestamp": 1571180460000, "date": "2019-10-16 07:01:00", "open": 1.2, "high": 1.4, "low": 1.1,
+             "close": 1.3, "vol": 5.0, "due_timestamp": 1577433600000, "due_date": "2019-12-27 16:00:00"},
+        ]
+        frame = KlineFrame.from_candles(candles, standard=True)
+        rows = [row for row in frame]
+        self.assertEqual(len(frame), 2)
+        self.assertEqual(rows[1]["high"], 140000000)
+        self.assertEqual(rows[0]["due_timestamp"], 1577433600000)
+        self.assertEqual(frame.row(1), rows[1])
+        self.assertEqual(len(frame.between(1571180460000, 1571180520000)), 1)
+
+    def test_frame_resample(self):
+        frame = KlineFrame(
+            [0, 60000, 120000, 240000],
+            [1.0, 2.0, 3.0, 4.0],
+            [1.5, 2.5, 3.5, 4.5],
+            [0.5, 1.5, 2.5, 3.5],
+            [1.2, 2.2, 3.2, 4.2],
+            [1.0, 1.0, 1.0, 1.0],
+        )
+        result = frame.resample([0, 180000, 360000, 540000])
+        self.assertEqual(result.timestamp.tolist(), [0, 180000])
+        self.assertEqual(result.open.tolist(), [1.0, 4.0])
+        self.assertEqual(result.high.tolist(), [3.5, 4.5])
+        self.assertEqual(result.low.tolist(), [0.5, 3.5])
+        self.assertEqual(result.close.tolist(), [3.2, 4.2])
+        self.assertEqual(result.vol.tolist(), [3.0, 1.0])
+
+    def test_cursor(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(10)]
+        kline = PagedKline(KlineFrame(timestamps, timestamps, timestamps, timestamps, timestamps, [1.0] * 10), 3)
+        cursor = KlineCursor(kline, standard=False)
+
+        # 第一次扫描到第5根蜡烛时触发
+        for frame in cursor.frames(timestamps[0], timestamps[-1] + 60000):
+            if timestamps[4] in frame.timestamp:
+                break
+        cursor.seek(timestamps[4])
+        scanned = [t for frame in cursor.frames(timestamps[4], timestamps[-1] + 60000) for t in frame.timestamp.tolist()]
+        self.assertEqual(scanned, timestamps[4:])
+        self.assertEqual(kline.rows, 10)
+
+        # 往回扫描时重新读取
+        scanned = [t for frame in cursor.frames(timestamps[1], timestamps[3]) for t in frame.timestamp.tolist()]
+        self.assertEqual(scanned, timestamps[1:3])
+
+        # 扫描过去没有停下的蜡烛不留在缓存里，只保留停下的那一页
+        timestamps = [1571184000000 + i * 60000 for i in range(100)]
+        kline = PagedKline(KlineFrame(timestamps, timestamps, timestamps, timestamps, timestamps, [1.0] * 100), 3)
+        cursor = KlineCursor(kline, standard=False)
+        for frame in cursor.frames(timestamps[0], timestamps[-1] + 60000):
+            self.assertLessEqual(sum(len(f) for f in cursor._buffer), 3)
+            if timestamps[70] in frame.timestamp:
+                break
+        self.assertEqual(cursor.position, timestamps[68] + 1)
+        cursor.seek(timestamps[70])
+        scanned = [t for frame in cursor.frames(timestamps[70], timestamps[80]) for t in frame.timestamp.tolist()]
+        self.assertEqual(scanned, timestamps[70:80])
+        self.assertEqual(kline.rows, 81)
+
+        # close()关闭还在读取的数据流
+        self.assertEqual(kline.closed, 0)
+        cursor.close()
+        self.assertEqual(kline.closed, 1)
+        self.assertEqual(cursor._buffer, [])
+        scanned = [t for frame in cursor.frames(timestamps[80], timestamps[85]) for t in frame.timestamp.tolist()]
+        self.assertEqual(scanned, timestamps[80:85])
+
+    def test_keyset_pages(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(7)]
+        rows = [{"timestamp": t, "close": 1.0, "due_timestamp": 1577433600000} for t in timestamps]
+        conn = RowsConn(rows, 3)
+        with mock.patch("pyghostbt.tool.kline.Conn", return_value=conn):
+            k = Kline(page_size=3, **config)
+            pages = k._query_pages(timestamps[0], timestamps[-1], KLINE_INTERVAL_1MIN)
+            pages = [[c["timestamp"] for c in page] for page in pages]
+        self.assertEqual(pages, [timestamps[:3], timestamps[3:6]])
+        self.assertEqual(conn.queries, 3)
+
+    def test_keyset_contracts(self):
+        # 每个时间有3个contract，页的边界落在同一时间的contract之间
+        timestamps = [1571184000000 + i * 60000 for i in range(5)]
+        dues = [1571990400000, 1572595200000, 1577433600000]
+        rows = [{"timestamp": t, "close": 1.0, "due_timestamp": d} for t in timestamps for d in dues]
+        conn = RowsConn(rows, 2)
+        with mock.patch("pyghostbt.tool.kline.Conn", return_value=conn):
+            k = Kline(page_size=2, **config)
+            keys = [(c["timestamp"], c["due_timestamp"]) for c in k.query_range_contracts(
+                timestamps[0], timestamps[-1], KLINE_INTERVAL_1MIN,
+            )]
+            self.assertEqual(keys, [(t, d) for t in timestamps[:-1] for d in dues])
+
+            # 从start_timestamp时due_timestamp之后的contract开始
+            keys = [(c["timestamp"], c["due_timestamp"]) for c in k.query_range_contracts(
+                timestamps[1], timestamps[3], KLINE_INTERVAL_1MIN, due_timestamp=dues[0],
+            )]
+            self.assertEqual(keys, [(timestamps[1], dues[1]), (timestamps[1], dues[2])] + [
+                (timestamps[2], d) for d in dues
+            ])
+
+    def test_prefetch(self):
+        k = Kline(prefetch=2, **config)
+        closed = threading.Event()
+        read = []
+
+        def pages(count, error=None):
+            try:
+                for i in range(count):
+                    read.append(i)
+                    yield [{"timestamp": i}]
+                if error is not None:
+                    raise error
+            finally:
+                closed.set()
+
+        self.assertEqual([p[0]["timestamp"] for p in k._prefetch_pages(pages(10))], list(range(10)))
+        self.assertTrue(closed.wait(1))
+
+        # 后台线程的异常在读取到该位置时抛出
+        closed.clear()
+        received = []
+        with self.assertRaises(ValueError):
+            for page in k._prefetch_pages(pages(3, ValueError("broken"))):
+                received.append(page[0]["timestamp"])
+        self.assertEqual(received, [0, 1, 2])
+
+        # 提前停止读取时，后台线程不再继续读取
+        closed.clear()
+        del read[:]
+        prefetched = k._prefetch_pages(pages(1000))
+        self.assertEqual(next(prefetched)[0]["timestamp"], 0)
+        prefetched.close()
+        self.assertTrue(closed.wait(1))
+        self.assertLess(len(read), 10)
+
+    def test_contract_matrix(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(3)]
+        dues = [1571990400000, 1577433600000]
+        # 第2个时间缺少当周的contract
+        candles = [
+            {"timestamp": t, "close": 1.0 + i + j / 10, "high": 2.0, "low": 0.5, "due_timestamp": d}
+            for i, t in enumerate(timestamps) for j, d in enumerate(dues)
+            if (i, j) != (1, 0)
+        ]
+        matrix = ContractMatrix.from_candles(candles[::-1], standard=True)
+        self.assertEqual(len(matrix), 3)
+        self.assertEqual(matrix.timestamp.tolist(), timestamps)
+        self.assertEqual(matrix.due_timestamp.tolist(), dues)
+        self.assertEqual(matrix.mask.tolist(), [[True, True], [False, True], [True, True]])
+        self.assertEqual(matrix.close[:, 1].tolist(), [110000000, 210000000, 310000000])
+        self.assertEqual(matrix.aligned(dues).tolist(), [True, False, True])
+        self.assertEqual(matrix.aligned([dues[1]]).tolist(), [True, True, True])
+        self.assertEqual(matrix.candle(1, dues[0]), {})
+        self.assertEqual(matrix.candle(2, dues[0])["close"], 300000000)
+        with self.assertRaises(RuntimeError):
+            matrix.column(1572595200000)
+
+    def test_lru(self):
+        timestamps = [1571184000000 + i * 60000 for i in range(20)]
+        source = KlineFrame(timestamps, timestamps, timestamps, timestamps, timestamps, [1.0] * 20)
+        reads = []
+
+        def read(start_timestamp, finish_timestamp):
+            reads.append((start_timestamp, finish_timestamp))
+            return source.between(start_timestamp, finish_timestamp)
+
+        lru = KlineLRU(8)
+        frame = lru.get(KLINE_INTERVAL_1MIN, False, timestamps[0], timestamps[5], read)
+        self.assertEqual(frame.timestamp.tolist(), timestamps[:5])
+        self.assertEqual(lru.get(KLINE_INTERVAL_1MIN, False, timestamps[1], timestamps[4], read).timestamp.tolist(),
+                         timestamps[1:4])
+        self.assertEqual(reads, [(timestamps[0], timestamps[5])])
+        # 部分命中时只读取没有缓存的部分
+        frame = lru.get(KLINE_INTERVAL_1MIN, False, timestamps[3], timestamps[8], read)
+        self.assertEqual(frame.timestamp.tolist(), timestamps[3:8])
+        self.assertEqual(reads[-1], (timestamps[5], timestamps[8]))
+        self.assertEqual(lru.stats(), {"hits": 1, "partial_hits": 1, "misses": 1, "rows": 8, "segments": 1})
+
+        # 缓存的蜡烛不能被调用者修改
+        with self.assertRaises(ValueError):
+            frame.close[0] = 0.0
+
+        # 超过容量时淘汰最久没有使用的一段
+        lru.get(KLINE_INTERVAL_1MIN, False, timestamps[10], timestamps[15], read)
+        self.assertEqual(lru.stats()["segments"], 1)
+        self.assertEqual(lru.stats()["rows"], 5)
+        lru.get(KLINE_INTERVAL_1MIN, False, timestamps[0], timestamps[2], read)
+        self.assertEqual(reads[-1], (timestamps[0], timestamps[2]))
+        self.assertEqual(lru.stats()["misses"], 3)
+
+        # 滑动窗口读取时合并的一段也不会超过容量
+        timestamps = [1571184000000 + i * 60000 for i in range(420)]
+        source = KlineFrame(timestamps, timestamps, timestamps, timestamps, timestamps, [1.0] * 420)
+        lru = KlineLRU(50)
+        for i in range(400):
+            frame = lru.get(KLINE_INTERVAL_1MIN, False, timestamps[i], timestamps[i + 20], read)
+            self.assertEqual(frame.timestamp.tolist(), timestamps[i:i + 20])
+            self.assertLessEqual(lru.stats()["rows"], 50)
+        self.assertEqual(lru.stats()["segments"], 1)
+        # 超过容量的查询不缓存
+        frame = lru.get(KLINE_INTERVAL_1MIN, False, timestamps[0], timestamps[60], read)
+        self.assertEqual(frame.timestamp.tolist(), timestamps[:60])
+        self.assertLessEqual(lru.stats()["rows"], 50)
+
+    def test_group_label(self):
+        # 2019-10-16 00:00 Asia/Shanghai
+        start = 1571155200000
+        rows = [
+            {"timestamp": start + i * 60000, "open": 1.0 * i, "high": 1.0 * i + 0.5, "low": 1.0 * i - 0.5,
+             "close": 1.0 * i, "vol": 1.0, "due_timestamp": 1577433600000}
+            for i in range(6 * 60)
+        ]
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch("pyghostbt.tool.kline.Conn", return_value=RowsConn(rows, 100)):
+            k = Kline(cache_dir=root, page_size=100, **config)
+            grouped = k.query_by_group(start, start + 4 * 3600000, KLINE_INTERVAL_1HOUR, standard=True)
+            KlinePyramid(k, (KLINE_INTERVAL_1HOUR,)).refresh(start, start + 6 * 3600000)
+            frame, _ = k.query_pyramid(start, start + 4 * 3600000, KLINE_INTERVAL_1HOUR, standard=True)
+            cached = k.query(start, start + 4 * 3600000, KLINE_INTERVAL_1HOUR, standard=True)
+
+        # 所有的读取方式都以组的开始时间作为时间戳
+        self.assertEqual([c["timestamp"] for c in grouped], [start + i * 3600000 for i in range(4)])
+        for candles in ([c for c in frame], cached):
+            self.assertEqual(
+                [(c["timestamp"], c["open"], c["high"], c["low"], c["close"], c["vol"]) for c in candles],
+                [(c["timestamp"], c["open"], c["high"], c["low"], c["close"], c["vol"]) for c in grouped],
+            )
@@ -0,0 +1,38 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+
+from pyghostbt.tool.offline import KlineFile
+from pyghostbt.tool.offline import KlineFileSource
+from pyghostbt.tool.cache import CANDLE_DTYPE
+from pyghostbt.const import *
+
+
+class TestToolOffline(unittest.TestCase):
+    def test_file_source(self):
+        with tempfile.TemporaryDirectory() as root:
+            records = np.zeros(3, dtype=CANDLE_DTYPE)
+            records["timestamp"] = [1571184000000, 1571184060000, 1571184120000]
+            records["close"] = [8000.1, 8001.2, 8002.3]
+            name = KlineFile.name(
+                TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE, None, KLINE_INTERVAL_1MIN, 1571184000000, 1571184180000,
+            )
+            KlineFile.save(
+                os.path.join(root, name),
+                records,
+                trade_type=TRADE_TYPE_SPOT,
+                symbol="btc_usdt",
+                exchange=EXCHANGE_BINANCE,
+                contract_type=None,
+                interval=KLINE_INTERVAL_1MIN,
+                start_timestamp=1571184000000,
+                finish_timestamp=1571184180000,
+                contracts=False,
+                exported_timestamp=1571184180000,
+            )
+
+            source = KlineFileSource(root, TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE)
+            loaded = source.records(1571184060000, 1571184180000, KLINE_INTERVAL_1MIN)
+            self.assertEqual(loaded["close"].tolist(), [8001.2, 8002.3])
+            self.assertRaises(RuntimeError, source.records, 1571184000000, 1571184240000, KLINE_INTERVAL_1MIN)
@@ -0,0 +1,24 @@
+import unittest
+
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.tool.passage import FirstPassageIndex
+
+
+class TestToolPassage(unittest.TestCase):
+    def test_first_passage(self):
+        frame = KlineFrame(
+            [1571184000000, 1571184060000, 1571184120000, 1571184180000, 1571184240000],
+            [5, 5, 5, 5, 5],
+            [6, 8, 7, 9, 6],
+            [4, 3, 4, 2, 4],
+            [5, 5, 5, 5, 5],
+            [1.0, 1.0, 1.0, 1.0, 1.0],
+            standard=True,
+        )
+        passage = FirstPassageIndex(frame, 1571184000000, 1571184300000)
+        self.assertEqual(passage.first_above(7), 1)
+        self.assertEqual(passage.first_above(8, lo=2), 3)
+        self.assertEqual(passage.first_above(8, lo=2, hi=3), -1)
+        self.assertEqual(passage.first_below(3), 3)
+        self.assertEqual(passage.first_below(2), -1)
+        self.assertEqual(passage.index(1571184120000), 2)
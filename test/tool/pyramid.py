@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import numpy as np
+
+from pyghostbt.tool.cache import KlineCache
+from pyghostbt.tool.kline import KlineFrame
+from pyghostbt.tool.pyramid import KlinePyramid
+from pyghostbt.const import *
+
+# 2019-10-13 12:00 Asia/Shanghai, a sunday
+START = 1570939200000
+
+
+class SourceKline(object):
+    def __init__(self, root: str, closes: np.ndarray):
+        self.cache = KlineCache(root, TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE)
+        self.timestamps = START + np.arange(len(closes), dtype=np.int64) * 60000
+        self.closes = closes
+
+    def query_frame(self, start_timestamp, finish_timestamp, interval, standard=False):
+        frame = KlineFrame(self.timestamps, self.closes, self.closes + 0.5, self.closes - 0.5, self.closes,
+                           np.ones(len(self.closes)))
+        return frame.between(start_timestamp, finish_timestamp)
+
+    def expected(self, closes: np.ndarray, bucket_start: int, interval: str) -> tuple:
+        """The open, high, low, close, vol of the 1min candles in the bucket. """
+        inside = (self.timestamps >= bucket_start) & (self.timestamps < bucket_start + INTERVAL_MILLISECONDS[interval])
+        closes = closes[inside]
+        return closes[0], closes.max() + 0.5, closes.min() - 0.5, closes[-1], float(len(closes))
+
+
+class TestToolPyramid(unittest.TestCase):
+    def test_floor(self):
+        with tempfile.TemporaryDirectory() as root:
+            pyramid = KlinePyramid(SourceKline(root, np.zeros(1)))
+            # 2019-10-14 03:00 Asia/Shanghai
+            timestamp = 1570993200000
+            self.assertEqual(pyramid.floor(timestamp, KLINE_INTERVAL_1DAY), 1570982400000)
+            self.assertEqual(pyramid.floor(timestamp, KLINE_INTERVAL_4HOUR), 1570982400000)
+            # 周一开始新的一周
+            self.assertEqual(pyramid.floor(timestamp, KLINE_INTERVAL_1WEEK), 1570982400000)
+            self.assertEqual(pyramid.floor(START, KLINE_INTERVAL_1WEEK), 1570377600000)
+            self.assertEqual(pyramid.ceil(START, KLINE_INTERVAL_1DAY), 1570982400000)
+            self.assertEqual(pyramid.ceil(1570982400000, KLINE_INTERVAL_1DAY), 1570982400000)
+
+    def test_refresh(self):
+        intervals = (KLINE_INTERVAL_1HOUR, KLINE_INTERVAL_1DAY, KLINE_INTERVAL_1WEEK)
+        with tempfile.TemporaryDirectory() as root:
+            kline = SourceKline(root, np.arange(2 * 1440, dtype=np.float64))
+            pyramid = KlinePyramid(kline, intervals)
+            pyramid.refresh(START, START + 1440 * 60000)
+
+            # 数据变化后再覆盖一段重叠的时间，只替换被覆盖的组
+            old = kline.closes.copy()
+            kline.closes = kline.closes + 10000
+            second_start = START + 720 * 60000 + 30 * 60000
+            pyramid.refresh(second_start, START + 2 * 1440 * 60000)
+
+            for interval in intervals:
+                records, ranges = kline.cache.load_series(interval)
+                num = INTERVAL_MILLISECONDS[interval]
+                first_bucket = pyramid.floor(START, interval)
+                self.assertEqual(ranges, [[first_bucket, pyramid.ceil(START + 2 * 1440 * 60000, interval)]])
+                self.assertEqual(records["timestamp"].tolist(), list(range(
+                    first_bucket, pyramid.ceil(START + 2 * 1440 * 60000, interval), num,
+                )))
+                for record in records:
+                    bucket_start = int(record["timestamp"])
+                    closes = old if bucket_start < pyramid.floor(second_start, interval) else kline.closes
+                    expected = kline.expected(closes, bucket_start, interval)
+                    self.assertEqual(
+                        (record["open"], record["high"], record["low"], record["close"], record["vol"]),
+                        expected,
+                    )
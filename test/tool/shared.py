@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+
+from pyghostbt.tool.shared import SharedKline
+from pyghostbt.tool.shared import SharedKlineSource
+from pyghostbt.tool.cache import CANDLE_DTYPE
+from pyghostbt.const import *
+
+
+class TestToolShared(unittest.TestCase):
+    def test_shared_source(self):
+        records = np.zeros(3, dtype=CANDLE_DTYPE)
+        records["timestamp"] = [1571184000000, 1571184060000, 1571184120000]
+        records["close"] = [8000.1, 8001.2, 8002.3]
+        shared = SharedKline.create(
+            records,
+            trade_type=TRADE_TYPE_SPOT,
+            symbol="btc_usdt",
+            exchange=EXCHANGE_BINANCE,
+            contract_type=None,
+            interval=KLINE_INTERVAL_1MIN,
+            start_timestamp=1571184000000,
+            finish_timestamp=1571184180000,
+            contracts=False,
+        )
+        try:
+            source = SharedKlineSource([shared.spec], TRADE_TYPE_SPOT, "btc_usdt", EXCHANGE_BINANCE)
+            loaded = source.records(1571184060000, 1571184180000, KLINE_INTERVAL_1MIN)
+            self.assertEqual(loaded["close"].tolist(), [8001.2, 8002.3])
+            self.assertFalse(loaded["close"].flags.writeable)
+            self.assertRaises(RuntimeError, source.records, 1571184000000, 1571184240000, KLINE_INTERVAL_1MIN)
+            del loaded
+            source.close()
+        finally:
+            shared.unlink()
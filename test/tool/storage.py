@@ -0,0 +1,87 @@
+import unittest
+
+from unittest import mock
+from pyghostbt.tool import storage
+from pyghostbt.tool.storage import MemoryStorage
+from pyghostbt.tool.storage import table_names
+from pyghostbt.tool.storage import upsert_sql
+
+
+class TestToolStorage(unittest.TestCase):
+    def test_route(self):
+        sql = "SELECT * FROM future_asset_backtest WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1"
+        self.assertEqual(table_names(sql), ["future_asset_backtest"])
+        self.assertTrue(MemoryStorage.is_memory_table("future_account_flow_backtest"))
+        self.assertFalse(MemoryStorage.is_memory_table("future_asset_strategy"))
+        self.assertFalse(MemoryStorage.is_memory_table("future_kline_btc_usd"))
+
+    def test_upsert_sql(self):
+        sql = upsert_sql("future_param_backtest", ["instance_id", "param_name", "param_value"], 2,
+                         unique_key=("instance_id", "param_name"))
+        self.assertEqual(sql.count("(?, ?, ?)"), 2)
+        self.assertTrue(sql.endswith("ON DUPLICATE KEY UPDATE `param_value` = VALUES(`param_value`)"))
+        self.assertEqual(table_names(sql), ["future_param_backtest"])
+        self.assertNotIn("ON DUPLICATE", upsert_sql("future_account_flow_backtest", ["amount"], 1))
+
+    def test_use_direct(self):
+        executed = []
+
+        class ExecuteConn(object):
+            def __init__(self, db_name):
+                pass
+
+            def execute(self, sql, params=()):
+                executed.append(params)
+
+        with mock.patch("pyghostbt.tool.storage.Conn", ExecuteConn):
+            storage.use_write_buffer("test_direct", max_rows=100)
+            storage.upsert("test_direct", "future_order_strategy", [{"id": 1, "status": 0}], unique_key=("id",))
+            self.assertEqual(executed, [])
+
+            # 缓冲的数据先写入，之后直接写入
+            storage.use_direct("test_direct")
+            self.assertEqual(executed, [(1, 0)])
+            storage.upsert("test_direct", "future_order_strategy", [{"id": 1, "status": 1}], unique_key=("id",))
+            self.assertEqual(executed, [(1, 0), (1, 1)])
+            storage.use_direct("test_direct")
+
+    def test_memory_upsert(self):
+        executed = []
+
+        class SchemaConn(object):
+            def __init__(self, db_name):
+                pass
+
+            def query(self, sql, params=()):
+                if "information_schema.COLUMNS" in sql:
+                    return [{"COLUMN_NAME": c, "DATA_TYPE": t, "COLUMN_DEFAULT": None} for c, t in (
+                        ("id", "int"), ("instance_id", "int"), ("param_name", "varchar"),
+                        ("param_value", "varchar"), ("flag", "int"),
+                    )]
+                # 第一个唯一键不是upsert的唯一键
+                return [{"INDEX_NAME": "a_flag", "COLUMN_NAME": "flag"},
+                        {"INDEX_NAME": "uk_param", "COLUMN_NAME": "instance_id"},
+                        {"INDEX_NAME": "uk_param", "COLUMN_NAME": "param_name"}]
+
+            def execute(self, sql, params=()):
+                executed.append(sql)
+
+        unique_key = ("instance_id", "param_name")
+        memory = MemoryStorage("test_memory")
+        with mock.patch("pyghostbt.tool.storage.Conn", SchemaConn):
+            # 只在with中使用内存表
+            self.assertNotIsInstance(storage.connect("test_memory"), storage.StorageConn)
+            with storage.scope({"test_memory": memory}):
+                self.assertIsInstance(storage.connect("test_memory"), storage.StorageConn)
+                for value, flag in (("0.5", 1), ("1.0", 2)):
+                    storage.upsert("test_memory", "future_param_backtest", [{
+                        "instance_id": 1, "param_name": "position", "param_value": value, "flag": flag,
+                    }], unique_key=unique_key)
+                rows = storage.connect("test_memory").query("SELECT * FROM future_param_backtest")
+            self.assertNotIsInstance(storage.connect("test_memory"), storage.StorageConn)
+            self.assertEqual([(r["param_value"], r["flag"]) for r in rows], [("1.0", 2)])
+
+            self.assertEqual(memory.flush(), 1)
+        self.assertEqual(executed, [upsert_sql(
+            "future_param_backtest", ["instance_id", "param_name", "param_value", "flag"], 1, unique_key,
+        )])